@@ -0,0 +1,118 @@
+"""
+Cost of filter_list_by_qs on a large relationship sized collection
+
+The "before" numbers come from legacy_filter_list_by_qs, a copy of
+filter_list_by_qs as it was before it shared filter_list, removing the
+rows that didn't match from a copy of the list one by one.  The values
+are given as the integers the old version compared against, it never
+matched integer columns against the strings of a query string.  It also
+can't take a .notin key and only orders by the last key, so only the
+rows it returns are checked against the new version.
+
+    python benchmarks/bench_filter_list_by_qs.py
+"""
+from sqlalchemy.ext.declarative import declarative_base
+from sqlalchemy.types import Integer
+from sqlalchemy.types import Unicode
+from sqlalchemy import Column
+
+from sqlalchemy_traversal import TraversalMixin
+from sqlalchemy_traversal import filter_list_by_qs
+
+import timeit
+
+Base = declarative_base()
+
+ROWS = 20000
+REPEAT = 3
+QS = {
+    '__order_by': 'room, id desc'
+    , 'capacity.not': 0
+    , 'room.in': 'Room 1,Room 2,Room 3'
+}
+
+
+class Event(TraversalMixin, Base):
+    __tablename__ = 'event'
+    id = Column(Integer, primary_key=True)
+    room = Column(Unicode(50))
+    capacity = Column(Integer)
+
+
+def legacy_filter_list_by_qs(qs, collection):
+    method = 'asc'
+
+    order_by = None
+
+    if '__order_by' in qs:
+        order_by = qs.pop('__order_by')
+
+    if order_by:
+        orders = [x.strip() for x in order_by.split(',')]
+
+        for order in orders:
+            if ' ' in order:
+                order, method = order.split()
+                if method == 'asc':
+                    collection.sort(key=lambda x: getattr(x, order))
+                else:
+                    collection.sort(key=lambda x: getattr(x, order), reverse=True)
+
+
+    for key, value in qs.iteritems():
+        if '.in' in key:
+            key = key[0:-3]
+            values = value.split(',')
+
+            for obj in collection[:]:
+                if not getattr(obj, key) in values:
+                    collection.remove(obj)
+
+        elif '.notin' in key:
+            key = key[0:-3]
+            values = value.split(',')
+
+            for obj in collection[:]:
+                if getattr(obj, key) in values:
+                    collection.remove(obj)
+
+        elif '.not' in key:
+            key = key[0:-4]
+
+            for obj in collection[:]:
+                if getattr(obj, key) == value:
+                    collection.remove(obj)
+        else:
+            for obj in collection[:]:
+                if not getattr(obj, key) == value:
+                    collection.remove(obj)
+
+    return collection
+
+
+def best(func, events):
+    return min(timeit.repeat(
+        lambda: func(dict(QS), list(events)), repeat=REPEAT, number=1
+    ))
+
+
+def main():
+    events = [
+        Event(id=i, room=u'Room %s' % (i % 10), capacity=i % 50)
+        for i in range(ROWS)
+    ]
+
+    assert set(legacy_filter_list_by_qs(dict(QS), list(events))) == \
+        set(filter_list_by_qs(dict(QS), list(events)))
+
+    before = best(legacy_filter_list_by_qs, events)
+    after = best(filter_list_by_qs, events)
+
+    print '%s rows, best of %s' % (ROWS, REPEAT)
+    print 'before: %8.1f ms' % (before * 1e3)
+    print 'after:  %8.1f ms' % (after * 1e3)
+    print 'speedup: %.0fx' % (before / after)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,135 @@
+"""
+Cost of parse_key over a corpus of traversal keys
+
+The "before" numbers come from legacy_parse_key, a copy of parse_key as it
+was before the patterns were precompiled and results cached.  It only
+differs from the original in writing its orders to result['order_by'],
+without that it raised a KeyError on every key with an order_by.
+
+    python benchmarks/bench_parse_key.py
+"""
+from sqlalchemy_traversal import parse_key
+from sqlalchemy_traversal import _parse_key
+from sqlalchemy_traversal import _parsed_keys
+
+import re
+import timeit
+
+REPEAT = 5
+NUMBER = 200
+
+CORPUS = [
+    "user"
+    , "messages"
+    , "permissions"
+    , "event.limit(0,20)"
+    , "event.limit(20,20)"
+    , "event.limit(40,20)"
+    , "event.order_by(starts desc)"
+    , "event.limit(0,50).order_by(starts desc)"
+    , "messages{topic.equals(python)}"
+    , "messages{topic.equals(python)}.limit(0,10)"
+    , "messages{id.not_equals(2),topic.equals(bar)}.limit(0,10)"
+    , "messages{id.in(1,2,3,4,5)}"
+    , "messages{id.not_in(7,8)}.limit(0,25).order_by(created desc)"
+    , "attendees{name.starts_with(Jo)}.limit(0,10).order_by(name asc)"
+    , "attendees{email.ends_with(example.com)}.limit(10,10)"
+    , "sessions{title.contains(sqlalchemy),room.equals(A)}.limit(0,5)"
+]
+
+
+def legacy_get_order_by(order_string):
+    final_orders = []
+    orders = [x.strip() for x in order_string.split(',')]
+
+    for order in orders:
+        if ' ' in order:
+            order, method = order.split()
+            if not method:
+                method = 'desc'
+            final_orders.append((order, method))
+
+    return final_orders
+
+
+def legacy_parse_key(key):
+    if key.startswith("/"):
+        key = key[1:]
+
+    key_regex = re.compile("^(?P<name>\w+)(?P<columns>\{.+?\})?.?(?P<limit>limit\(.+?\))?.?(?P<order_by>order_by\(.+?\))?$")
+    match = re.match(key_regex, key)
+
+    name = match.group('name')
+    limit = match.group('limit')
+    order_by = match.group('order_by')
+    columns = match.group('columns')
+
+    result = {'table': name, 'column_filters': []}
+
+    if order_by:
+        order_regex = re.compile("^(\w+)\((.+?)\)$")
+        match = re.match(order_regex, order_by)
+        result['order_by'] = []
+        orders = legacy_get_order_by(match.group(2))
+
+        for order, method in orders:
+            result['order_by'].append((order, method))
+
+    if limit:
+        limit_regex = re.compile("^(\w+)\((\d+),(\d+)\)$")
+        match = re.match(limit_regex, limit)
+        start = int(match.group(2))
+        end = int(match.group(3))
+        result['limit'] = (start, end)
+
+    if columns:
+        column_regex = re.compile("\w+\.\w+\(.+?\)")
+
+        results = re.findall(column_regex, columns)
+
+        for match in results:
+            filter_regex = re.compile("^(?P<column>\w+)\.(?P<command>\w+)\((?P<args>.+?)\)")
+            filter_match = re.match(filter_regex, match)
+
+            column = filter_match.group('column')
+            command = filter_match.group('command')
+            args = filter_match.group('args')
+
+            if command in [
+                    "equals"
+                    , 'not_equals'
+                    , 'starts_with'
+                    , 'ends_with'
+                    ,"contains"
+            ]:
+                result['column_filters'].append((column, command, args))
+            elif command in ["in", "not_in"]:
+                final_args = [x.strip() for x in args.split(',')]
+                result['column_filters'].append((column, command, final_args))
+
+    return result
+
+
+def per_key(func):
+    best = min(timeit.repeat(
+        lambda: [func(key) for key in CORPUS], repeat=REPEAT, number=NUMBER
+    ))
+
+    return best / (NUMBER * len(CORPUS)) * 1e6
+
+
+def main():
+    _parsed_keys.clear()
+
+    before = per_key(legacy_parse_key)
+    uncached = per_key(_parse_key)
+    cached = per_key(parse_key)
+
+    print '%s keys, best of %s' % (len(CORPUS), REPEAT)
+    print 'before:   %6.2f us/key' % before
+    print 'uncached: %6.2f us/key' % uncached
+    print 'cached:   %6.2f us/key' % cached
+
+
+if __name__ == '__main__':
+    main()
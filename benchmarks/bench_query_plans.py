@@ -0,0 +1,88 @@
+"""
+Cost of building, compiling and running the query for a filtered key,
+with filter_query on every request and with a cached QueryPlan
+
+    python benchmarks/bench_query_plans.py
+"""
+from sqlalchemy.ext.declarative import declarative_base
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.types import Integer
+from sqlalchemy.types import Unicode
+from sqlalchemy import Column
+from sqlalchemy import create_engine
+
+from sqlalchemy_traversal import TraversalMixin
+from sqlalchemy_traversal import filter_query
+from sqlalchemy_traversal import get_query_plan
+from sqlalchemy_traversal import parse_key
+
+import timeit
+
+Base = declarative_base()
+
+ROWS = 100
+REPEAT = 5
+NUMBER = 1000
+
+KEYS = [
+    'message{topic.equals(topic%s),id.not_in(1,2,3)}'
+    '.order_by(id desc).limit(0,5)' % i for i in range(3)
+]
+
+
+class Message(TraversalMixin, Base):
+    __tablename__ = 'message'
+    id = Column(Integer, primary_key=True)
+    user_id = Column(Integer)
+    topic = Column(Unicode(50))
+
+
+def rebuilt(session, filters):
+    return filter_query(filters, session.query(Message), Message).all()
+
+
+def planned(session, filters):
+    plan = get_query_plan(Message, filters)
+
+    return list(plan.instances(plan.query(session, filters)))
+
+
+def per_query(func, session):
+    corpus = [parse_key(key) for key in KEYS]
+
+    best = min(timeit.repeat(
+        lambda: [func(session, filters) for filters in corpus],
+        repeat=REPEAT, number=NUMBER
+    ))
+
+    return best / (NUMBER * len(corpus)) * 1e6
+
+
+def main():
+    engine = create_engine('sqlite://')
+    Base.metadata.create_all(engine)
+    session = sessionmaker(bind=engine)()
+
+    session.add_all([
+        Message(id=i, user_id=1, topic=u'topic%s' % (i % 3))
+        for i in range(ROWS)
+    ])
+    session.commit()
+
+    for key in KEYS:
+        filters = parse_key(key)
+
+        assert [x.id for x in rebuilt(session, filters)] == \
+            [x.id for x in planned(session, filters)]
+
+    before = per_query(rebuilt, session)
+    after = per_query(planned, session)
+
+    print '%s keys of the same shape, best of %s' % (len(KEYS), REPEAT)
+    print 'filter_query: %6.1f us/query' % before
+    print 'query plan:   %6.1f us/query' % after
+    print 'speedup:      %.1fx' % (before / after)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,88 @@
+"""
+Per-row cost of loading and serializing a collection, as instances and as
+raw rows with select_rows
+
+    python benchmarks/bench_raw_rows.py
+"""
+from sqlalchemy.ext.declarative import declarative_base
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.types import Integer
+from sqlalchemy.types import Unicode
+from sqlalchemy.types import Boolean
+from sqlalchemy.types import DateTime
+from sqlalchemy import Column
+from sqlalchemy import create_engine
+
+from sqlalchemy_traversal import TraversalMixin
+from sqlalchemy_traversal import ModelCollection
+from sqlalchemy_traversal import select_rows
+
+import datetime
+import timeit
+
+Base = declarative_base()
+
+ROWS = 5000
+REPEAT = 5
+FILTERS = {'table': 'event', 'column_filters': ()}
+
+
+class Event(TraversalMixin, Base):
+    __tablename__ = 'event'
+    id = Column(Integer, primary_key=True)
+    name = Column(Unicode(50))
+    location = Column(Unicode(255))
+    capacity = Column(Integer)
+    is_public = Column(Boolean)
+    starts = Column(DateTime)
+
+
+def instances(session):
+    rows = session.query(Event).all()
+    result = ModelCollection(rows).__json__(None)
+    session.expunge_all()
+
+    return result
+
+
+def raw_rows(session):
+    result, plan = select_rows(session.query(Event), FILTERS, Event)
+
+    return ModelCollection(result.fetchall(), plan=plan).__json__(None)
+
+
+def per_row(func, session):
+    best = min(timeit.repeat(
+        lambda: func(session), repeat=REPEAT, number=1
+    ))
+
+    return best / ROWS * 1e6
+
+
+def main():
+    engine = create_engine('sqlite://')
+    Base.metadata.create_all(engine)
+    session = sessionmaker(bind=engine)()
+
+    starts = datetime.datetime(2012, 5, 1)
+    session.add_all([
+        Event(id=i, name=u'Event %s' % i, location=u'Room %s' % (i % 10),
+            capacity=100, is_public=bool(i % 2), starts=starts)
+        for i in range(ROWS)
+    ])
+    session.commit()
+    session.expunge_all()
+
+    assert instances(session) == raw_rows(session)
+
+    before = per_row(instances, session)
+    after = per_row(raw_rows, session)
+
+    print '%s rows, best of %s' % (ROWS, REPEAT)
+    print 'instances: %6.2f us/row' % before
+    print 'raw rows:  %6.2f us/row' % after
+    print 'speedup:   %.1fx' % (before / after)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,133 @@
+"""
+Per-row cost of JsonSerializableMixin.__json__
+
+The "before" numbers come from legacy_json, a copy of __json__ as it was
+before serialization plans were cached per class.
+
+    python benchmarks/bench_serialization.py
+"""
+from sqlalchemy.ext.declarative import declarative_base
+from sqlalchemy.orm import class_mapper
+from sqlalchemy.orm.properties import RelationshipProperty
+from sqlalchemy.types import Integer
+from sqlalchemy.types import Unicode
+from sqlalchemy.types import UnicodeText
+from sqlalchemy.types import Boolean
+from sqlalchemy.types import DateTime
+from sqlalchemy import Column
+
+from sqlalchemy_traversal import JsonSerializableMixin
+
+import datetime
+import timeit
+
+Base = declarative_base()
+
+ROWS = 5000
+REPEAT = 5
+
+
+class Event(Base, JsonSerializableMixin):
+    __tablename__ = 'event'
+    id = Column(Integer, primary_key=True)
+    name = Column(Unicode(50))
+    slug = Column(Unicode(50))
+    description = Column(UnicodeText)
+    location = Column(Unicode(255))
+    capacity = Column(Integer)
+    attendees = Column(Integer)
+    is_public = Column(Boolean)
+    is_active = Column(Boolean)
+    starts = Column(DateTime)
+    ends = Column(DateTime)
+    created = Column(DateTime)
+    modified = Column(DateTime)
+
+
+def legacy_json(self, request):
+    props = {}
+
+    json_eager_load = set(getattr(self, '_json_eager_load', []))
+
+    for prop in json_eager_load:
+        getattr(self, prop, None)
+
+    properties = list(class_mapper(type(self)).iterate_properties)
+
+    relationships = [
+        p.key for p in properties if type(p) is RelationshipProperty
+    ]
+
+    attrs = []
+    all_properties = {}
+    for p in properties:
+        all_properties[p.key] = p
+
+        if not p.key in relationships:
+            attrs.append(p.key)
+
+    blacklist = set(getattr(self, '_base_blacklist', []))
+    blacklist.update(getattr(self, '_json_blacklist', []))
+
+    for key in attrs:
+        if key in blacklist:
+            continue
+
+        obj = getattr(self, key)
+
+        if isinstance(obj, (datetime.datetime, datetime.date, datetime.time)):
+            props[key] = obj.isoformat()
+            continue
+
+        attr = getattr(self, key)
+
+        if attr and not isinstance(attr, (int, float)):
+            try:
+                props[key] = unicode(attr)
+            except UnicodeDecodeError:
+                props[key] = str(attr)
+            continue
+
+        props[key] = attr
+
+    return props
+
+
+def make_rows():
+    now = datetime.datetime.now()
+
+    return [
+        Event(
+            id=i, name=u'event %s' % i, slug=u'event-%s' % i,
+            description=u'x' * 200, location=u'Somewhere',
+            capacity=100, attendees=i % 100, is_public=True,
+            is_active=bool(i % 2), starts=now, ends=now, created=now,
+            modified=now,
+        ) for i in range(ROWS)
+    ]
+
+
+def per_row(func, rows):
+    best = min(timeit.repeat(
+        lambda: [func(row, None) for row in rows], repeat=REPEAT, number=1
+    ))
+
+    return best / len(rows) * 1e6
+
+
+def main():
+    rows = make_rows()
+
+    assert legacy_json(rows[0], None) == rows[0].__json__(None)
+
+    before = per_row(legacy_json, rows)
+    after = per_row(Event.__json__.im_func, rows)
+
+    print '%s rows, best of %s' % (ROWS, REPEAT)
+    print 'before: %6.2f us/row' % before
+    print 'after:  %6.2f us/row' % after
+    print 'speedup: %.1fx' % (before / after)
+
+
+if __name__ == '__main__':
+    main()
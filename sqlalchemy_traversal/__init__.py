@@ -2,376 +2,1978 @@ from sqlalchemy_traversal.interfaces    import ISABase
 from sqlalchemy_traversal.interfaces    import ISASession
 from sqlalchemy_traversal.interfaces    import ISaver
 from sqlalchemy_traversal.interfaces    import IAfterSaver
+from sqlalchemy_traversal.interfaces    import IAfterBulkSaver
+from sqlalchemy_traversal.interfaces    import ITraversalTables
+from sqlalchemy_traversal.interfaces    import IResponseCache
+from sqlalchemy_traversal.cache         import LRUCache
+from sqlalchemy_traversal.cache         import ResponseCache
 
 from datetime                           import datetime
 from datetime                           import date
 from datetime                           import time
+from collections                        import Mapping
+from decimal                            import Decimal
+from decimal                            import InvalidOperation
 
 from sqlalchemy.orm                     import class_mapper
+from sqlalchemy.orm                     import object_session
+from sqlalchemy.orm                     import object_mapper
+from sqlalchemy.orm                     import subqueryload
+from sqlalchemy.orm                     import defer
+from sqlalchemy.orm                     import Query
+from sqlalchemy.orm                     import Session
+from sqlalchemy.orm.scoping             import ScopedSession
+from sqlalchemy.orm.properties          import ColumnProperty
+from sqlalchemy.orm.attributes          import instance_state
 from sqlalchemy.exc                     import InvalidRequestError
 from sqlalchemy.orm.properties          import RelationshipProperty
+from sqlalchemy                         import event
 from sqlalchemy                         import not_
+from sqlalchemy                         import and_
+from sqlalchemy                         import or_
+from sqlalchemy                         import tuple_
+from sqlalchemy                         import func
+from sqlalchemy                         import bindparam
+from sqlalchemy                         import Numeric
+from sqlalchemy                         import Float
 from sqlalchemy                         import Integer
+from sqlalchemy                         import DateTime
+from sqlalchemy                         import Date
+from sqlalchemy                         import Time
+from sqlalchemy                         import Boolean
+from sqlalchemy                         import String
+from sqlalchemy                         import LargeBinary
+from sqlalchemy                         import Enum
+from sqlalchemy.dialects.postgresql     import UUID
 from zope.interface                     import providedBy
+from zope.interface                     import implementedBy
+from pyramid.settings                   import asbool
+from pyramid.httpexceptions             import HTTPBadRequest
 
 import colander
 import venusian
+from itertools                          import izip
+from operator                           import attrgetter
+
+import base64
+import copy
+import hashlib
+import json
 import re
 import urllib
+import uuid
+import weakref
+
+# name{column.command(args), ...} followed by .limit(...)/.order_by(...)
+KEY_REGEX = re.compile(
+    r"^/?(?P<name>\w+)"
+    r"(?:\{(?P<columns>[^{}]*)\})?"
+    r"(?P<modifiers>(?:\.\w+\([^()]*\))*)$"
+)
+FILTER_REGEX = re.compile(
+    r"\s*(?P<column>\w+)\.(?P<command>\w+)\((?P<args>[^()]*)\)\s*(?:,|$)"
+)
+MODIFIER_REGEX = re.compile(r"\.(?P<command>\w+)\((?P<args>[^()]*)\)")
+LIMIT_REGEX = re.compile(r"^\s*(\d+)\s*,\s*(\d+)\s*$")
+CURSOR_REGEX = re.compile(r"^\s*(\d+)\s*(?:,\s*([\w\-=]+)\s*)?$")
+
+# commands that take a single value, like equals(value)
+SCALAR_COMMANDS = frozenset([
+    'equals'
+    , 'not_equals'
+    , 'starts_with'
+    , 'ends_with'
+    , 'contains'
+    , 'gt'
+    , 'gte'
+    , 'lt'
+    , 'lte'
+])
+
+# commands that take a list of values, like in(1,2,3)
+LIST_COMMANDS = frozenset([
+    'in'
+    , 'not_in'
+])
+
+# commands that take the two ends of a range, like between(1, 10)
+RANGE_COMMANDS = frozenset([
+    'between'
+])
+
+# commands whose values are converted to the type of the column, the
+# string matching ones always compare strings
+COERCED_COMMANDS = frozenset([
+    'equals'
+    , 'not_equals'
+    , 'in'
+    , 'not_in'
+    , 'gt'
+    , 'gte'
+    , 'lt'
+    , 'lte'
+    , 'between'
+])
+
+PARSE_KEY_CACHE_SIZE = 1024
+
+_parsed_keys = LRUCache(PARSE_KEY_CACHE_SIZE)
+
+QUERY_PLAN_CACHE_SIZE = 256
+
+# compiled statements kept per plan, one for each set of options and
+# LIMIT/OFFSET values it was run with
+QUERY_PLAN_STATEMENTS = 16
+
+_query_plans = LRUCache(QUERY_PLAN_CACHE_SIZE)
+
+# one plan per class and set of .fields() a client asked for
+SERIALIZATION_PLAN_CACHE_SIZE = 256
+
+_serialization_plans = LRUCache(SERIALIZATION_PLAN_CACHE_SIZE)
 
 def get_order_by(order_string):
+    """
+    Turns "name, created desc" into [('name', 'asc'), ('created', 'desc')],
+    orders without a direction are ascending
+    """
     final_orders = []
     orders = [x.strip() for x in order_string.split(',')]
 
     for order in orders:
-        if ' ' in order:
-            order, method = order.split()
-            if not method:
-                method = 'desc'
-            final_orders.append((order, method))
+        if not order:
+            continue
+
+        parts = order.split()
+
+        if len(parts) == 1:
+            final_orders.append((parts[0], 'asc'))
+        elif len(parts) == 2 and parts[1].lower() in ('asc', 'desc'):
+            final_orders.append((parts[0], parts[1].lower()))
+        else:
+            raise ValueError("Invalid order: %s" % order)
 
     return final_orders
 
+def _parse_key(key):
+    match = KEY_REGEX.match(key)
+
+    if match is None:
+        raise KeyError(key)
+
+    column_filters = []
+    columns = match.group('columns') or ''
+    pos = 0
+
+    while pos < len(columns):
+        filter_match = FILTER_REGEX.match(columns, pos)
+
+        if filter_match is None or filter_match.end() == pos:
+            raise KeyError(key)
+
+        pos = filter_match.end()
+
+        column = filter_match.group('column')
+        command = filter_match.group('command')
+        args = filter_match.group('args')
+
+        if command in SCALAR_COMMANDS:
+            column_filters.append((column, command, args))
+        elif command in LIST_COMMANDS:
+            final_args = tuple(x.strip() for x in args.split(','))
+            column_filters.append((column, command, final_args))
+        elif command in RANGE_COMMANDS:
+            final_args = tuple(x.strip() for x in args.split(','))
+
+            if len(final_args) != 2:
+                raise KeyError(key)
+
+            column_filters.append((column, command, final_args))
+        elif command == 'is_null':
+            # is_null() and is_null(true) or is_null(false)
+            try:
+                is_null = coerce_boolean(args or 'true', None)
+            except ValueError:
+                raise KeyError(key)
+
+            column_filters.append((column, command, is_null))
+        else:
+            raise KeyError(key)
+
+    result = {
+        'table': match.group('name')
+        , 'column_filters': tuple(column_filters)
+    }
+
+    for modifier in MODIFIER_REGEX.finditer(match.group('modifiers')):
+        command = modifier.group('command')
+        args = modifier.group('args')
+
+        if command == 'limit':
+            limit_match = LIMIT_REGEX.match(args)
+
+            if limit_match is None:
+                raise KeyError(key)
+
+            result['limit'] = (
+                int(limit_match.group(1)), int(limit_match.group(2))
+            )
+        elif command == 'order_by':
+            try:
+                result['order_by'] = tuple(get_order_by(args))
+            except ValueError:
+                raise KeyError(key)
+        elif command == 'cursor':
+            cursor_match = CURSOR_REGEX.match(args)
+
+            if cursor_match is None:
+                raise KeyError(key)
+
+            result['cursor'] = (
+                int(cursor_match.group(1)), cursor_match.group(2)
+            )
+        elif command == 'count':
+            if args.strip():
+                raise KeyError(key)
+
+            result['count'] = True
+        elif command == 'fields':
+            fields = [x.strip() for x in args.split(',') if x.strip()]
+
+            if not fields:
+                raise KeyError(key)
+
+            result['fields'] = frozenset(fields)
+        else:
+            raise KeyError(key)
+
+    # you either page by offset or by cursor
+    if 'limit' in result and 'cursor' in result:
+        raise KeyError(key)
+
+    return result
+
 def parse_key(key):
     """ This will return a set of query rules based on the
     key.
 
-
     The structure of this is:
-    /column{column1.equals(foo).limit(0, 12).order_by(foo,bar)
+    /table{column1.command(args), ...}.limit(offset, count).order_by(foo,bar desc)
 
     for example:
     /messages{id.not_equals(2), topic.equals(bar)}.order_by(name).limit(0, 10)
+
+    Besides the string and list commands columns can be compared with
+    gt, gte, lt, lte and between(low, high), or checked with is_null() and
+    is_null(false):
+
+    /events{starts.between(2012-05-01, 2012-05-31), room.is_null(false)}
+
+    A .fields(id, name) modifier limits which columns are loaded and
+    serialized.
+
+    A .cursor(count) or .cursor(count, next_cursor) modifier pages by the
+    order_by columns and the lookup key instead of by offset, see
+    get_next_cursor.
+
+    A .count() modifier also returns the total number of rows, see
+    count_query.
+
+    The filters and modifiers are all optional and the modifiers may come
+    in any order.  Keys that don't follow this raise a KeyError.
+
+    Parsed keys are cached, so the result must not be changed in place.
     """
+    result = _parsed_keys.get(key)
 
-    # first value will be our column
-    # rest will be values for rules on the query
-    if key.startswith("/"):
-        key = key[1:]
+    if result is None:
+        result = _parse_key(key)
+        _parsed_keys.set(key, result)
 
-    key_regex = re.compile("^(?P<name>\w+)(?P<columns>\{.+?\})?.?(?P<limit>limit\(.+?\))?.?(?P<order_by>order_by\(.+?\))?$")
-    match = re.match(key_regex, key)
+    return dict(result)
 
-    name = match.group('name')
-    limit = match.group('limit')
-    order_by = match.group('order_by')
-    columns = match.group('columns')
+def get_cursor_columns(filters, cls):
+    """
+    The (column, method) pairs a cursor pages by: the order_by columns
+    followed by the lookup key to break ties
+    """
+    columns = list(filters.get('order_by', ()))
+    lookup_key = cls._traversal_lookup_key
 
-    result = {'table': name, 'column_filters': []}
+    if not lookup_key in [order for order, method in columns]:
+        columns.append((lookup_key, 'asc'))
 
-    if order_by:
-        order_regex = re.compile("^(\w+)\((.+?)\)$")
-        match = re.match(order_regex, order_by)
-        result['orders'] = []
-        orders = get_order_by(match.group(2))
+    return columns
 
-        for order, method in orders:
-            result['order_by'].append((order, method))
+def encode_cursor(obj, columns):
+    """
+    Builds the opaque cursor pointing just past obj
+    """
+    values = []
 
-    if limit:
-        limit_regex = re.compile("^(\w+)\((\d+),(\d+)\)$")
-        match = re.match(limit_regex, limit)
-        start = int(match.group(2))
-        end = int(match.group(3))
-        result['limit'] = (start, end)
+    for order, method in columns:
+        value = getattr(obj, order)
 
+        # anything json can't hold goes as the string its coercer reads
+        if isinstance(value, (datetime, date, time)):
+            value = value.isoformat()
+        elif isinstance(value, (Decimal, uuid.UUID)):
+            value = str(value)
 
-    if columns:
-        column_regex = re.compile("\w+\.\w+\(.+?\)")
-
-        results = re.findall(column_regex, columns)
-
-        for match in results:
-            filter_regex = re.compile("^(?P<column>\w+)\.(?P<command>\w+)\((?P<args>.+?)\)")
-            filter_match = re.match(filter_regex, match)
-
-            column = filter_match.group('column')
-            command = filter_match.group('command')
-            args = filter_match.group('args')
-
-            if command in [
-                    "equals"
-                    , 'not_equals'
-                    , 'starts_with'
-                    , 'ends_with'
-                    ,"contains"
-            ]:
-                # should be like equals(value)
-                # should be like not_equals(value)
-                result['column_filters'].append((column, command, args))
-            elif command in ["in", "not_in"]:
-                # should be like in(1,2,3)
-                # should be like not_in(1,2,3)
-                final_args = [x.strip() for x in args.split(',')]
-                result['column_filters'].append((column, command, final_args))
+        values.append(value)
+
+    return base64.urlsafe_b64encode(json.dumps(values))
+
+def decode_cursor(token, columns, cls):
+    """
+    Turns a cursor back into the values of the cursor columns, converted
+    to the column types the same way filter values are, see coerce_args.
+    Raises HTTPBadRequest for anything that isn't a cursor we gave out for
+    these columns
+    """
+    try:
+        values = json.loads(base64.urlsafe_b64decode(str(token)))
+    except (TypeError, ValueError):
+        raise HTTPBadRequest("Invalid cursor")
+
+    if not isinstance(values, list) or len(values) != len(columns):
+        raise HTTPBadRequest("Invalid cursor")
+
+    result = []
+
+    for (order, method), value in zip(columns, values):
+        try:
+            value = coerce_args(getattr(cls, order).property, 'equals', value)
+        except HTTPBadRequest:
+            raise HTTPBadRequest("Invalid cursor")
+
+        result.append(value)
 
     return result
 
-def filter_query(filters, query, cls):
+def cursor_predicate(columns, values, cls):
+    """
+    The WHERE clause for every row after the cursor values:
+
+        (a, b) > (1, 2)
+
+    or when the directions are mixed:
+
+        a > 1 OR (a = 1 AND b < 2)
+    """
+    props = [getattr(cls, order) for order, method in columns]
+    methods = set(method for order, method in columns)
+
+    if len(methods) == 1:
+        if methods.pop() == 'desc':
+            return tuple_(*props) < tuple_(*values)
+
+        return tuple_(*props) > tuple_(*values)
+
+    clauses = []
+
+    for i, (prop, (order, method)) in enumerate(zip(props, columns)):
+        equals = [props[j] == values[j] for j in range(i)]
+
+        if method == 'desc':
+            clauses.append(and_(*(equals + [prop < values[i]])))
+        else:
+            clauses.append(and_(*(equals + [prop > values[i]])))
+
+    return or_(*clauses)
+
+def is_after_cursor(obj, columns, values):
+    """
+    The in memory version of cursor_predicate
+    """
+    for (order, method), value in zip(columns, values):
+        attr = getattr(obj, order)
+
+        if attr == value:
+            continue
+
+        if method == 'desc':
+            return attr < value
+
+        return attr > value
+
+    return False
+
+def get_next_cursor(filters, cls, rows):
+    """
+    Returns the cursor for the page after rows, or None if the key wasn't
+    paging by cursor or this was the last page
+    """
+    if not 'cursor' in filters:
+        return None
+
+    count = filters['cursor'][0]
+
+    if not rows or len(rows) < count:
+        return None
+
+    return encode_cursor(rows[-1], get_cursor_columns(filters, cls))
+
+def get_page_limits(cls, request=None):
+    """
+    Returns the default and maximum number of rows a collection of cls may
+    return, from _traversal_default_page/_traversal_max_page on the model
+    or the sqlalchemy_traversal.default_page_size/max_page_size settings.
+    None means unlimited.
+    """
+    settings = {}
+    if request is not None:
+        settings = request.registry.settings or {}
+
+    maximum = getattr(cls, '_traversal_max_page', None)
+    if maximum is None:
+        maximum = settings.get('sqlalchemy_traversal.max_page_size')
+
+    default = getattr(cls, '_traversal_default_page', None)
+    if default is None:
+        default = settings.get('sqlalchemy_traversal.default_page_size')
+
+    if maximum is not None:
+        maximum = int(maximum)
+
+    if default is not None:
+        default = int(default)
+
+        if maximum is not None:
+            default = min(default, maximum)
+    else:
+        default = maximum
+
+    return default, maximum
+
+def guard_page_size(filters, cls, request=None):
+    """
+    Applies the default and maximum page sizes to a parsed key.  Returns
+    the new filters and the page size the results have to be cut down to,
+    see page_collection, or None if the key was within the limits.
+
+    The limit is set one higher than the page size so that we can tell if
+    there were more rows.
+    """
+    default, maximum = get_page_limits(cls, request)
+
+    if default is None and maximum is None:
+        return filters, None
+
+    filters = dict(filters)
+
+    if 'cursor' in filters:
+        count, token = filters['cursor']
+
+        # the next cursor already tells the client there is more
+        if maximum is not None and count > maximum:
+            filters['cursor'] = (maximum, token)
+
+        return filters, None
+
+    if 'limit' in filters:
+        start, count = filters['limit']
+
+        if maximum is None or count <= maximum:
+            return filters, None
+
+        page_size = maximum
+    else:
+        start = 0
+        page_size = default
+
+    filters['limit'] = (start, page_size + 1)
+
+    return filters, page_size
+
+def page_collection(rows, filters, cls, page_size, request=None):
+    """
+    Wraps rows loaded for a parsed key in a ModelCollection, cutting them
+    down to the page size from guard_page_size
+    """
+    truncated = page_size is not None and len(rows) > page_size
+
+    if truncated:
+        rows = rows[:page_size]
+
+    return ModelCollection(rows
+        , request=request
+        , cls=cls
+        , fields=filters.get('fields')
+        , next_cursor=get_next_cursor(filters, cls, rows)
+        , truncated=truncated
+    )
+
+def coerce_integer(value, column_type):
+    return int(value)
+
+def coerce_float(value, column_type):
+    return float(value)
+
+def coerce_decimal(value, column_type):
+    return Decimal(value)
+
+def coerce_boolean(value, column_type):
+    value = value.strip().lower()
+
+    if value in ('true', 't', 'yes', '1'):
+        return True
+    elif value in ('false', 'f', 'no', '0'):
+        return False
+
+    raise ValueError(value)
+
+def coerce_datetime(value, column_type):
+    # a date on its own is midnight
+    if not 'T' in value:
+        return datetime.strptime(value, '%Y-%m-%d')
+
+    if '.' in value:
+        return datetime.strptime(value, '%Y-%m-%dT%H:%M:%S.%f')
+
+    return datetime.strptime(value, '%Y-%m-%dT%H:%M:%S')
+
+def coerce_date(value, column_type):
+    return datetime.strptime(value, '%Y-%m-%d').date()
+
+def coerce_time(value, column_type):
+    if '.' in value:
+        return datetime.strptime(value, '%H:%M:%S.%f').time()
+
+    return datetime.strptime(value, '%H:%M:%S').time()
+
+def coerce_enum(value, column_type):
+    if not value in column_type.enums:
+        raise ValueError(value)
+
+    return value
+
+def coerce_uuid(value, column_type):
+    value = uuid.UUID(value)
+
+    if column_type.as_uuid:
+        return value
+
+    return str(value)
+
+def coerce_passthrough(value, column_type):
+    return value
+
+# like COLUMN_CONVERTERS the first type a column is an instance of picks
+# its coercer, so subclasses have to come before their bases
+COLUMN_COERCERS = [
+    (Boolean, coerce_boolean)
+    , (Integer, coerce_integer)
+    , (Float, coerce_float)
+    , (Numeric, coerce_decimal)
+    , (DateTime, coerce_datetime)
+    , (Date, coerce_date)
+    , (Time, coerce_time)
+    , (Enum, coerce_enum)
+    , (UUID, coerce_uuid)
+]
+
+_column_coercers = {}
+
+def add_column_coercer(column_type, coercer):
+    """
+    Converts the filter values of columns of column_type, a SQLAlchemy
+    type or a tuple of them, with coercer(value, column_type).  It takes
+    precedence over the built in ones.  Raise a ValueError for values
+    that aren't valid
+    """
+    COLUMN_COERCERS.insert(0, (column_type, coercer))
+
+    # the coercers chosen so far may not be the ones to use anymore
+    _column_coercers.clear()
+
+def get_column_coercer(prop):
+    """
+    Chooses the function that converts filter values for a property based
+    on the type of the column it maps to, see COLUMN_COERCERS.  Anything
+    else, including TypeDecorators, is left as a string
+    """
+    coercer = _column_coercers.get(prop)
+
+    if coercer is not None:
+        return coercer
+
+    coercer = coerce_passthrough
+    columns = getattr(prop, 'columns', None)
+
+    if columns:
+        for types, column_coercer in COLUMN_COERCERS:
+            if isinstance(columns[0].type, types):
+                coercer = column_coercer
+                break
+
+    _column_coercers[prop] = coercer
+
+    return coercer
+
+def coerce_args(prop, command, args):
+    """
+    Converts the args of a column filter to the type of the column, so
+    they are compared against the column as it is indexed.  Raises
+    HTTPBadRequest for values the column can't hold
+    """
+    if not command in COERCED_COMMANDS:
+        return args
+
+    coercer = get_column_coercer(prop)
+
+    if coercer is coerce_passthrough:
+        return args
+
+    column_type = prop.columns[0].type
+
+    def coerce(value):
+        if not isinstance(value, basestring):
+            return value
+
+        return coercer(value, column_type)
+
+    try:
+        if isinstance(args, tuple):
+            return tuple(coerce(x) for x in args)
+
+        return coerce(args)
+    except (TypeError, ValueError, InvalidOperation):
+        raise HTTPBadRequest("Invalid value for %s" % prop.key)
+
+def filter_value(command, args):
+    """
+    The value a column filter compares against, the LIKE pattern for the
+    string matching commands and the args themselves for the rest
+    """
+    if command == 'starts_with':
+        return args + "%"
+    elif command == 'ends_with':
+        return "%" + args
+    elif command == 'contains':
+        return "%" + args + "%"
+
+    return args
+
+def column_filter(prop, command, value):
+    """
+    The WHERE clause of a column filter, value is what filter_value
+    returned for it or a bind parameter that will hold it
+    """
+    if command == 'equals':
+        return prop == value
+    elif command == 'not_equals':
+        return prop != value
+    elif command in ('starts_with', 'ends_with', 'contains'):
+        return prop.like(value)
+    elif command == 'in':
+        return prop.in_(value)
+    elif command == 'not_in':
+        return not_(prop.in_(value))
+    elif command == 'gt':
+        return prop > value
+    elif command == 'gte':
+        return prop >= value
+    elif command == 'lt':
+        return prop < value
+    elif command == 'lte':
+        return prop <= value
+    elif command == 'between':
+        return prop.between(value[0], value[1])
+    elif command == 'is_null':
+        if value:
+            return prop == None
+
+        return prop != None
+
+def filter_columns(filters, query, cls):
+    """
+    Applies just the column filters of a parsed key to the query
+    """
     if filters['column_filters']:
         for column, command, args in filters['column_filters']:
             prop = getattr(cls, column)
+            args = coerce_args(prop.property, command, args)
+
+            query = query.filter(column_filter(prop, command,
+                filter_value(command, args)
+            ))
 
-            if command == 'equals':
-                query = query.filter(prop == args)
-            elif command == 'not_equals':
-                query = query.filter(prop != args)
-            elif command == 'starts_with':
-                query = query.filter(prop.like(args +"%"))
-            elif command == 'ends_with':
-                query = query.filter(prop.like("%" + args))
-            elif command == 'contains':
-                query = query.filter(prop.like("%" + args + "%"))
-            elif command == 'in':
-                query = query.filter(prop.in_(args))
-            elif command == 'not_in':
-                query = query.filter(not_(prop.in_(args)))
-
-    for key, value in filters.iteritems():
-        if key == 'limit':
-            query = query.limit(value[1])
-            query = query.offset(value[0])
-        elif key == 'order_by':
-            for order, method in value:
-                prop = getattr(cls, order)
-
-                if method == 'desc':
-                    query = query.order_by(prop.desc())
-                else:
-                    query = query.order_by(prop.asc())
     return query
 
+def wants_count(filters, request=None):
+    """
+    Whether the total number of rows should be counted, either the key
+    asked for .count(), the request has an X-Traversal-Count header or it
+    is a HEAD request
+    """
+    if filters.get('count'):
+        return True
 
-def filter_list(filters, list_, cls):
-    for column, command, args in filters['column_filters']:
-        properties = list(class_mapper(cls).iterate_properties)
-
-        type_cleaner = None
-        # figure out if we should cast the passed it variable
-        for prop in properties:
-            if prop.key == column:
-                if isinstance(prop.columns[0].type, Integer):
-                    type_cleaner = int
-
-        if type_cleaner:
-            args = type_cleaner(args)
-
-        if command == 'equals':
-            list_ = filter(lambda x: getattr(x, column) == args, list_)
-        elif command == 'not_equals':
-            list_ = filter(lambda x: getattr(x, column) != args, list_)
-        elif command == 'starts_with':
-            list_ = filter(lambda x: getattr(x, column).startswith(args), list_)
-        elif command == 'ends_with':
-            list_ = filter(lambda x: getattr(x, column).endswith(args), list_)
-        elif command == 'contains':
-            list_ = filter(lambda x: args in getattr(x, column), list_)
-        elif command == 'in':
-            list_ = filter(lambda x: getattr(x, column) in args, list_)
-        elif command == 'not_in':
-            list_ = filter(lambda x: getattr(x, column) not in args, list_)
-
-    for key, value in filters.iteritems():
-        if key == 'limit':
-            list_ = list_[value[0]:value[1]]
-        elif key == 'order_by':
-            for order, method in value:
-                if method == 'asc':
-                    list_.sort(key=lambda x: getattr(x, order))
-                else:
-                    list_.sort(key=lambda x: getattr(x, order), reverse=True)
+    if request is None:
+        return False
 
-    return list_
+    if request.method == 'HEAD':
+        return True
 
-def filter_list_by_qs(qs, collection):
-    """ This function takes a querystring and a list
+    header = request.headers.get('X-Traversal-Count', '')
 
-    Accepted QS arguments are: __order_by and property names, for example:
+    return header.lower() in ('1', 'true', 'yes')
 
-        /conference/1/fields?__order_by=sort_order&name=Foo Con
+def count_query(filters, query, cls):
+    """
+    Runs a SELECT count() with the column filters of the key, leaving out
+    the ordering, paging and eager loads
+    """
+    query = filter_columns(filters, query, cls)
+    column = getattr(cls, cls._traversal_lookup_key)
 
-    You can also do an in query:
+    query = query.with_entities(func.count(column))
+    query = query.order_by(None)
 
-        /conference?pk.in=1,2
+    return query.scalar()
 
-    You can also do a not query by using pk.not=
+def get_version_key(cls):
+    """
+    The attribute ETags are built from, _traversal_version_column or the
+    mapper's version_id_col.  None if the model has neither, in which case
+    the ETag is a hash of the response
+    """
+    if cls._traversal_version_column:
+        return cls._traversal_version_column
 
-        /conference?name.not=PyCon2012
+    mapper = class_mapper(cls)
 
-    You can also do a not in query by using pk.not=
+    if mapper.version_id_col is not None:
+        return mapper.get_property_by_column(mapper.version_id_col).key
 
-        /conference?name.notin=PyCon2012,PyCon2011
+    return None
+
+def make_etag(*parts):
+    return hashlib.sha1(repr(parts)).hexdigest()
+
+def etag_matches(request, etag):
+    """
+    Whether the request's If-None-Match header matches the ETag
     """
-    method = 'asc'
+    header = request.headers.get('If-None-Match', '').strip()
 
-    order_by = None
+    if not header:
+        return False
 
-    if '__order_by' in qs:
-        order_by = qs.pop('__order_by')
+    if header == '*':
+        return True
 
-    if order_by:
-        orders = [x.strip() for x in order_by.split(',')]
+    for tag in header.split(','):
+        tag = tag.strip()
 
-        for order in orders:
-            if ' ' in order:
-                order, method = order.split()
-                if method == 'asc':
-                    collection.sort(key=lambda x: getattr(x, order))
-                else:
-                    collection.sort(key=lambda x: getattr(x, order), reverse=True)
+        if tag.startswith('W/'):
+            tag = tag[2:]
+
+        if tag.strip('"') == etag:
+            return True
+
+    return False
 
+def collection_etag(filters, query, cls, request, entity=None):
+    """
+    Builds the ETag of a collection from a SELECT of the newest version
+    and the number of rows matching the key's filters, so the rows don't
+    have to be loaded to know they haven't changed.  Returns None if the
+    model has no version column.
+
+    A date or time column changes its max() whenever a row is updated,
+    a version counter only its sum().  Deleting a row and inserting
+    another one with the same version leaves both as they were, so the
+    sum() and max() of integer primary keys are part of the ETag too.  A
+    version counter without one falls back to the hash of the response
+
+    Relationships serialized through _json_eager_load change without
+    touching the version column, the hash of the response is used for
+    those too
+    """
+    key = get_version_key(cls)
 
-    for key, value in qs.iteritems():
-        if '.in' in key:
-            key = key[0:-3]
-            values = value.split(',')
+    if key is None:
+        return None
 
-            for obj in collection[:]:
-                if not getattr(obj, key) in values:
-                    collection.remove(obj)
+    if eager_loads(cls, filters.get('fields')):
+        return None
 
-        elif '.notin' in key:
-            key = key[0:-3]
-            values = value.split(',')
+    if entity is None:
+        entity = cls
 
-            for obj in collection[:]:
-                if getattr(obj, key) in values:
-                    collection.remove(obj)
+    mapper = class_mapper(cls)
+    column = mapper.get_property(key).columns[0]
+    counter = not isinstance(column.type, (DateTime, Date, Time))
 
-        elif '.not' in key:
-            key = key[0:-4]
+    if counter:
+        aggregate = func.sum
+    else:
+        aggregate = func.max
+
+    aggregates = [
+        aggregate(getattr(entity, key))
+        , func.count(getattr(entity, cls._traversal_lookup_key))
+    ]
+
+    for column in mapper.primary_key:
+        if not isinstance(column.type, Integer):
+            if counter:
+                return None
+
+            continue
+
+        prop = getattr(entity, mapper.get_property_by_column(column).key)
+        aggregates.extend([func.sum(prop), func.max(prop)])
+
+    query = filter_columns(filters, query, entity)
+    query = query.with_entities(*aggregates)
+
+    return make_etag(request.path, sorted(request.GET.items()),
+        query.order_by(None).one()
+    )
+
+def precheck_collection(filters, query, cls, request, entity=None):
+    """
+    Counts a collection and builds its ETag before any of its rows are
+    loaded.  Returns the total count, the ETag and, when the rows aren't
+    needed, the empty ModelCollection to respond with instead, otherwise
+    None
+    """
+    if entity is None:
+        entity = cls
+
+    total_count = None
+    etag = None
+
+    if wants_count(filters, request):
+        total_count = count_query(filters, query, entity)
+
+    if request is not None:
+        etag = collection_etag(filters, query, cls, request, entity=entity)
+
+        # HEAD only wants the headers and a matching ETag means the
+        # client already has the rows, so don't load any
+        if request.method == 'HEAD' or \
+                (etag is not None and etag_matches(request, etag)):
+            return total_count, etag, ModelCollection([], request=request,
+                total_count=total_count, etag=etag, cls=cls
+            )
+
+    return total_count, etag, None
+
+def instance_etag(obj, request):
+    """
+    Builds the ETag of a single instance from its version column, None if
+    it doesn't have one or serializes relationships through
+    _json_eager_load
+    """
+    key = get_version_key(type(obj))
 
-            for obj in collection[:]:
-                if getattr(obj, key) == value:
-                    collection.remove(obj)
+    if key is None or eager_loads(type(obj)):
+        return None
+
+    return make_etag(request.path, sorted(request.GET.items()),
+        getattr(obj, key)
+    )
+
+def filter_query(filters, query, cls):
+    query = filter_columns(filters, query, cls)
+
+    if 'cursor' in filters:
+        count, token = filters['cursor']
+        columns = get_cursor_columns(filters, cls)
+
+        if token is not None:
+            values = decode_cursor(token, columns, cls)
+            query = query.filter(cursor_predicate(columns, values, cls))
+
+        orders = columns
+    else:
+        orders = filters.get('order_by', ())
+
+    # the ordering has to be applied before the LIMIT
+    for order, method in orders:
+        prop = getattr(cls, order)
+
+        if method == 'desc':
+            query = query.order_by(prop.desc())
         else:
-            for obj in collection[:]:
-                if not getattr(obj, key) == value:
-                    collection.remove(obj)
+            query = query.order_by(prop.asc())
 
-    return collection
+    if 'limit' in filters:
+        start, count = filters['limit']
+        query = query.limit(count)
+        query = query.offset(start)
+    elif 'cursor' in filters:
+        query = query.limit(filters['cursor'][0])
 
-def filter_query_by_qs(session, cls, qs, existing_query=None):
-    """ This function takes a SA Session, a SA ORM class, and a 
-    query string that it can filter with.
+    return query
 
-    Accepted QS arguments are: __order_by and property names, for example:
+def relationship_order(prop, filters):
+    """
+    The ORDER BY of a relationship, for when its collection is loaded with
+    a query of our own.  The key's own ordering replaces it
+    """
+    if 'order_by' in filters or 'cursor' in filters or not prop.order_by:
+        return []
 
-        /conference?__order_by=sort_order&name=Foo Con
+    return list(prop.order_by)
 
-    You can also do an in query:
+def get_filter_shape(filters):
+    """
+    What the query of a parsed key looks like without its values: the
+    columns and commands it filters by, how many values the list commands
+    have, the ordering and which paging modifier it uses
+    """
+    columns = []
+
+    for column, command, args in filters['column_filters']:
+        if isinstance(args, tuple):
+            columns.append((column, command, len(args)))
+        elif command == 'is_null':
+            columns.append((column, command, args))
+        else:
+            columns.append((column, command, None))
+
+    cursor = None
+    if 'cursor' in filters:
+        cursor = filters['cursor'][1] is not None
+
+    return (tuple(columns), tuple(filters.get('order_by', ())), cursor,
+        'limit' in filters
+    )
+
+class QueryPlan(object):
+    """
+    filter_query for every key with the same shape.  The filters and the
+    ordering are applied once to a Query without a session whose values
+    are bind parameters, a request only binds its own values to it.
+
+    SQLAlchemy compiles a Query every time it runs, so instances and
+    execute run the statement they compiled the first time instead, and
+    instances reuses the QueryContext the ORM loads the rows with.
+    """
+    def __init__(self, cls, filters):
+        self.cls = cls
+        self.mapper = class_mapper(cls)
+        self.statements = LRUCache(QUERY_PLAN_STATEMENTS)
+        self.props = []
+
+        query = Query(cls)
+
+        for i, (column, command, args) in enumerate(filters['column_filters']):
+            prop = getattr(cls, column)
+            self.props.append(prop.property)
+
+            if isinstance(args, tuple):
+                value = [self._bind(prop, 'f%s_%s' % (i, j))
+                    for j in range(len(args))
+                ]
+            elif command == 'is_null':
+                # part of the shape rather than a value
+                value = args
+            else:
+                value = self._bind(prop, 'f%s' % i)
+
+            query = query.filter(column_filter(prop, command, value))
+
+        if 'cursor' in filters:
+            orders = get_cursor_columns(filters, cls)
+
+            if filters['cursor'][1] is not None:
+                values = [self._bind(getattr(cls, order), 'c%s' % i)
+                    for i, (order, method) in enumerate(orders)
+                ]
+                query = query.filter(cursor_predicate(orders, values, cls))
+        else:
+            orders = filters.get('order_by', ())
+
+        for order, method in orders:
+            prop = getattr(cls, order)
+
+            if method == 'desc':
+                query = query.order_by(prop.desc())
+            else:
+                query = query.order_by(prop.asc())
+
+        self.template = query
+
+    def _bind(self, prop, name):
+        return bindparam(name, type_=prop.property.columns[0].type)
+
+    def params(self, filters):
+        """
+        The values of a parsed key's filters and cursor by the names of
+        their bind parameters
+        """
+        params = {}
+
+        for i, (column, command, args) in enumerate(filters['column_filters']):
+            args = coerce_args(self.props[i], command, args)
+
+            if isinstance(args, tuple):
+                for j, arg in enumerate(args):
+                    params['f%s_%s' % (i, j)] = arg
+            elif command != 'is_null':
+                params['f%s' % i] = filter_value(command, args)
+
+        if 'cursor' in filters and filters['cursor'][1] is not None:
+            orders = get_cursor_columns(filters, self.cls)
+            values = decode_cursor(filters['cursor'][1], orders, self.cls)
+
+            for i, value in enumerate(values):
+                params['c%s' % i] = value
+
+        return params
+
+    def query(self, session, filters):
+        """
+        The same query filter_query would build for a key of this shape
+        """
+        if isinstance(session, ScopedSession):
+            session = session()
+
+        query = self.template.with_session(session)
+        query = query.params(**self.params(filters))
+
+        if 'limit' in filters:
+            start, count = filters['limit']
+            query = query.limit(count)
+            query = query.offset(start)
+        elif 'cursor' in filters:
+            query = query.limit(filters['cursor'][0])
+
+        return query
+
+    def _entry(self, query, key, build):
+        """
+        The statement kept under key, the dict it compiles to is kept in
+        and the QueryContext to copy for each query, build() returns them
+        the first time
+        """
+        key = key + (query._limit, query._offset)
+        entry = self.statements.get(key)
+
+        if entry is None:
+            entry = build()
+            self.statements.set(key, entry)
+
+        return entry
+
+    def _connection(self, query, statement, compiled):
+        """
+        The connection to run a statement of query on.  This mirrors what
+        Query.__iter__ does before running its own statement:
+
+        - the session is autoflushed unless populate_existing is set
+        - the connection comes from the session for the plan's mapper, so
+          the session's binds and the query's execution_options, like the
+          stream_results of yield_per, apply
+        - it is closed along with the result
+
+        The query's params are passed when the statement runs and its
+        LIMIT/OFFSET are part of the key the statement is kept under
+        """
+        if query._autoflush and not query._populate_existing:
+            query.session._autoflush()
+
+        conn = query._connection_from_session(mapper=self.mapper,
+            clause=statement, close_with_result=True
+        )
+
+        return conn.execution_options(compiled_cache=compiled)
+
+    def _compile(self, query):
+        context = query._compile_context()
+
+        # joined eager loads alias their tables again every time, the
+        # columns of another statement wouldn't line up with them
+        if context.eager_joins or context.create_eager_joins:
+            return None, None, None
+
+        # subquery eager loads keep the query that loads the related rows
+        # in the context, bound to the session and values of this one
+        for name in context.attributes:
+            if isinstance(name, tuple) and name[0] == 'subquery':
+                return context.statement, {}, None
+
+        return context.statement, {}, context
+
+    def instances(self, query, *key):
+        """
+        Runs a query from self.query and iterates over the instances, key
+        tells apart the options that were added to the query since
+        """
+        statement, compiled, template = self._entry(query, key,
+            lambda: self._compile(query)
+        )
+
+        if statement is None:
+            return iter(query)
+
+        if template is None:
+            context = query._compile_context()
+        else:
+            # instances() keeps the state of a single run in the context
+            context = copy.copy(template)
+            context.query = query
+            context.session = query.session
+            context.attributes = template.attributes.copy()
+
+        conn = self._connection(query, statement, compiled)
+
+        return query.instances(conn.execute(statement, query._params), context)
+
+    def execute(self, query, *key):
+        """
+        Runs the Core statement of a query from self.query, for when the
+        rows are wanted as they are
+        """
+        statement, compiled, template = self._entry(query, key,
+            lambda: (query.statement, {}, None)
+        )
+        conn = self._connection(query, statement, compiled)
+
+        return conn.execute(statement, query._params)
+
+def get_query_plan(cls, filters):
+    """
+    The cached QueryPlan for the shape of a parsed key
+    """
+    key = (cls, get_filter_shape(filters))
+    plan = _query_plans.get(key)
+
+    if plan is None:
+        plan = QueryPlan(cls, filters)
+        _query_plans.set(key, plan)
+
+    return plan
+
+def value_test(command, args):
+    """
+    The in memory version of column_filter, a function that tells whether
+    a column's value passes the filter.  Like in SQL a NULL only passes
+    is_null
+    """
+    if command == 'is_null':
+        return lambda value: (value is None) == args
+
+    if command == 'equals':
+        test = lambda value: value == args
+    elif command == 'not_equals':
+        test = lambda value: value != args
+    elif command == 'starts_with':
+        test = lambda value: value.startswith(args)
+    elif command == 'ends_with':
+        test = lambda value: value.endswith(args)
+    elif command == 'contains':
+        test = lambda value: args in value
+    elif command == 'in':
+        test = lambda value: value in args
+    elif command == 'not_in':
+        test = lambda value: value not in args
+    elif command == 'gt':
+        test = lambda value: value > args
+    elif command == 'gte':
+        test = lambda value: value >= args
+    elif command == 'lt':
+        test = lambda value: value < args
+    elif command == 'lte':
+        test = lambda value: value <= args
+    elif command == 'between':
+        test = lambda value: args[0] <= value <= args[1]
+
+    return lambda value: value is not None and test(value)
+
+def list_predicate(filters, cls):
+    """
+    One function that tells whether an instance passes every column filter
+    of a parsed key, so a list is only gone through once
+    """
+    tests = []
+
+    for column, command, args in filters['column_filters']:
+        args = coerce_args(getattr(cls, column).property, command, args)
+
+        if command in LIST_COMMANDS:
+            args = frozenset(args)
+
+        tests.append((column, value_test(command, args)))
+
+    def predicate(obj):
+        for column, test in tests:
+            if not test(getattr(obj, column)):
+                return False
+
+        return True
+
+    return predicate
+
+def sort_list(list_, orders):
+    """
+    Sorts list_ in place by (column, method) pairs the way ORDER BY would
+    """
+    if not orders:
+        return
+
+    methods = set(method for order, method in orders)
+
+    if len(methods) == 1:
+        list_.sort(
+            key=attrgetter(*[order for order, method in orders])
+            , reverse=(methods.pop() == 'desc')
+        )
+        return
+
+    # mixed directions sort by the last key first, the sorts are stable
+    # so the first key ends up being the primary one
+    for order, method in reversed(orders):
+        list_.sort(key=attrgetter(order), reverse=(method == 'desc'))
+
+def filter_list(filters, list_, cls):
+    if filters['column_filters']:
+        predicate = list_predicate(filters, cls)
+        list_ = [x for x in list_ if predicate(x)]
+
+    if 'cursor' in filters:
+        orders = get_cursor_columns(filters, cls)
+    else:
+        orders = filters.get('order_by', ())
+
+    sort_list(list_, orders)
+
+    if 'limit' in filters:
+        # same as OFFSET start LIMIT count in filter_query
+        start, count = filters['limit']
+        list_ = list_[start:start + count]
+    elif 'cursor' in filters:
+        count, token = filters['cursor']
+
+        if token is not None:
+            values = decode_cursor(token, orders, cls)
+            list_ = [x for x in list_ if is_after_cursor(x, orders, values)]
+
+        list_ = list_[:count]
+
+    return list_
+
+def filter_list_by_qs(qs, collection, cls=None):
+    """ This function takes a querystring and a list
+
+    Accepted QS arguments are: __order_by and property names, for example:
+
+        /conference/1/fields?__order_by=sort_order&name=Foo Con
+
+    You can also do an in query:
+
+        /conference?pk.in=1,2
+
+    You can also do a not query by using pk.not=
+
+        /conference?name.not=PyCon2012
+
+    You can also do a not in query by using pk.not=
+
+        /conference?name.notin=PyCon2012,PyCon2011
+
+    The list is filtered like filter_query_by_qs would filter the table,
+    cls defaults to the class of the first item.  Returns a new list
+    """
+    collection = list(collection)
+
+    if not collection:
+        return collection
+
+    if cls is None:
+        cls = type(collection[0])
+
+    return filter_list(get_qs_filters(qs), collection, cls)
+
+def get_qs_filters(qs):
+    """
+    Turns the query string filter_query_by_qs takes into the filters of a
+    parsed key, so the same query plans can be used for both
+    """
+    orders = []
+    order_by = qs.get('__order_by')
+
+    if order_by:
+        method = 'asc'
+
+        # an order without a direction goes the way the one before it did
+        for order in [x.strip() for x in order_by.split(',')]:
+            if ' ' in order:
+                order, method = order.split()
+
+            orders.append((order, method))
+
+    column_filters = []
+
+    for key, value in sorted(qs.items()):
+        if key == '__order_by':
+            continue
+        elif '.in' in key:
+            column_filters.append((key[0:-3], 'in', tuple(value.split(','))))
+        elif '.notin' in key:
+            column_filters.append(
+                (key[0:-6], 'not_in', tuple(value.split(',')))
+            )
+        elif '.not' in key:
+            column_filters.append((key[0:-4], 'not_equals', value))
+        else:
+            column_filters.append((key, 'equals', value))
+
+    return {
+        'column_filters': tuple(column_filters)
+        , 'order_by': tuple(orders)
+    }
+
+def filter_query_by_qs(session, cls, qs, existing_query=None):
+    """ This function takes a SA Session, a SA ORM class, and a 
+    query string that it can filter with.
+
+    Accepted QS arguments are: __order_by and property names, for example:
+
+        /conference?__order_by=sort_order&name=Foo Con
+
+    You can also do an in query:
+
+        /conference?pk.in=1,2
+
+    You can also do a not query by using pk.not=
+
+        /conference?name.not=PyCon2012
+
+    You can also do a not in query by using pk.not=
+
+        /conference?name.notin=PyCon2012,PyCon2011
+    """
+    if existing_query:
+        query = existing_query
+    else:
+        query = session.query(cls)
+
+    return filter_query(get_qs_filters(qs), query, cls)
+
+def should_stream(cls, request):
+    """
+    Whether a collection of cls should be streamed back to the client
+    rather than loaded into memory first
+    """
+    if getattr(cls, '_traversal_stream', False):
+        return True
+
+    header = request.headers.get('X-Traversal-Stream', '')
+
+    return header.lower() in ('1', 'true', 'yes')
+
+def lazy_traversal(request):
+    """
+    Whether GET traversal should build up a single query and only run it
+    for the final resource, turned on with the sqlalchemy_traversal.lazy
+    setting
+    """
+    if request.method not in ('GET', 'HEAD'):
+        return False
+
+    settings = request.registry.settings or {}
+
+    return asbool(settings.get('sqlalchemy_traversal.lazy', False))
+
+def format_colander_errors(e):
+    """
+    This formats our colander errors in a nice format
+    for rendering errors
+    """
+    values = []
+
+    for child in e.children:
+        msg = child.msg
+
+        if msg == None:
+            msg = e.asdict()
+
+        error = {
+            'name': child.node.title
+            , 'id': child.node.name
+            , 'error': msg
+        }
+
+        values.append(error)
+
+    return values
+
+def get_session(request):
+    """
+    This is a utility to allow you to extract the session from the pyramid
+    registry
+    """
+
+    if request.registry.queryUtility(ISASession):
+        session = request.registry.getUtility(ISASession)
+    else:
+        raise Exception(
+            "You must register ISASession with your SQLAlchemy "
+            + "session in the pyramid registry"
+        )
+
+    return session
+
+def get_base(request):
+    """
+    This is a utility to allow you to extract the SQLAlchemy base from the
+    pyramid registry
+    """
+
+    if request.registry.queryUtility(ISABase):
+        base = request.registry.getUtility(ISABase)
+    else:
+        raise Exception(
+            "You must register ISABase with your SQLAlchemy "
+            + "base in the pyramid registry"
+        )
+
+    return base
+
+class TraversalTables(Mapping):
+    """
+    An immutable tablename -> class mapping of every TraversalMixin class
+    on a declarative base.  This is built once and stored in the pyramid
+    registry so that the TraversalRoot doesn't have to walk the SQLAlchemy
+    class registry on every request.
+    """
+    __name__ = None
+    __parent__ = None
+
+    def __init__(self, base):
+        tables = {}
+
+        # Loop through all the tables in the SQLAlchemy registry
+        # and store them if they subclass the TraversalMixin
+        for key, table in base._decl_class_registry.iteritems():
+            if isinstance(table, type) and issubclass(table, TraversalMixin):
+                table.__parent__ = self
+                tables[table.__tablename__] = table
+
+        self._tables = tables
+
+    def get_class(self, key):
+        """
+        This function just returns the class directly without running any
+        logic
+        """
+        return self._tables[key]
+
+    def __getitem__(self, key):
+        return self._tables[key]
+
+    def __iter__(self):
+        return iter(self._tables)
+
+    def __len__(self):
+        return len(self._tables)
+
+def rebuild_traversal_tables(registry):
+    """
+    Builds the TraversalTables from the ISABase registered in the pyramid
+    registry and stores them as the ITraversalTables utility.
+
+    This is done for you when the configuration is committed, call it again
+    if your application maps TraversalMixin classes after that.
+    """
+    base = registry.queryUtility(ISABase)
+
+    if base is None:
+        raise Exception(
+            "You must register ISABase with your SQLAlchemy "
+            + "base in the pyramid registry"
+        )
+
+    tables = TraversalTables(base)
+    registry.registerUtility(tables, ITraversalTables)
+
+    return tables
+
+def get_tables(request):
+    """
+    This is a utility to allow you to extract the TraversalTables from the
+    pyramid registry, they will be built on first use if they haven't been
+    yet.
+    """
+    tables = request.registry.queryUtility(ITraversalTables)
+
+    if tables is None:
+        tables = rebuild_traversal_tables(request.registry)
+
+    return tables
+
+_primary_lookups = {}
+
+def get_primary_lookup(cls):
+    """
+    Returns the primary key column of cls if it is also the
+    _traversal_lookup_key, so instances can be looked up with query.get,
+    otherwise None
+    """
+    cache_key = (cls, cls._traversal_lookup_key)
+
+    try:
+        return _primary_lookups[cache_key]
+    except KeyError:
+        pass
+
+    mapper = class_mapper(cls)
+    column = None
+
+    if len(mapper.primary_key) == 1:
+        prop = mapper.get_property_by_column(mapper.primary_key[0])
+
+        if prop.key == cls._traversal_lookup_key:
+            column = mapper.primary_key[0]
+
+    _primary_lookups[cache_key] = column
+
+    return column
+
+def get_eager_load_tables(cls):
+    """
+    The tables of every class that cls serializes through _json_eager_load
+    """
+    tables = set()
+
+    for path in get_eager_load_paths(cls):
+        rel_cls = cls
+
+        for key in path.split('.'):
+            rel_cls = class_mapper(rel_cls).get_property(key).mapper.class_
+
+        tables.add(rel_cls.__tablename__)
+
+    return tables
+
+def get_row_tag(obj):
+    mapper = object_mapper(obj)
+
+    return (obj.__tablename__, tuple(mapper.primary_key_from_instance(obj)))
+
+def get_cache_tags(context):
+    """
+    The tags a cached response for context is stored with, the row of every
+    instance on the way to it, plus the table of a collection and the tables
+    it eager loads.  Returns None if the response shouldn't be cached
+    """
+    tags = set()
+
+    if isinstance(context, ModelCollection):
+        if context.cls is None:
+            return None
+
+        tags.add(context.cls.__tablename__)
+        tags.update(get_eager_load_tables(context.cls))
+    elif isinstance(context, TraversalMixin):
+        tags.update(get_eager_load_tables(type(context)))
+    else:
+        return None
+
+    node = context
+
+    while node is not None:
+        if isinstance(node, TraversalMixin):
+            tags.add(get_row_tag(node))
+
+        node = getattr(node, '__parent__', None)
+
+    return tags
+
+def get_write_tags(obj):
+    """
+    The tags a write to obj invalidates, its own row and every collection
+    of its table
+    """
+    return set([obj.__tablename__, get_row_tag(obj)])
+
+# the (cache, tags) to invalidate once a session's transaction commits
+_pending_invalidations = weakref.WeakKeyDictionary()
+
+def invalidate_cache(request, tags):
+    """
+    Drops the cached responses with any of the tags once the request's
+    session commits, if there is an IResponseCache.  Until then a GET could
+    still read the old rows and cache them again, if the session rolls back
+    nothing is dropped
+    """
+    cache = request.registry.queryUtility(IResponseCache)
+
+    if cache is None or not tags:
+        return
+
+    session = get_session(request)
+
+    if isinstance(session, ScopedSession):
+        session = session()
+
+    _pending_invalidations.setdefault(session, []).append((cache, set(tags)))
+
+def _invalidate_after_commit(session):
+    # a SAVEPOINT committing doesn't make the writes visible yet
+    if session.transaction is not None and session.transaction.nested:
+        return
+
+    for cache, tags in _pending_invalidations.pop(session, ()):
+        cache.invalidate(tags)
+
+def _discard_after_rollback(session):
+    if session.transaction is not None and session.transaction.nested:
+        return
+
+    _pending_invalidations.pop(session, None)
+
+event.listen(Session, 'after_commit', _invalidate_after_commit)
+event.listen(Session, 'after_rollback', _discard_after_rollback)
+
+def convert_value(value):
+    """
+    Converts a single value into something json can encode, this is used
+    for properties where we can't tell what we will get from the column type
+    """
+    # format and date/datetime/time properties to isoformat
+    if isinstance(value, (datetime, date, time)):
+        return value.isoformat()
+
+    # convert all non integer strings to unicode or if unicode conversion
+    # is not possible, convert it to a byte string.
+    if value and not isinstance(value, (int, float)):
+        try:
+            return unicode(value)
+        except UnicodeDecodeError:
+            return str(value)  # .encode('utf-8')
+
+    return value
+
+def convert_isoformat(value):
+    if value is None:
+        return None
+
+    return value.isoformat()
+
+def convert_passthrough(value):
+    return value
+
+def convert_float(value):
+    if value is None:
+        return None
+
+    return float(value)
+
+def convert_decimal(value):
+    # a float would lose digits the column keeps, Numeric(asdecimal=False)
+    # already gives us floats
+    if value is None or not isinstance(value, Decimal):
+        return value
+
+    return unicode(value)
+
+def convert_text(value):
+    # values loaded from unicode columns already are
+    if value is None or value.__class__ is unicode:
+        return value
+
+    try:
+        return unicode(value)
+    except UnicodeDecodeError:
+        return str(value)
+
+def convert_base64(value):
+    if value is None:
+        return None
+
+    return base64.b64encode(value)
+
+# the first type a column is an instance of picks its converter, so
+# subclasses have to come before their bases
+COLUMN_CONVERTERS = [
+    ((DateTime, Date, Time), convert_isoformat)
+    , (Boolean, convert_passthrough)
+    , ((Integer, Float), convert_passthrough)
+    , (Numeric, convert_decimal)
+    , (String, convert_text)
+    , (LargeBinary, convert_base64)
+]
+
+def add_column_converter(column_type, converter):
+    """
+    Serializes columns of column_type, a SQLAlchemy type or a tuple of
+    them, with converter.  It takes precedence over the built in ones
+    """
+    COLUMN_CONVERTERS.insert(0, (column_type, converter))
+
+    # the serialization plans built so far hold the converters they chose
+    _serialization_plans.clear()
+
+def get_column_converter(prop):
+    """
+    Chooses the function used to serialize a property based on the type of
+    the column it maps to, see COLUMN_CONVERTERS.  Anything else, including
+    TypeDecorators, goes through convert_value
+    """
+    columns = getattr(prop, 'columns', None)
+
+    if not columns:
+        return convert_value
+
+    column_type = columns[0].type
+
+    for types, converter in COLUMN_CONVERTERS:
+        if isinstance(column_type, types):
+            return converter
+
+    return convert_value
+
+class SerializationPlan(object):
+    """
+    Everything __json__ needs to know about a class that doesn't change
+    between instances: which columns to serialize and how, and which
+    relationships to include.  These are built once per class and set of
+    fields, see get_serialization_plan
+    """
+    def __init__(self, cls, fields=None):
+        # setup the blacklist
+        # use set for easy 'in' lookups
+        blacklist = set(getattr(cls, '_base_blacklist', []))
+
+        # extend the base blacklist with the json blacklist
+        blacklist.update(getattr(cls, '_json_blacklist', []))
+
+        json_eager_load = set(getattr(cls, '_json_eager_load', []))
+
+        # this is for SQLAlchemy foreign key fields that
+        # indicate with one-to-many relationships
+        many_directions = ["ONETOMANY", "MANYTOMANY"]
+
+        columns = []
+        relationships = []
+
+        for prop in class_mapper(cls).iterate_properties:
+            if fields is not None and not prop.key in fields:
+                continue
+
+            if isinstance(prop, RelationshipProperty):
+                # only relationships we were asked to eagerly load
+                # are serialized
+                if prop.key in json_eager_load:
+                    is_many = prop.direction.name in many_directions
+                    relationships.append((prop.key, is_many))
+            elif not prop.key in blacklist:
+                columns.append((prop.key, get_column_converter(prop)))
+
+        self.cls = cls
+        self.fields = fields
+        self.blacklist = frozenset(blacklist)
+        self.columns = tuple(columns)
+        self.relationships = tuple(relationships)
+
+    def serialize(self, obj, request):
+        props = {}
+
+        for key, converter in self.columns:
+            props[key] = converter(getattr(obj, key))
+
+        for key, is_many in self.relationships:
+            attr = getattr(obj, key)
+
+            if attr:
+                if is_many:
+                    # jsonify all child objects
+                    props[key] = [obj.try_to_json(request, x) for x in attr]
+                else:
+                    props[key] = obj.try_to_json(request, attr)
+
+        return props
+
+    def serialize_row(self, row):
+        """
+        Serializes a row from select_rows, whose first columns are the ones
+        in the plan.  Relationships aren't included
+        """
+        props = {}
+
+        for (key, converter), value in izip(self.columns, row):
+            props[key] = converter(value)
+
+        return props
+
+def get_serialization_plan(cls, fields=None):
+    """
+    Returns the cached SerializationPlan for a class, building it the first
+    time the class is serialized.  fields is a frozenset of property names
+    to limit the plan to, or None for all of them
+    """
+    key = (cls, fields)
+    plan = _serialization_plans.get(key)
+
+    if plan is None:
+        plan = SerializationPlan(cls, fields)
+        _serialization_plans.set(key, plan)
+
+    return plan
+
+def get_fields(filters, cls):
+    """
+    Returns the fields a parsed key asked for, raises KeyError if cls
+    doesn't have one of them
+    """
+    fields = filters.get('fields')
+
+    if fields is not None:
+        mapper = class_mapper(cls)
+
+        for field in fields:
+            if not mapper.has_property(field):
+                raise KeyError(field)
+
+    return fields
+
+def load_fields(query, cls, fields):
+    """
+    Defers every column that isn't in fields so that they aren't part of
+    the SELECT, primary keys and the lookup key are always loaded
+    """
+    if fields is None:
+        return query
 
-        /conference?pk.in=1,2
+    mapper = class_mapper(cls)
+    keep = set(fields)
+    keep.add(getattr(cls, '_traversal_lookup_key', None))
+    keep.update(mapper.get_property_by_column(c).key
+        for c in mapper.primary_key
+    )
 
-    You can also do a not query by using pk.not=
+    deferred = []
+    for prop in mapper.iterate_properties:
+        if isinstance(prop, ColumnProperty) and not prop.key in keep:
+            deferred.append(defer(prop.key))
 
-        /conference?name.not=PyCon2012
+    if not deferred:
+        return query
 
-    You can also do a not in query by using pk.not=
+    return query.options(*deferred)
 
-        /conference?name.notin=PyCon2012,PyCon2011
-    """
-    if existing_query:
-        query = existing_query
-    else:
-        query = session.query(cls)
+def _find_eager_load_paths(cls, seen):
+    paths = []
+    mapper = class_mapper(cls)
+    seen = seen + (cls,)
 
-    method = 'asc'
+    for key in getattr(cls, '_json_eager_load', []):
+        if not mapper.has_property(key):
+            continue
 
-    order_by = None
+        prop = mapper.get_property(key)
 
-    if '__order_by' in qs:
-        order_by = qs.pop('__order_by')
+        if not isinstance(prop, RelationshipProperty):
+            continue
 
-    if order_by:
-        orders = [x.strip() for x in order_by.split(',')]
+        paths.append(key)
 
-        for order in orders:
-            if ' ' in order:
-                order, method = order.split()
+        # stop at classes we have already been through, otherwise
+        # relationships that point at each other would never end
+        rel_cls = prop.mapper.class_
+        if rel_cls not in seen:
+            for path in _find_eager_load_paths(rel_cls, seen):
+                paths.append('%s.%s' % (key, path))
 
-            prop = getattr(cls, order)
+    return paths
 
-            if method == 'desc':
-                query = query.order_by(prop.desc())
-            else:
-                query = query.order_by(prop.asc())
+_eager_load_paths = {}
 
-    for key, value in qs.iteritems():
-        if '.in' in key:
-            key = key[0:-3]
-            prop = getattr(cls, key)
-            query = query.filter(prop.in_(value.split(',')))
-        elif '.notin' in key:
-            key = key[0:-6]
-            prop = getattr(cls, key)
-            query = query.filter(not_(prop.in_(value.split(','))))
-        elif '.not' in key:
-            key = key[0:-4]
-            prop = getattr(cls, key)
-            query = query.filter(prop != value)
-        else:
-            prop = getattr(cls, key)
-            query = query.filter(prop == value)
+def get_eager_load_paths(cls):
+    """
+    Returns the relationship paths in cls._json_eager_load, including the
+    ones the related classes eager load themselves, e.g.
 
-    return query
+        ('messages', 'messages.attachments')
+    """
+    paths = _eager_load_paths.get(cls)
 
+    if paths is None:
+        paths = tuple(_find_eager_load_paths(cls, ()))
+        _eager_load_paths[cls] = paths
 
+    return paths
 
-def format_colander_errors(e):
+def eager_loads(cls, fields=None):
     """
-    This formats our colander errors in a nice format
-    for rendering errors
+    Returns the paths of get_eager_load_paths that are serialized when
+    only fields are asked for
     """
-    values = []
+    paths = get_eager_load_paths(cls)
 
-    for child in e.children:
-        msg = child.msg
+    if fields is not None:
+        paths = [x for x in paths if x.split('.', 1)[0] in fields]
 
-        if msg == None:
-            msg = e.asdict()
+    return paths
 
-        error = {
-            'name': child.node.title
-            , 'id': child.node.name
-            , 'error': msg
-        }
+def eager_load(query, cls, fields=None):
+    """
+    Adds subqueryload options for everything cls serializes through
+    _json_eager_load, so serializing the whole result takes one query per
+    relationship instead of one per row
+    """
+    paths = eager_loads(cls, fields)
 
-        values.append(error)
+    if not paths:
+        return query
 
-    return values
+    return query.options(*[subqueryload(path) for path in paths])
 
-def get_session(request):
+def select_rows(query, filters, cls, fields=None, query_plan=None):
     """
-    This is a utility to allow you to extract the session from the pyramid
-    registry
+    Runs a query built by filter_query as a Core select of just the
+    columns cls serializes, the rows come back as they are without being
+    turned into instances.  Returns the unread result and the
+    SerializationPlan whose serialize_row turns them into dicts.
+
+    Pass the QueryPlan the query came from to reuse its statement
     """
+    plan = get_serialization_plan(cls, fields)
+    keys = [key for key, converter in plan.columns]
 
-    if request.registry.queryUtility(ISASession):
-        session = request.registry.getUtility(ISASession)
-    else:
-        raise Exception(
-            "You must register ISASession with your SQLAlchemy "
-            + "session in the pyramid registry"
-        )
+    # cursors are built from the ordering columns and the lookup key
+    for order, method in get_cursor_columns(filters, cls):
+        if not order in keys:
+            keys.append(order)
 
-    return session
+    query = query.with_entities(*[getattr(cls, key).label(key) for key in keys])
 
-def get_base(request):
+    if query_plan is not None:
+        return query_plan.execute(query, 'rows', fields), plan
+
+    return query.session.execute(query.statement), plan
+
+class StreamedRows(object):
     """
-    This is a utility to allow you to extract the SQLAlchemy base from the
-    pyramid registry
+    The rows of a streamed collection.  They are read while the response
+    is written, by then the view has returned and the request's session
+    may have been committed and closed, so they are fetched with a session
+    of their own that is closed once the rows have been written.
+
+    fetch is called with the query bound to that session and returns the
+    rows to iterate over
     """
+    def __init__(self, query, cls, fetch):
+        self.query = query
+        self.bind = query.session.get_bind(mapper=class_mapper(cls))
+        self.fetch = fetch
 
-    if request.registry.queryUtility(ISABase):
-        base = request.registry.getUtility(ISABase)
-    else:
-        raise Exception(
-            "You must register ISABase with your SQLAlchemy "
-            + "base in the pyramid registry"
-        )
+    def __iter__(self):
+        session = Session(bind=self.bind, autoflush=False)
 
-    return base
+        try:
+            for row in self.fetch(self.query.with_session(session)):
+                yield row
+        finally:
+            session.close()
 
 class TraversalBase(object):
     def try_to_json(self, request, attr):
@@ -407,13 +2009,14 @@ class JsonSerializableMixin(TraversalBase):
 
     _json_blacklist :
         blacklist list of which properties not to include in JSON
+
+    These are read once per class, the first time it is serialized.
     """
 
     _base_blacklist = ['password', '_json_eager_load', '_request',
         '_base_blacklist', '_json_blacklist'
     ]
 
-
     def __json__(self, request):
         """
         Main JSONify method
@@ -423,93 +2026,114 @@ class JsonSerializableMixin(TraversalBase):
         :return: dictionary ready to be jsonified
         :rtype: <dict>
         """
+        plan = get_serialization_plan(type(self))
 
-        props = {}
+        return plan.serialize(self, request)
 
-        # grab the json_eager_load set, if it exists
-        # use set for easy 'in' lookups
-        json_eager_load = set(getattr(self, '_json_eager_load', []))
+class ModelCollection(TraversalBase):
+    """
+    Wraps a list of models, or StreamedRows when stream is set so that
+    rows are only loaded as iter_json writes them out.
+
+    next_cursor is set when the collection is a page fetched with
+    .cursor(), it points at the page after this one.  truncated is set
+    when the page size guard cut the collection short.  total_count is
+    set when the count of every row matching the key was asked for.
+    etag is set when the model has a version column, see collection_etag.
+    cls is the model the collection holds.  plan is set when it holds raw
+    rows from select_rows instead of instances.
+    """
+    def __init__(self, collection, request=None, stream=False,
+            batch_size=100, fields=None, next_cursor=None, truncated=False,
+            total_count=None, etag=None, cls=None, plan=None):
+        self.collection = collection
+        self._request = request
+        self.cls = cls
+        self.plan = plan
+        self.stream = stream
+        self.batch_size = batch_size
+        self.fields = fields
+        self.next_cursor = next_cursor
+        self.truncated = truncated
+        self.total_count = total_count
+        self.etag = etag
 
-        # now load the property if it exists
-        # (does this issue too many SQL statements?)
-        for prop in json_eager_load:
-            getattr(self, prop, None)
+    def _get_collection(self):
+        return self._collection
 
-        # we make a copy because the dict will change if the database
-        # is updated / flushed
-    #    options = self.__dict__.copy()
-        properties = list(class_mapper(type(self)).iterate_properties)
+    def _set_collection(self, collection):
+        self._collection = collection
+        self.invalidate()
 
-        relationships = [
-            p.key for p in properties if type(p) is RelationshipProperty
-        ]
+    collection = property(_get_collection, _set_collection)
 
-        # attrs is the attributes that we serialize to json
-        # we store them separately since we have a blacklist
-        attrs = []
-        all_properties = {}
-        for p in properties:
-            all_properties[p.key] = p
+    def invalidate(self):
+        """
+        Drops the lookup index, call this if you change the wrapped
+        collection in place without changing its length
+        """
+        self._index = None
+        self._indexed_length = None
 
-            if not p.key in relationships:
-                attrs.append(p.key)
+    def _get_index(self):
+        """
+        Builds a lookup_key -> model index the first time it is needed,
+        it is rebuilt if the collection has changed size since
+        """
+        length = None
+        if hasattr(self._collection, '__len__'):
+            length = len(self._collection)
 
-        # setup the blacklist
-        # use set for easy 'in' lookups
-        blacklist = set(getattr(self, '_base_blacklist', []))
+        if self._index is None or self._indexed_length != length:
+            index = {}
 
-        # extend the base blacklist with the json blacklist
-        blacklist.update(getattr(self, '_json_blacklist', []))
+            for obj in self._collection:
+                data = getattr(obj, obj._traversal_lookup_key)
 
-        for key in attrs:
-            # skip blacklisted properties
-            if key in blacklist:
-                continue
+                # the first match wins, just like scanning the list did
+                index.setdefault(data, obj)
 
-            # format and date/datetime/time properties to isoformat
-            obj = getattr(self, key)
+            self._index = index
+            self._indexed_length = length
+            self._int_keys = any(
+                isinstance(x, (int, long)) for x in index
+            )
 
-            if isinstance(obj, (datetime, date, time)):
-                props[key] = obj.isoformat()
-                continue
+        return self._index
 
-            # get the class property value
-            attr = getattr(self, key)
+    def _lookup(self, key):
+        """
+        Returns the model with the lookup_key and the value it matched
+        """
+        index = self._get_index()
 
-            # convert all non integer strings to unicode or if unicode conversion
-            # is not possible, convert it to a byte string.
-            if attr and not isinstance(attr, (int, float)):
-                try:
-                    props[key] = unicode(attr)
-                except UnicodeDecodeError:
-                    props[key] = str(attr)  # .encode('utf-8')
-                continue
+        if key in index:
+            return index[key], key
 
-            props[key] = attr
+        # keys from the URL are strings, coerce them once if the
+        # lookup keys are integers
+        if self._int_keys:
+            try:
+                int_key = int(key)
+            except ValueError:
+                raise KeyError(key)
 
-        for key in relationships:
-            # let see if we need to eagerly load it
-            # this is for SQLAlchemy foreign key fields that
-            # indicate with one-to-many relationships
-            many_directions = ["ONETOMANY", "MANYTOMANY"]
+            if int_key in index:
+                return index[int_key], int_key
 
-            if key in json_eager_load:
-                # get the class property value
-                attr = getattr(self, key)
+        raise KeyError(key)
 
-                if attr:
-                    if all_properties[key].direction.name in many_directions:
-                        # jsonify all child objects
-                        props[key] = [self.try_to_json(request, x) for x in attr]
-                    else:
-                        props[key] = self.try_to_json(request, attr)
+    def append(self, obj):
+        self._collection.append(obj)
+        self.invalidate()
 
-        return props
+    def extend(self, objs):
+        self._collection.extend(objs)
+        self.invalidate()
 
-class ModelCollection(TraversalBase):
-    def __init__(self, collection, request=None):
-        self.collection = collection
-        self._request = request
+    def remove(self, obj):
+        self._collection.remove(obj)
+        self.invalidate()
 
     def __getitem__(self, key):
         """
@@ -519,32 +2143,96 @@ class ModelCollection(TraversalBase):
         will use standard indexing
         """
         if isinstance(key, (str, unicode)):
-            for obj in self.collection:
-                data = getattr(obj, obj._traversal_lookup_key)
-
-                if isinstance(data, int):
-                    compare_value = int(key)
-                else:
-                    compare_value = key
+            obj, value = self._lookup(key)
 
-                # Does the item in the collection have the lookup_key we
-                # are looking for?
-                if data == compare_value:
-                    obj.__parent__ = self
-                    if hasattr(self, '_request'):
-                        obj._request = self._request
+            # the model's lookup key changed since we indexed it
+            if getattr(obj, obj._traversal_lookup_key) != value:
+                self.invalidate()
+                obj, value = self._lookup(key)
 
-                    return obj
+            obj.__parent__ = self
+            if hasattr(self, '_request'):
+                obj._request = self._request
 
-            raise KeyError
+            return obj
         else:
             return self.collection[key]
 
     def __iter__(self):
         return (x for x in self.collection)
 
-    def __json__(self, request):
-        return [self.try_to_json(request, x) for x in self.collection]
+    def _serialize(self, request, obj):
+        if self.plan is not None:
+            return self.plan.serialize_row(obj)
+
+        # the instance is shared with the rest of the session, so the
+        # fields only go into the plan it is serialized with
+        if self.fields is not None and \
+                isinstance(obj, JsonSerializableMixin):
+            plan = get_serialization_plan(type(obj), self.fields)
+
+            return plan.serialize(obj, request)
+
+        return self.try_to_json(request, obj)
+
+    def __json__(self, request, extra=None):
+        """
+        JSONify every item in the collection
+
+        :param request: Pyramid Request object
+        :type request: <Request>
+        :param extra: items merged into every serialized row
+        :type extra: <dict>
+        :return: list of dictionaries ready to be jsonified
+        :rtype: <list>
+        """
+        results = []
+
+        for obj in self.collection:
+            json = self._serialize(request, obj)
+
+            if extra:
+                json.update(extra)
+
+            results.append(json)
+
+        return results
+
+    def iter_json(self, request, extra=None):
+        """
+        Generates the collection as a JSON array, encoding batch_size rows
+        per chunk so that the full result never has to be held in memory
+
+        :param request: Pyramid Request object
+        :type request: <Request>
+        :param extra: items merged into every serialized row
+        :type extra: <dict>
+        :return: iterator of encoded chunks
+        :rtype: <generator>
+        """
+        chunk = []
+        separator = '['
+
+        for obj in self.collection:
+            row = self._serialize(request, obj)
+
+            if extra:
+                row.update(extra)
+
+            chunk.append(separator)
+            chunk.append(json.dumps(row))
+            separator = ','
+
+            if len(chunk) >= self.batch_size * 2:
+                yield ''.join(chunk)
+                chunk = []
+
+        if separator == '[':
+            chunk.append(separator)
+
+        chunk.append(']')
+
+        yield ''.join(chunk)
 
 def recurse_get_traversal_root(obj):
     if hasattr(obj, 'get_class'):
@@ -572,8 +2260,51 @@ def get_prop_from_cls(cls, attr):
 class TraversalMixin(JsonSerializableMixin):
     """
     This mixin is used to enable traversal on a specific model.
+
+    _traversal_lookup_key :
+        the column used to look up a single instance from the URL
+
+    _traversal_stream :
+        always stream collections of this model instead of loading them
+        into memory, a request can also ask for it with the
+        X-Traversal-Stream header
+
+    _traversal_stream_batch :
+        how many rows are fetched and written at a time when streaming
+
+    _traversal_default_page :
+        how many rows a collection returns when the key has no limit,
+        defaults to the sqlalchemy_traversal.default_page_size setting
+
+    _traversal_max_page :
+        the most rows a collection will ever return, defaults to the
+        sqlalchemy_traversal.max_page_size setting
+
+    _traversal_bulk_batch :
+        how many objects of a bulk save are flushed at a time
+
+    _traversal_bulk_delete :
+        the columns a DELETE on a filtered collection may filter on, bulk
+        deletes are turned off when it is empty
+
+    _traversal_version_column :
+        the column ETags are built from, such as an updated_at, defaults
+        to the mapper's version_id_col
+
+    _traversal_raw :
+        serialize collections straight from the selected rows instead of
+        loading instances, relationships and __json__ overrides are left
+        out
     """
     _traversal_lookup_key = 'id'
+    _traversal_stream = False
+    _traversal_stream_batch = 100
+    _traversal_default_page = None
+    _traversal_max_page = None
+    _traversal_bulk_batch = 500
+    _traversal_bulk_delete = ()
+    _traversal_version_column = None
+    _traversal_raw = False
 
     def _get_class(self, name):
         """
@@ -585,6 +2316,68 @@ class TraversalMixin(JsonSerializableMixin):
 
         return root.get_class(name)
 
+    def _query_relationship(self, name, filters, terminal=True):
+        """
+        Loads a relationship collection with the filters from the traversal
+        key applied in SQL and returns it as a ModelCollection.  Returns
+        None if name isn't a collection or it has already been loaded, in
+        which case it is filtered in memory.  terminal is False when the
+        path goes on to one of its members
+        """
+        mapper = class_mapper(type(self))
+
+        if not mapper.has_property(name):
+            return None
+
+        prop = mapper.get_property(name)
+
+        if not isinstance(prop, RelationshipProperty) or not prop.uselist:
+            return None
+
+        session = object_session(self)
+
+        if session is None or name in instance_state(self).dict:
+            return None
+
+        rel_cls = prop.mapper.class_
+        fields = get_fields(filters, rel_cls)
+        request = getattr(self, '_request', None)
+        page_size = None
+
+        # the page size guard is for the collection that is sent back, a
+        # member after it doesn't have to be on its first page
+        if terminal:
+            filters, page_size = guard_page_size(filters, rel_cls, request)
+
+        query = session.query(rel_cls).with_parent(self, name)
+        order_by = relationship_order(prop, filters)
+
+        if order_by:
+            query = query.order_by(*order_by)
+
+        total_count = None
+        etag = None
+
+        # counts, ETags and HEAD are about the response, not a collection
+        # the path only passes through
+        if terminal:
+            total_count, etag, empty = precheck_collection(filters, query,
+                rel_cls, request
+            )
+
+            if empty is not None:
+                return empty
+
+        query = filter_query(filters, query, rel_cls)
+        query = load_fields(query, rel_cls, fields)
+        query = eager_load(query, rel_cls, fields)
+
+        col = page_collection(query.all(), filters, rel_cls, page_size)
+        col.total_count = total_count
+        col.etag = etag
+
+        return col
+
     def __getitem__(self, attribute):
         """
         This is where the traversal magic happens for a specific model,
@@ -614,19 +2407,27 @@ class TraversalMixin(JsonSerializableMixin):
 
                 return cls()
 
+        request = getattr(self, '_request', None)
+        terminal = request is None or \
+            urllib.unquote(request.path).endswith(attribute)
+
+        # relationship collections that haven't been loaded yet are
+        # filtered in SQL rather than loading every row first
+        col = self._query_relationship(table_name, filters, terminal)
+
+        if col is not None:
+            col.__parent__ = self
+
+            if request:
+                col._request = request
+
+            return col
+
         obj = getattr(self, table_name)
 
         # The model had the specific attribute, so we just need to figure out
         # if we are returning a collection or a single instance
         if obj != None:
-            request = None
-            if hasattr(self, '_request'):
-                request = self._request
-
-#            if request:
-                #session = get_session(request)
-                #filter_query_by_qs(session, obj, self._request.GET)
-
             try:
                 ignore_types = (str, unicode, int, float, TraversalMixin)
                 if not isinstance(obj, ignore_types):
@@ -641,7 +2442,29 @@ class TraversalMixin(JsonSerializableMixin):
                         if prop.key == table_name:
                             rel_cls = prop.mapper.class_
 
-                    col = ModelCollection(filter_list(filters, obj, rel_cls))
+                    get_fields(filters, rel_cls)
+                    page_size = None
+
+                    if terminal:
+                        filters, page_size = guard_page_size(filters,
+                            rel_cls, request
+                        )
+
+                    col = page_collection(
+                        filter_list(filters, list(obj), rel_cls)
+                        , filters
+                        , rel_cls
+                        , page_size
+                    )
+
+                    # the rows are already loaded, so count them in memory
+                    if terminal and wants_count(filters, request):
+                        unpaged = {
+                            'column_filters': filters['column_filters']
+                        }
+                        col.total_count = len(
+                            filter_list(unpaged, list(obj), rel_cls)
+                        )
                     col.__parent__ = self
 
                     if request:
@@ -656,26 +2479,197 @@ class TraversalMixin(JsonSerializableMixin):
         # throws a 404
         raise KeyError
 
+def get_bulk_items(request):
+    """
+    Returns the items of a bulk save if the request body is a JSON array,
+    otherwise None
+    """
+    if not request.is_xhr and request.content_type != 'application/json':
+        return None
+
+    try:
+        body = request.json_body
+    except ValueError:
+        return None
+
+    if isinstance(body, list):
+        return body
+
+    return None
+
 class register_save(object):
     """
     This is a decorator that matches a Model class with a colander Schema
 
     If an API is called with a POST or PUT it will first try to run validation
     against the schema before doing anything
+
+    POSTing or PUTing a JSON array to the collection saves every item in it,
+    see bulk_save
     """
     def __init__(self, cls, schema, exception_handlers=None):
         self.cls = cls
         self.schema = schema
         self.exception_handlers = exception_handlers
 
+    def handle_exception(self, model, e):
+        error_dict = {'has_errors': True}
+
+        if self.exception_handlers:
+            if e.__class__ in self.exception_handlers:
+                new_errors = self.exception_handlers[e.__class__](model, e)
+
+                return dict(error_dict.items() + new_errors.items())
+
+        error_dict['message']  = e.message
+        return error_dict
+
+    def bulk_save(self, request, items, wrapped):
+        """
+        Validates every item against the schema and runs the save function
+        on it, nothing is saved unless all of them are valid.  A POST
+        creates new objects and a PUT updates the ones the items' lookup
+        keys point at.
+
+        The objects are flushed _traversal_bulk_batch at a time, if a flush
+        fails the exception handlers are given the list of objects in that
+        batch.  Once everything is flushed the IAfterBulkSaver is called
+        with the list of objects, or the IAfterSaver for each of them if
+        there isn't one.
+        """
+        session = get_session(request)
+        cls = self.cls
+
+        schema = self.schema()
+        schema = schema.bind(request=request)
+
+        existing = {}
+
+        if request.method == 'PUT':
+            lookup_key = cls._traversal_lookup_key
+            keys = [item.get(lookup_key) for item in items
+                if isinstance(item, dict)
+            ]
+            keys = [key for key in keys if key is not None]
+
+            if keys:
+                column = getattr(cls, lookup_key)
+                query = session.query(cls).filter(column.in_(keys))
+
+                for obj in query:
+                    existing[unicode(getattr(obj, lookup_key))] = obj
+
+        pending = []
+        results = []
+        has_errors = False
+
+        for item in items:
+            if not isinstance(item, dict):
+                has_errors = True
+                results.append({'message': 'Expected an object'})
+                continue
+
+            if request.method == 'PUT':
+                key = item.get(lookup_key)
+                obj = existing.get(unicode(key)) if key is not None else None
+
+                if obj is None:
+                    has_errors = True
+                    results.append({'message': 'Not found', lookup_key: key})
+                    continue
+            else:
+                obj = cls()
+
+            try:
+                data = schema.deserialize(item)
+            except colander.Invalid as e:
+                has_errors = True
+                results.append(dict(item.items()
+                    + [('errors', format_colander_errors(e))]
+                ))
+                continue
+
+            # cleaned dictionary data from the save function
+            pending.append((obj, wrapped(request, data)))
+            results.append({})
+
+        # the objects being updated are already in the session, so nothing
+        # is set on them until every item has passed
+        if has_errors:
+            return {'has_errors': True, 'items': results}
+
+        objects = []
+
+        for obj, result in pending:
+            for key, value in result.iteritems():
+                setattr(obj, key, value)
+
+            objects.append(obj)
+
+        batch_size = cls._traversal_bulk_batch
+
+        for start in range(0, len(objects), batch_size):
+            batch = objects[start:start + batch_size]
+
+            try:
+                session.add_all(batch)
+                session.flush()
+            except Exception as e:
+                error_dict = self.handle_exception(batch, e)
+                error_dict['batch'] = [start, start + len(batch)]
+
+                return error_dict
+
+        tags = set()
+
+        for obj in objects:
+            tags.update(get_write_tags(obj))
+
+        invalidate_cache(request, tags)
+
+        after_save = request.registry.adapters.lookup(
+            [implementedBy(cls)], IAfterBulkSaver
+        )
+
+        if after_save:
+            after_save(request, objects)
+        else:
+            context = request.context
+
+            for obj in objects:
+                after_save = request.registry.adapters.lookup(
+                    [providedBy(obj)], IAfterSaver
+                )
+
+                if after_save:
+                    request.context = obj
+                    after_save(request)
+
+            request.context = context
+
+        return objects
+
     def register(self, scanner, name, wrapped):
         def save(request):
             session = get_session(request)
 
+            # a JSON array sent to the collection
+            items = get_bulk_items(request)
+
+            if items is not None:
+                if instance_state(request.context).key is not None:
+                    return {
+                        'has_errors': True,
+                        'message': 'Bulk saves are sent to the collection'
+                    }
+
+                return self.bulk_save(request, items, wrapped)
+
+            # colander wants a mapping, not a list of pairs
             if request.is_xhr:
-                post_items = request.json.items()
+                post_items = dict(request.json)
             else:
-                post_items = request.POST.items()
+                post_items = dict(request.POST)
 
             schema = self.schema()
             schema = schema.bind(request=request)
@@ -688,7 +2682,7 @@ class register_save(object):
                     'errors': format_colander_errors(e)
                 }
 
-                return dict(error_dict.items() + post_items)
+                return dict(error_dict.items() + post_items.items())
 
             # cleaned dictionary data from the save function
             result = wrapped(request, data)
@@ -700,15 +2694,9 @@ class register_save(object):
                 session.add(request.context)
                 session.flush()
             except Exception as e:
-                error_dict = {'has_errors': True}
-                if self.exception_handlers:
-                    if e.__class__ in self.exception_handlers:
-                        new_errors = self.exception_handlers[e.__class__](request.context, e)
-
-                        return dict(error_dict.items() + new_errors.items())
+                return self.handle_exception(request.context, e)
 
-                error_dict['message']  = e.message
-                return error_dict
+            invalidate_cache(request, get_write_tags(request.context))
 
             after_save = request.registry.adapters.lookup(
                 [providedBy(request.context)], IAfterSaver
@@ -747,6 +2735,69 @@ class register_after_save(object):
 
         return wrapped
 
+class register_after_bulk_save(object):
+    """
+    This is a decorator that matches a Model class and will execute once
+    all the objects of a bulk save have been flushed, it is called with the
+    request and the list of saved objects
+    """
+    def __init__(self, cls):
+        self.cls = cls
+
+    def register(self, scanner, name, wrapped):
+        def after_save(request, objects):
+            wrapped(request, objects)
+
+        registry = scanner.config.registry
+        registry.registerAdapter(after_save, (self.cls, ), IAfterBulkSaver)
+
+    def __call__(self, wrapped):
+        venusian.attach(wrapped, self.register)
+
+        return wrapped
+
+def add_traversal_tables(config):
+    """
+    Config directive that builds the TraversalTables once the configuration
+    is committed, after ISABase has been registered:
+
+        config.add_traversal_tables()
+    """
+    def register():
+        if config.registry.queryUtility(ISABase) is not None:
+            rebuild_traversal_tables(config.registry)
+
+    config.action(ITraversalTables, register)
+
+def add_traversal_cache(config, cache=None):
+    """
+    Config directive that caches GET responses in cache, an IResponseCache.
+    By default it is a ResponseCache sized by the
+    sqlalchemy_traversal.cache_size and sqlalchemy_traversal.cache_ttl
+    settings:
+
+        config.add_traversal_cache()
+        config.add_traversal_cache(MyMemcachedCache())
+    """
+    if cache is None:
+        settings = config.registry.settings or {}
+
+        cache = ResponseCache(
+            maxsize=int(settings.get('sqlalchemy_traversal.cache_size', 1024))
+            , ttl=int(settings.get('sqlalchemy_traversal.cache_ttl', 60))
+        )
+
+    config.registry.registerUtility(cache, IResponseCache)
+
 def includeme(config):
+    settings = config.registry.settings or {}
+
+    config.add_directive('add_traversal_tables', add_traversal_tables)
+    config.add_directive('add_traversal_cache', add_traversal_cache)
+    config.add_traversal_tables()
+
+    if asbool(settings.get('sqlalchemy_traversal.cache', False)):
+        config.add_traversal_cache()
+
     config.scan('sqlalchemy_traversal')
     config.include('sqlalchemy_traversal.routes')
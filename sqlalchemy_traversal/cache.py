@@ -0,0 +1,103 @@
+from collections import OrderedDict
+
+import threading
+import time
+
+class LRUCache(object):
+    """
+    A small thread safe least recently used cache, once it holds maxsize
+    items adding another one drops whichever was used the longest ago
+    """
+    def __init__(self, maxsize=1024):
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value = self._data.pop(key)
+            except KeyError:
+                return default
+
+            # move it back to the most recently used end
+            self._data[key] = value
+
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = value
+
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def keys(self):
+        with self._lock:
+            return list(self._data)
+
+    def items(self):
+        """
+        A snapshot of the cached items, reading them this way doesn't
+        count as a use
+        """
+        with self._lock:
+            return list(self._data.items())
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._data
+
+    def __len__(self):
+        return len(self._data)
+
+
+class ResponseCache(object):
+    """
+    The in process IResponseCache, rendered GET responses are kept in an
+    LRUCache for ttl seconds.
+
+    Every entry is tagged with the tables and rows it was built from, a
+    table name or a (table name, primary key) tuple, and invalidate drops
+    the entries with any of the given tags.  Other stores only need the
+    same get, set and invalidate methods.
+    """
+    def __init__(self, maxsize=1024, ttl=60):
+        self.ttl = ttl
+        self._entries = LRUCache(maxsize)
+
+    def get(self, key):
+        entry = self._entries.get(key)
+
+        if entry is None:
+            return None
+
+        expires, tags, value = entry
+
+        if expires < time.time():
+            self._entries.delete(key)
+            return None
+
+        return value
+
+    def set(self, key, value, tags):
+        self._entries.set(key, (time.time() + self.ttl, frozenset(tags), value))
+
+    def invalidate(self, tags):
+        tags = set(tags)
+
+        for key, (expires, entry_tags, value) in self._entries.items():
+            if not tags.isdisjoint(entry_tags):
+                self._entries.delete(key)
+
+    def clear(self):
+        self._entries.clear()
@@ -6,8 +6,17 @@ class ISaver(Interface):
 class IAfterSaver(Interface):
     pass
 
+class IAfterBulkSaver(Interface):
+    pass
+
 class ISASession(Interface):
     pass
 
 class ISABase(Interface):
     pass
+
+class ITraversalTables(Interface):
+    pass
+
+class IResponseCache(Interface):
+    pass
@@ -1,15 +1,39 @@
 from sqlalchemy_traversal import get_session
 from sqlalchemy_traversal import get_base
-from sqlalchemy_traversal import TraversalMixin
+from sqlalchemy_traversal import get_tables
 from sqlalchemy_traversal import ModelCollection
 from sqlalchemy_traversal import filter_query_by_qs
-from sqlalchemy_traversal import get_prop_from_cls
 from sqlalchemy_traversal import parse_key
 from sqlalchemy_traversal import filter_query
-from sqlalchemy.orm       import contains_eager
+from sqlalchemy_traversal import filter_columns
+from sqlalchemy_traversal import should_stream
+from sqlalchemy_traversal import eager_load
+from sqlalchemy_traversal import get_fields
+from sqlalchemy_traversal import load_fields
+from sqlalchemy_traversal import guard_page_size
+from sqlalchemy_traversal import page_collection
+from sqlalchemy_traversal import lazy_traversal
+from sqlalchemy_traversal import precheck_collection
+from sqlalchemy_traversal import invalidate_cache
+from sqlalchemy_traversal import get_primary_lookup
+from sqlalchemy_traversal import select_rows
+from sqlalchemy_traversal import StreamedRows
+from sqlalchemy_traversal import get_serialization_plan
+from sqlalchemy_traversal import get_qs_filters
+from sqlalchemy_traversal import get_query_plan
+from sqlalchemy_traversal import coerce_args
+from sqlalchemy_traversal import relationship_order
+from sqlalchemy_traversal.interfaces import IResponseCache
+from sqlalchemy.orm       import aliased
+from sqlalchemy.orm       import class_mapper
+from sqlalchemy.orm.properties import RelationshipProperty
 from sqlalchemy.orm.exc   import NoResultFound
+from sqlalchemy.orm.exc   import MultipleResultsFound
 from sqlalchemy.exc       import ProgrammingError
 from sqlalchemy.exc       import DataError
+from sqlalchemy.sql.util  import ClauseAdapter
+from pyramid.httpexceptions import HTTPBadRequest
+from pyramid.httpexceptions import HTTPForbidden
 
 import urllib
 
@@ -17,46 +41,373 @@ class QueryGetItem(object):
     """
     This is used so that if we haven't ended our traversal we can pass
     unexecuted queries around to limit the amount of queries we actually
-    run during traversal
+    run during traversal.
+
+    Every segment adds a join or a filter to the query, nothing is executed
+    until resolve() is called on the last one, which loads the final
+    resource and the instances of all the segments above it in a single
+    round trip.
     """
-    def __init__(self, cls, query, request, old_gi):
+    def __init__(self, request, cls, entity, query, single, filters=None):
+        self.request = request
+        self.session = get_session(self.request)
         self.cls = cls
+        self.entity = entity
         self.query = query
+        self.single = single
+        self.filters = filters or {}
+        self.page_size = None
+
+    def _child(self, name, cls, entity, query, single, filters=None):
+        child = QueryGetItem(self.request, cls, entity, query, single,
+            filters=filters
+        )
+        child.__name__ = name
+        child.__parent__ = self
+
+        return child
+
+    def __getitem__(self, item):
+        if not self.single:
+            # we are pointing at a collection, so look up one of its
+            # members, paging only applies to the collection itself
+            name = self.cls._traversal_lookup_key
+            key = getattr(self.entity, name)
+            query = filter_columns(self.filters, self.query, self.entity)
+
+            # a key the lookup column can't hold isn't there
+            try:
+                value = coerce_args(getattr(self.cls, name).property,
+                    'equals', item
+                )
+            except HTTPBadRequest:
+                raise KeyError(item)
+
+            return self._child(item, self.cls, self.entity,
+                query.filter(key == value), True
+            )
+
+        filters = parse_key(item)
+        name = filters['table']
+        mapper = class_mapper(self.cls)
+
+        prop = None
+        if mapper.has_property(name):
+            prop = mapper.get_property(name)
+
+        # plain attributes have to come off of the instance itself
+        if not isinstance(prop, RelationshipProperty):
+            return self.resolve()[item]
+
+        rel_cls = prop.mapper.class_
+        selectable = prop.mapper.mapped_table.alias()
+        entity = aliased(rel_cls, alias=selectable)
+
+        query = self.query.join(entity, getattr(self.entity, name))
+        query = query.with_entities(entity)
+
+        page_size = None
+
+        # the filters and paging of a collection are applied once we know
+        # it is the one being resolved
+        if prop.uselist:
+            get_fields(filters, rel_cls)
+            filters, page_size = guard_page_size(filters, rel_cls,
+                self.request
+            )
+
+            order_by = relationship_order(prop, filters)
+
+            # the relationship's ordering is written against its table
+            if order_by:
+                adapter = ClauseAdapter(selectable)
+                query = query.order_by(
+                    *[adapter.traverse(x) for x in order_by]
+                )
+        else:
+            filters = None
+
+        child = self._child(item, rel_cls, entity, query, not prop.uselist,
+            filters=filters
+        )
+        child.page_size = page_size
+
+        return child
+
+    def _load_parents(self, parents):
+        """
+        Loads the instances of the segments above an empty collection,
+        raises KeyError if the one it belongs to isn't there
+        """
+        query = parents[0].query
+
+        for parent in parents[1:]:
+            query = query.add_entity(parent.entity)
+
+        try:
+            row = query.first()
+        except (ProgrammingError, DataError):
+            raise KeyError
+
+        if row is None:
+            raise KeyError
+
+        if len(parents) == 1:
+            return [row]
+
+        return list(row)
+
+    def resolve(self):
+        """
+        Runs the query and returns the instance or ModelCollection we
+        traversed to, raises KeyError if there isn't one
+        """
+        parents = []
+        node = self.__parent__
+
+        while isinstance(node, QueryGetItem):
+            if node.single:
+                parents.append(node)
+
+            node = node.__parent__
+
+        total_count = None
+        etag = None
+
+        if not self.single:
+            total_count, etag, result = precheck_collection(self.filters,
+                self.query, self.cls, self.request, entity=self.entity
+            )
+
+            if result is not None:
+                # an empty answer still needs the collection to be there
+                if parents:
+                    self._load_parents(parents)
+
+                result.__parent__ = node
+
+                return result
+
+        query = self.query
+
+        if not self.single:
+            query = filter_query(self.filters, query, self.entity)
+            query = eager_load(query, self.cls,
+                get_fields(self.filters, self.cls)
+            )
+
+        for parent in parents:
+            query = query.add_entity(parent.entity)
+
+        try:
+            if self.single:
+                rows = [query.one()]
+            else:
+                rows = query.all()
+        except (NoResultFound, ProgrammingError, DataError):
+            raise KeyError
+
+        if not parents:
+            rows = [(row,) for row in rows]
+
+        # the collection's rows come with its parents, without any they
+        # are loaded on their own to tell whether they exist
+        if rows:
+            instances = list(rows[0][1:])
+        elif parents:
+            instances = self._load_parents(parents)
+        else:
+            instances = []
+
+        # hook up the parent instances the same way eager traversal would
+        parent = node
+
+        for instance in reversed(instances):
+            instance._request = self.request
+            instance.__parent__ = parent
+            parent = instance
+
+        if self.single:
+            result = rows[0][0]
+            result._request = self.request
+        else:
+            result = page_collection([row[0] for row in rows]
+                , self.filters
+                , self.cls
+                , self.page_size
+                , request=self.request
+            )
+            result.total_count = total_count
+            result.etag = etag
+
+        result.__parent__ = parent
+
+        return result
+
+class CollectionDelete(object):
+    """
+    This is the context of a DELETE on a filtered collection key such as
+    /traverse/session{user_id.equals(2)}, every matching row is deleted
+    with a single DELETE statement instead of being loaded first.
+
+    Models opt in by listing the columns that may be filtered on in
+    _traversal_bulk_delete
+    """
+    def __init__(self, request, cls, filters):
         self.request = request
         self.session = get_session(self.request)
-        self.old_gi = old_gi
-
-    def __call__(self, item):
-        cls = get_prop_from_cls(self.cls, item)
-        if self.request.path.endswith(item):
-            self.query = self.query.outerjoin(item)
-            self.query = self.query.options(contains_eager(item))
-
-            self.query = filter_query_by_qs(
-                self.session,
-                cls,
-                self.request.GET,
-                existing_query = self.query
+        self.cls = cls
+        self.filters = filters
+
+    def delete(self):
+        """
+        Runs the DELETE and returns how many rows it removed
+        """
+        allowed = self.cls._traversal_bulk_delete or ()
+        column_filters = self.filters['column_filters']
+
+        if not allowed:
+            raise HTTPForbidden('%s does not allow bulk deletes' %
+                self.cls.__name__
             )
 
-            try:
-                if self.request.method == 'POST':
-                    return cls()
+        if not column_filters:
+            raise HTTPBadRequest('A bulk delete needs at least one filter')
 
-                parent = self.query.one()
+        for column, command, args in column_filters:
+            if column not in allowed:
+                raise HTTPForbidden('Bulk deletes can not filter on %s' %
+                    column
+                )
 
-                to_return = ModelCollection(
-                    [x for x in getattr(parent, item)]
+        for modifier in ('limit', 'order_by', 'cursor', 'fields', 'count'):
+            if modifier in self.filters:
+                raise HTTPBadRequest('A bulk delete can not use %s()' %
+                    modifier
                 )
+
+        query = self.session.query(self.cls)
+        query = filter_columns(self.filters, query, self.cls)
+
+        tags = set([self.cls.__tablename__])
+
+        # cached responses of the deleted rows have to go too, so just
+        # their primary keys are selected first
+        if self.request.registry.queryUtility(IResponseCache) is not None:
+            columns = class_mapper(self.cls).primary_key
+            table = self.cls.__tablename__
+
+            for row in query.with_entities(*columns):
+                tags.add((table, tuple(row)))
+
+        # the session isn't updated, rows it already loaded may be stale
+        count = query.delete(synchronize_session=False)
+
+        invalidate_cache(self.request, tags)
+
+        return count
+
+class CollectionQuery(object):
+    """
+    A collection at the root of the traversal that hasn't been loaded yet,
+    the key is parsed and checked when it is built and resolve() runs its
+    queries.  Like QueryGetItem, lazy traversal hands this to the view
+    """
+    def __init__(self, request, cls, filters):
+        self.request = request
+        self.session = get_session(self.request)
+        self.cls = cls
+        self.fields = get_fields(filters, cls)
+        self.filters, self.page_size = guard_page_size(filters, cls,
+            request
+        )
+
+    def resolve(self):
+        """
+        Loads the collection and returns it as a ModelCollection, or
+        raises KeyError if its query can't be run
+        """
+        cls = self.cls
+        fields = self.fields
+        filters = self.filters
+        page_size = self.page_size
+
+        total_count, etag, empty = precheck_collection(filters,
+            self.session.query(cls), cls, self.request
+        )
+
+        query_plan = get_query_plan(cls, filters)
+        query = query_plan.query(self.session, filters)
+        query = load_fields(query, cls, fields)
+
+        if empty is not None:
+            result = empty
+        # a cursor page is already bounded, so it isn't streamed
+        elif should_stream(cls, self.request) and not 'cursor' in filters:
+            # rows will be fetched as the response is written
+            batch_size = cls._traversal_stream_batch
+
+            # we can't tell the client it was truncated once the response
+            # has started, so drop the extra row
+            if page_size is not None:
+                query = query.limit(page_size)
+
+            plan = None
+
+            if cls._traversal_raw:
+                plan = get_serialization_plan(cls, fields)
+
+                # like yield_per, so that the driver doesn't buffer
+                # every row before the first is read
+                def fetch(query):
+                    query = query.execution_options(stream_results=True)
+
+                    return select_rows(query, filters, cls, fields
+                        , query_plan=query_plan
+                    )[0]
+            else:
+                def fetch(query):
+                    return query_plan.instances(
+                        query.yield_per(batch_size), 'stream', fields
+                    )
+
+            rows = StreamedRows(query, cls, fetch)
+
+            result = ModelCollection(rows
+                , request=self.request
+                , cls=cls
+                , stream=True
+                , batch_size=batch_size
+                , fields=fields
+                , total_count=total_count
+                , etag=etag
+                , plan=plan
+            )
+        else:
+            plan = None
+
+            try:
+                if cls._traversal_raw:
+                    rows, plan = select_rows(query, filters, cls, fields
+                        , query_plan=query_plan
+                    )
+                    rows = rows.fetchall()
+                else:
+                    query = eager_load(query, cls, fields)
+                    rows = list(query_plan.instances(query, 'all', fields))
             except ProgrammingError:
                 raise KeyError
 
-            return to_return
+            result = page_collection(rows, filters, cls, page_size
+                , request=self.request
+            )
+            result.total_count = total_count
+            result.etag = etag
+            result.plan = plan
 
-        new_sa_root = SQLAlchemyRoot(self.request, cls, table_lookup=item)
-        new_sa_root.__parent__ = self.__parent__
+        result.__parent__ = self.__parent__
 
-        return new_sa_root
+        return result
 
 class SQLAlchemyRoot(object):
     """
@@ -75,31 +426,50 @@ class SQLAlchemyRoot(object):
             self.table_lookup = table_lookup
 
     def __getitem__(self, k):
+        if lazy_traversal(self.request):
+            return self._lazy_getitem(k)
+
         try:
-            key = getattr(self.cls, self.cls._traversal_lookup_key)
+            column = get_primary_lookup(self.cls)
+            prop = getattr(self.cls, self.cls._traversal_lookup_key)
 
-            result =  self.session.query(self.cls).filter(key == k)
+            # a key the lookup column can't hold isn't there, converting it
+            # also lets query.get find it in the identity map
+            try:
+                k = coerce_args(prop.property, 'equals', k)
+            except HTTPBadRequest:
+                raise KeyError(k)
 
-            # This is the final object we want, so lets return the result
-            # if its not, lets return the query itself
-#            if self.request.path.split('/')[-2] == self.table_lookup:
+            # query.get doesn't run any SQL if the instance is already in
+            # the session's identity map
+            if column is not None and not self.request.GET:
+                try:
+                    result = self.session.query(self.cls).get(k)
+                except (ProgrammingError, DataError):
+                    raise KeyError
 
-            try:
-                result = filter_query_by_qs(self.session, self.cls,
-                        self.request.GET
-                        , existing_query = result
-                )
+                if result is None:
+                    raise NoResultFound()
+            else:
+                filters = get_qs_filters(self.request.GET)
+                filters['column_filters'] = (
+                    (self.cls._traversal_lookup_key, 'equals', k),
+                ) + filters['column_filters']
 
-                result = result.one()
-            except (ProgrammingError, DataError):
-                raise KeyError
-#                getitem = QueryGetItem(self.cls, result,
-#                    self.request, result.__getitem__
-#                )
-#
-#                getitem.__parent__ = self
+                query_plan = get_query_plan(self.cls, filters)
+                query = query_plan.query(self.session, filters)
+
+                try:
+                    rows = list(query_plan.instances(query))
+                except (ProgrammingError, DataError):
+                    raise KeyError
+
+                if not rows:
+                    raise NoResultFound()
+                elif len(rows) > 1:
+                    raise MultipleResultsFound()
 
-#                result.__getitem__ =  getitem
+                result = rows[0]
 
             # we need give the SQLAlchemy model an instance of the request
             # so that it can check if we are in a PUT or POST
@@ -116,6 +486,30 @@ class SQLAlchemyRoot(object):
 
             raise KeyError
 
+    def _lazy_getitem(self, k):
+        """
+        Starts a QueryGetItem chain instead of loading the instance
+        """
+        name = self.cls._traversal_lookup_key
+        entity = aliased(self.cls)
+        key = getattr(entity, name)
+
+        try:
+            value = coerce_args(getattr(self.cls, name).property, 'equals', k)
+        except HTTPBadRequest:
+            raise KeyError(k)
+
+        query = self.session.query(entity).filter(key == value)
+        query = filter_query_by_qs(self.session, entity, self.request.GET
+            , existing_query = query
+        )
+
+        result = QueryGetItem(self.request, self.cls, entity, query, True)
+        result.__name__ = k
+        result.__parent__ = self
+
+        return result
+
 class TraversalRoot(object):
     """
     This is the root factory to use on a traversal route:
@@ -135,23 +529,24 @@ class TraversalRoot(object):
 
     def __init__(self, request):
         self.request = request
-        self.base = get_base(request)
         self.session = get_session(request)
-        self.tables = {}
+        self.tables = get_tables(request)
 
-        # Loop through all the tables in the SQLAlchemy registry
-        # and store them if they subclass the TraversalMixin
-        for key, table in self.base._decl_class_registry.iteritems():
-            if isinstance(table, type) and issubclass(table, TraversalMixin):
-                table.__parent__ = self
-                self.tables[table.__tablename__] = table
+    @property
+    def base(self):
+        """
+        The declarative base registered with ISABase.  Traversal itself
+        only needs the tables it maps, see get_tables, so it is looked up
+        when something asks for it
+        """
+        return get_base(self.request)
 
     def get_class(self, key):
         """
         This function just returns the class directly without running any
         logic
         """
-        return self.tables[key]
+        return self.tables.get_class(key)
 
     def __getitem__(self, key):
         """
@@ -168,42 +563,35 @@ class TraversalRoot(object):
         """
         filters = parse_key(key)
 
+        # Do we have the table registered as a traversal object?
         cls = self.tables[filters['table']]
 
         to_return = None
 
-        # Do we have the table registered as a traversal object?
-        if cls == None:
-            raise KeyError
-
         # This is used to shortcircuit the traversal, if we are ending
         # on a model, for instance /api/user then we should either be creating
         # a new instance or querying the table
         path = urllib.unquote(self.request.path)
 
         if path.endswith(key):
-            if self.request.method == 'GET':
-                #query = filter_query_by_qs(self.session, cls,
-                #        self.request.GET
-                #)
-                query = self.session.query(cls)
-                query = filter_query(filters, query, cls)
+            if self.request.method in ('GET', 'HEAD'):
+                to_return = CollectionQuery(self.request, cls, filters)
+                to_return.__parent__ = self
 
-                try:
-                    to_return = ModelCollection(
-                        [x for x in query.all()]
-                        , request=self.request
-                    )
-                except ProgrammingError:
-                    raise KeyError
+                # lazy traversal leaves the query to the view, so that a
+                # cached response doesn't run it
+                if not lazy_traversal(self.request):
+                    to_return = to_return.resolve()
 
             elif self.request.method == 'POST' or self.request.method == 'PUT':
                 to_return = cls()
+            elif self.request.method == 'DELETE':
+                to_return = CollectionDelete(self.request, cls, filters)
 
         # If we haven't found something to return in the traversal tree yet,
         # it means we want to continue traversing the SQLAlchemy objects,
         # so lets return an SQLAlchemyRoot
-        if not to_return:
+        if to_return is None:
             to_return = SQLAlchemyRoot(self.request, cls)
 
         to_return.__parent__ = self
@@ -0,0 +1,229 @@
+from sqlalchemy_traversal.tests.test_views import StatementsTestCase
+from sqlalchemy_traversal.tests.test_resources import Message
+from sqlalchemy_traversal.tests.test_resources import session
+
+import unittest
+import mock
+
+
+class TestResponseCache(unittest.TestCase):
+    def _make_one(self, **kw):
+        from sqlalchemy_traversal.cache import ResponseCache
+
+        return ResponseCache(**kw)
+
+    def test_get_set(self):
+        cache = self._make_one()
+        cache.set('key', 'value', ['user'])
+
+        assert cache.get('key') == 'value'
+        assert cache.get('other') is None
+
+    def test_expires(self):
+        cache = self._make_one(ttl=10)
+
+        with mock.patch('time.time', return_value=100):
+            cache.set('key', 'value', ['user'])
+
+        with mock.patch('time.time', return_value=109):
+            assert cache.get('key') == 'value'
+
+        with mock.patch('time.time', return_value=111):
+            assert cache.get('key') is None
+
+    def test_least_recently_used_dropped(self):
+        cache = self._make_one(maxsize=2)
+        cache.set('first', 1, [])
+        cache.set('second', 2, [])
+        cache.get('first')
+        cache.set('third', 3, [])
+
+        assert cache.get('first') == 1
+        assert cache.get('second') is None
+
+    def test_invalidate(self):
+        cache = self._make_one()
+        cache.set('users', 1, ['user'])
+        cache.set('user 1', 2, [('user', (1,)), 'message'])
+        cache.set('user 2', 3, [('user', (2,))])
+
+        cache.invalidate([('user', (1,))])
+
+        assert cache.get('users') == 1
+        assert cache.get('user 1') is None
+        assert cache.get('user 2') == 3
+
+        cache.invalidate(['user'])
+
+        assert cache.get('users') is None
+        assert cache.get('user 2') == 3
+
+
+class TestCachedView(StatementsTestCase):
+    def setUp(self):
+        super(TestCachedView, self).setUp()
+
+        # hits still traverse, lazily that doesn't run any SQL
+        self.config.registry.settings['sqlalchemy_traversal.lazy'] = 'true'
+        self.config.add_traversal_cache()
+        self.app = self._make_app()
+
+    def _make_app(self):
+        from webtest import TestApp
+
+        return TestApp(self.config.make_wsgi_app())
+
+    def _cached(self, path):
+        """ whether a GET of path was answered without any SQL """
+        del self.statements[:]
+        self.app.get(path)
+
+        return not self.statements
+
+    def test_no_cache(self):
+        from sqlalchemy_traversal.interfaces import IResponseCache
+
+        self.config.registry.unregisterUtility(provided=IResponseCache)
+        self.app.get('/traverse/user/1')
+
+        assert not self._cached('/traverse/user/1')
+
+    def test_permission_checked_on_hit(self):
+        from pyramid import testing
+        from pyramid.authentication import RemoteUserAuthenticationPolicy
+        from pyramid.authorization import ACLAuthorizationPolicy
+        from pyramid.httpexceptions import HTTPForbidden
+        from pyramid.security import Allow
+        from sqlalchemy_traversal.interfaces import ISABase
+        from sqlalchemy_traversal.interfaces import ISASession
+        from sqlalchemy_traversal.resources import TraversalRoot
+        from sqlalchemy_traversal.tests.test_resources import Base
+        from sqlalchemy_traversal.tests.test_resources import session
+
+        testing.tearDown()
+
+        # the views pick up the default permission when they are scanned
+        self.config = testing.setUp(autocommit=False,
+            settings={'sqlalchemy_traversal.lazy': 'true'}
+        )
+        self.config.registry.registerUtility(Base, ISABase)
+        self.config.registry.registerUtility(session, ISASession)
+        self.config.set_authentication_policy(
+            RemoteUserAuthenticationPolicy()
+        )
+        self.config.set_authorization_policy(ACLAuthorizationPolicy())
+        self.config.set_default_permission('view')
+        self.config.include('sqlalchemy_traversal')
+        self.config.add_traversal_cache()
+        self.app = self._make_app()
+
+        with mock.patch.object(TraversalRoot, '__acl__',
+                [(Allow, 'alice', 'view')], create=True):
+            self.app.get('/traverse/user/1',
+                extra_environ={'REMOTE_USER': 'alice'}
+            )
+
+            del self.statements[:]
+            self.app.get('/traverse/user/1',
+                extra_environ={'REMOTE_USER': 'alice'}
+            )
+
+            assert not self.statements
+
+            self.assertRaises(HTTPForbidden, self.app.get, '/traverse/user/1',
+                extra_environ={'REMOTE_USER': 'mallory'}
+            )
+            self.assertRaises(HTTPForbidden, self.app.get, '/traverse/user/1')
+
+    def test_cached_response(self):
+        first = self.app.get('/traverse/user/1')
+
+        assert self._cached('/traverse/user/1')
+
+        second = self.app.get('/traverse/user/1')
+
+        assert second.json == first.json
+        assert second.headers['ETag'] == first.headers['ETag']
+
+        self.app.get('/traverse/user/1',
+            headers={'If-None-Match': first.headers['ETag']}, status=304
+        )
+
+    def test_root_collection_cached(self):
+        paths = ['/traverse/user', '/traverse/message{topic.equals(other)}']
+
+        for path in paths:
+            first = self.app.get(path)
+
+            assert self._cached(path)
+            assert self.app.get(path).json == first.json
+
+    def test_normalized_key(self):
+        self.app.get('/traverse/user/1/messages?name=user1&id=1')
+
+        assert self._cached('/traverse/user/1/messages?id=1&name=user1')
+        assert not self._cached('/traverse/user/1/messages?id=1')
+
+    def test_delete_invalidates(self):
+        self.app.get('/traverse/user/1')
+        self.app.get('/traverse/user/2')
+        self.app.get('/traverse/user/2/messages')
+        self.app.delete('/traverse/message/2')
+
+        # nothing is dropped until the delete is committed
+        assert self._cached('/traverse/user/2/messages')
+
+        session.commit()
+
+        # user 1 eager loads its messages
+        assert not self._cached('/traverse/user/1')
+        assert not self._cached('/traverse/user/2/messages')
+
+    def test_bulk_delete_invalidates_rows(self):
+        from pyramid.httpexceptions import HTTPNotFound
+
+        self.app.get('/traverse/message/6')
+        self.app.get('/traverse/message/1')
+
+        with mock.patch.object(Message, '_traversal_bulk_delete', ['user_id']):
+            result = self.app.delete('/traverse/message{user_id.equals(2)}')
+
+        session.commit()
+
+        assert result.json['count'] == 3
+        self.assertRaises(HTTPNotFound, self.app.get, '/traverse/message/6')
+        assert self._cached('/traverse/message/1')
+
+    def test_save_invalidates(self):
+        from sqlalchemy_traversal import register_save
+        from sqlalchemy_traversal.tests.test_save import UserSchema
+        from sqlalchemy_traversal.tests.test_resources import User
+
+        def save_user(request, data):
+            return data
+
+        scanner = mock.Mock(config=self.config)
+        register_save(User, UserSchema).register(scanner, 'save', save_user)
+
+        self.app.get('/traverse/message/1/user')
+        self.app.get('/traverse/user/2')
+
+        self.app.put_json('/traverse/user/1', {'name': u'first'},
+            headers={'X-Requested-With': 'XMLHttpRequest'}
+        )
+        session.commit()
+
+        assert not self._cached('/traverse/message/1/user')
+        assert self._cached('/traverse/user/2')
+        assert self.app.get('/traverse/user/1').json['name'] == u'first'
+
+    def test_rollback_keeps_entries(self):
+        self.app.get('/traverse/user/2/messages')
+        self.app.delete('/traverse/message/6')
+        session.rollback()
+
+        assert self._cached('/traverse/user/2/messages')
+
+        session.commit()
+
+        assert self._cached('/traverse/user/2/messages')
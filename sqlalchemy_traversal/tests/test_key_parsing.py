@@ -6,9 +6,112 @@ class TestKeyParsing(unittest.TestCase):
 
         keys = [
             "/messages.limit(0,20)"
-            , "/messages.order_by.limit(2,20)"
+            , "/messages.limit(0, 20)"
+            , "messages.limit(0,20)"
         ]
 
         for key in keys:
             result = parse_key(key)
-            import pdb; pdb.set_trace()
+            assert result['table'] == 'messages'
+            assert result['limit'] == (0, 20)
+            assert not result['column_filters']
+            assert 'order_by' not in result
+
+    def test_order_by_key_parsing(self):
+        from sqlalchemy_traversal import parse_key
+
+        result = parse_key("/messages.order_by(name, created desc)")
+
+        assert result['order_by'] == (('name', 'asc'), ('created', 'desc'))
+
+    def test_modifiers_in_any_order(self):
+        from sqlalchemy_traversal import parse_key
+
+        first = parse_key("/messages.order_by(name).limit(2,20)")
+        second = parse_key("/messages.limit(2,20).order_by(name)")
+
+        assert first == second
+        assert first['limit'] == (2, 20)
+        assert first['order_by'] == (('name', 'asc'),)
+
+    def test_column_filters(self):
+        from sqlalchemy_traversal import parse_key
+
+        result = parse_key(
+            "/messages{id.not_equals(2), topic.equals(bar),"
+            "id.in(1, 2,3)}.order_by(name).limit(0, 10)"
+        )
+
+        assert result['table'] == 'messages'
+        assert result['column_filters'] == (
+            ('id', 'not_equals', '2')
+            , ('topic', 'equals', 'bar')
+            , ('id', 'in', ('1', '2', '3'))
+        )
+        assert result['limit'] == (0, 10)
+
+    def test_invalid_keys(self):
+        from sqlalchemy_traversal import parse_key
+
+        keys = [
+            "/messages.order_by.limit(2,20)"
+            , "/messages.limit(a,b)"
+            , "/messages.order_by(name sideways)"
+            , "/messages{id.explode(1)}"
+            , "/messages{id.equals(1) topic}"
+            , "/messages.frobnicate(1)"
+            , "/mess-ages"
+        ]
+
+        for key in keys:
+            self.assertRaises(KeyError, parse_key, key)
+
+    def test_parsed_keys_are_cached(self):
+        from sqlalchemy_traversal import parse_key
+        from sqlalchemy_traversal import _parsed_keys
+
+        key = "/messages{topic.equals(cached)}"
+        first = parse_key(key)
+        first['limit'] = (0, 1)
+
+        assert key in _parsed_keys
+        assert 'limit' not in parse_key(key)
+
+    def test_fields_key_parsing(self):
+        from sqlalchemy_traversal import parse_key
+
+        result = parse_key("/event.fields(id, name).limit(0,10)")
+
+        assert result['fields'] == frozenset(['id', 'name'])
+        assert result['limit'] == (0, 10)
+
+        self.assertRaises(KeyError, parse_key, "/event.fields()")
+
+    def test_count_key_parsing(self):
+        from sqlalchemy_traversal import parse_key
+
+        result = parse_key("/event.limit(0,10).count()")
+
+        assert result['count']
+        assert 'count' not in parse_key("/event.limit(0,10)")
+
+        self.assertRaises(KeyError, parse_key, "/event.count(1)")
+
+    def test_comparison_key_parsing(self):
+        from sqlalchemy_traversal import parse_key
+
+        result = parse_key(
+            "/event{capacity.gte(10), starts.between(2012-05-01, 2012-06-01),"
+            "room.is_null(), name.is_null(false)}"
+        )
+
+        assert result['column_filters'] == (
+            ('capacity', 'gte', '10')
+            , ('starts', 'between', ('2012-05-01', '2012-06-01'))
+            , ('room', 'is_null', True)
+            , ('name', 'is_null', False)
+        )
+
+        self.assertRaises(KeyError, parse_key, "/event{id.between(1)}")
+        self.assertRaises(KeyError, parse_key, "/event{id.between(1,2,3)}")
+        self.assertRaises(KeyError, parse_key, "/event{id.is_null(maybe)}")
@@ -0,0 +1,612 @@
+from sqlalchemy.ext.declarative import declarative_base
+from sqlalchemy.types import Integer
+from sqlalchemy.types import Unicode
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.orm import scoped_session
+from sqlalchemy.orm import relationship
+from sqlalchemy import Column
+from sqlalchemy import ForeignKey
+from sqlalchemy import create_engine
+from pyramid import testing
+
+from sqlalchemy_traversal import TraversalMixin
+from sqlalchemy_traversal.interfaces import ISABase
+from sqlalchemy_traversal.interfaces import ISASession
+
+import unittest
+
+Base = declarative_base()
+maker = sessionmaker()
+session = scoped_session(maker)
+
+
+class User(TraversalMixin, Base):
+    __tablename__ = 'user'
+    id = Column(Integer, primary_key=True)
+    name = Column(Unicode(50), nullable=False)
+
+    messages = relationship('Message', backref='user')
+
+    _json_eager_load = ['messages']
+
+    @property
+    def pk(self):
+        return self.id
+
+
+class Message(TraversalMixin, Base):
+    __tablename__ = 'message'
+    id = Column(Integer, primary_key=True)
+    user_id = Column(Integer, ForeignKey('user.id'))
+    topic = Column(Unicode(50))
+
+
+class TraversalTestCase(unittest.TestCase):
+    def setUp(self):
+        self.engine = create_engine('sqlite://')
+        session.configure(bind=self.engine)
+        Base.metadata.create_all(self.engine)
+
+        self.config = testing.setUp(autocommit=False)
+        self.config.registry.registerUtility(Base, ISABase)
+        self.config.registry.registerUtility(session, ISASession)
+        self.config.include('sqlalchemy_traversal')
+        self.config.commit()
+
+        users = [User(id=i, name=u'user%s' % i) for i in range(1, 4)]
+        session.add_all(users)
+        session.add_all([
+            Message(id=i, user_id=1, topic=u'topic%s' % (i % 2))
+            for i in range(1, 6)
+        ])
+        session.commit()
+
+    def tearDown(self):
+        testing.tearDown()
+        session.remove()
+        self.engine.dispose()
+
+    def _make_request(self, path, method='GET', **kw):
+        request = testing.DummyRequest(path=path, **kw)
+        request.method = method
+        request.registry = self.config.registry
+
+        return request
+
+
+class TestTraversalTables(TraversalTestCase):
+    def test_tables_built_at_commit(self):
+        from sqlalchemy_traversal.interfaces import ITraversalTables
+
+        tables = self.config.registry.queryUtility(ITraversalTables)
+
+        assert tables['user'] is User
+        assert tables.get_class('message') is Message
+
+    def test_root_reuses_tables(self):
+        from sqlalchemy_traversal.resources import TraversalRoot
+
+        first = TraversalRoot(self._make_request('/traverse/user'))
+        second = TraversalRoot(self._make_request('/traverse/user'))
+
+        assert first.tables is second.tables
+        assert first.get_class('user') is User
+
+    def test_tables_are_immutable(self):
+        from sqlalchemy_traversal.resources import TraversalRoot
+
+        root = TraversalRoot(self._make_request('/traverse/user'))
+
+        def assign():
+            root.tables['foo'] = User
+
+        self.assertRaises(TypeError, assign)
+
+    def test_rebuild_picks_up_late_classes(self):
+        from sqlalchemy_traversal import rebuild_traversal_tables
+        from sqlalchemy_traversal.resources import TraversalRoot
+
+        class Late(TraversalMixin, Base):
+            __tablename__ = 'late'
+            id = Column(Integer, primary_key=True)
+
+        root = TraversalRoot(self._make_request('/traverse/late'))
+        self.assertRaises(KeyError, root.get_class, 'late')
+
+        rebuild_traversal_tables(self.config.registry)
+
+        root = TraversalRoot(self._make_request('/traverse/late'))
+        assert root.get_class('late') is Late
+
+    def test_collection_lookup(self):
+        from sqlalchemy_traversal.resources import TraversalRoot
+
+        root = TraversalRoot(self._make_request('/traverse/user'))
+        collection = root['user']
+
+        assert [x.id for x in collection] == [1, 2, 3]
+
+    def test_collection_serializes_eager_relationships(self):
+        from sqlalchemy_traversal.resources import TraversalRoot
+
+        request = self._make_request('/traverse/user')
+        collection = TraversalRoot(request)['user']
+        result = collection.__json__(request)
+
+        assert [len(x.get('messages', [])) for x in result] == [5, 0, 0]
+        assert result[0]['messages'][0] == {
+            'id': 1, 'user_id': 1, 'topic': u'topic1'
+        }
+
+
+class TestRelationshipTraversal(TraversalTestCase):
+    def _user(self, path):
+        from sqlalchemy_traversal.resources import TraversalRoot
+
+        request = self._make_request(path)
+
+        return TraversalRoot(request)['user']['1']
+
+    def test_filters_run_in_sql(self):
+        from sqlalchemy.orm.attributes import instance_state
+
+        user = self._user('/traverse/user/1/messages')
+        collection = user['messages{topic.equals(topic1)}.limit(1,2)']
+
+        assert [x.id for x in collection] == [3, 5]
+        assert collection.__parent__ is user
+        assert 'messages' not in instance_state(user).dict
+
+    def test_loaded_collection_filtered_in_memory(self):
+        user = self._user('/traverse/user/1/messages')
+        loaded = user.messages
+
+        collection = user['messages{topic.equals(topic1)}.limit(1,2)']
+
+        assert [x.id for x in collection] == [3, 5]
+        assert [x.id for x in user.messages] == [1, 2, 3, 4, 5]
+        assert user.messages is loaded
+
+    def test_many_to_one_is_not_a_collection(self):
+        from sqlalchemy_traversal.resources import TraversalRoot
+
+        request = self._make_request('/traverse/message/2/user')
+        message = TraversalRoot(request)['message']['2']
+
+        assert message['user'].id == 1
+
+    def test_order_by_matches_in_memory(self):
+        key = 'messages.order_by(topic desc, id desc).limit(1,3)'
+
+        in_sql = self._user('/traverse/user/1/messages')[key]
+
+        user = self._user('/traverse/user/1/messages')
+        user.messages
+        in_memory = user[key]
+
+        assert [x.id for x in in_sql] == [3, 1, 4]
+        assert [x.id for x in in_memory] == [3, 1, 4]
+
+
+class TestModelCollection(unittest.TestCase):
+    def _collection(self, count=5):
+        from sqlalchemy_traversal import ModelCollection
+
+        return ModelCollection([
+            Message(id=i, topic=u'topic%s' % i) for i in range(1, count + 1)
+        ])
+
+    def test_lookup_by_key(self):
+        collection = self._collection()
+
+        message = collection['3']
+
+        assert message.id == 3
+        assert message.__parent__ is collection
+        assert collection[0].id == 1
+
+    def test_missing_keys(self):
+        collection = self._collection()
+
+        self.assertRaises(KeyError, collection.__getitem__, '30')
+        self.assertRaises(KeyError, collection.__getitem__, 'abc')
+
+    def test_index_is_reused(self):
+        collection = self._collection()
+
+        collection['1']
+        index = collection._index
+        collection['5']
+
+        assert collection._index is index
+
+    def test_index_invalidated_on_mutation(self):
+        collection = self._collection()
+        collection['1']
+
+        collection.append(Message(id=10))
+        assert collection['10'].id == 10
+
+        # changed behind our back
+        collection.collection.append(Message(id=11))
+        assert collection['11'].id == 11
+
+        collection['1'].id = 12
+        self.assertRaises(KeyError, collection.__getitem__, '1')
+        assert collection['12'].topic == u'topic1'
+
+
+class TestCursorPagination(TraversalTestCase):
+    def _pages(self, get_page, key):
+        pages = []
+        cursor = None
+
+        while True:
+            if cursor:
+                page = get_page(key % (', ' + cursor))
+            else:
+                page = get_page(key % '')
+
+            pages.append([x.id for x in page])
+            cursor = page.next_cursor
+
+            if not cursor:
+                return pages
+
+    def _root_page(self, key):
+        from sqlalchemy_traversal.resources import TraversalRoot
+
+        request = self._make_request('/traverse/' + key)
+
+        return TraversalRoot(request)[key]
+
+    def _relationship_page(self, key, loaded=False):
+        from sqlalchemy_traversal.resources import TraversalRoot
+
+        request = self._make_request('/traverse/user/1/' + key)
+        user = TraversalRoot(request)['user']['1']
+
+        if loaded:
+            user.messages
+
+        return user[key]
+
+    def test_root_pages(self):
+        pages = self._pages(self._root_page, 'message.cursor(2%s)')
+
+        assert pages == [[1, 2], [3, 4], [5]]
+
+    def test_mixed_directions(self):
+        pages = self._pages(self._root_page,
+            'message.order_by(topic desc, id).cursor(2%s)'
+        )
+
+        assert pages == [[1, 3], [5, 2], [4]]
+
+    def test_relationship_pages(self):
+        key = 'messages.order_by(id desc).cursor(2%s)'
+
+        in_sql = self._pages(self._relationship_page, key)
+        in_memory = self._pages(
+            lambda key: self._relationship_page(key, loaded=True), key
+        )
+
+        assert in_sql == [[5, 4], [3, 2], [1]]
+        assert in_memory == in_sql
+
+    def test_exact_last_page(self):
+        pages = self._pages(self._root_page, 'user.cursor(3%s)')
+
+        assert pages == [[1, 2, 3], []]
+
+    def test_invalid_cursor(self):
+        from pyramid.httpexceptions import HTTPBadRequest
+
+        self.assertRaises(HTTPBadRequest, self._root_page,
+            'message.cursor(2, bm9wZQ==)'
+        )
+
+    def test_cursor_and_limit(self):
+        from sqlalchemy_traversal import parse_key
+
+        self.assertRaises(KeyError, parse_key, 'message.cursor(2).limit(0,2)')
+
+
+class TestPageSizeGuard(TraversalTestCase):
+    def setUp(self):
+        super(TestPageSizeGuard, self).setUp()
+
+        settings = self.config.registry.settings
+        settings['sqlalchemy_traversal.default_page_size'] = '2'
+        settings['sqlalchemy_traversal.max_page_size'] = '3'
+
+    def _collection(self, key):
+        from sqlalchemy_traversal.resources import TraversalRoot
+
+        request = self._make_request('/traverse/' + key)
+
+        return TraversalRoot(request)[key]
+
+    def test_default_page(self):
+        collection = self._collection('message')
+
+        assert [x.id for x in collection] == [1, 2]
+        assert collection.truncated
+
+    def test_maximum_page(self):
+        collection = self._collection('message.limit(1,10)')
+
+        assert [x.id for x in collection] == [2, 3, 4]
+        assert collection.truncated
+
+    def test_within_limits(self):
+        collection = self._collection('message.limit(3,2)')
+
+        assert [x.id for x in collection] == [4, 5]
+        assert not collection.truncated
+
+    def test_exactly_one_page(self):
+        collection = self._collection('user.limit(0,10)')
+
+        assert [x.id for x in collection] == [1, 2, 3]
+        assert not collection.truncated
+
+    def test_cursor_is_clamped(self):
+        collection = self._collection('message.cursor(10)')
+
+        assert [x.id for x in collection] == [1, 2, 3]
+        assert collection.next_cursor
+
+    def test_model_maximum(self):
+        import mock
+
+        with mock.patch.object(Message, '_traversal_max_page', 1):
+            collection = self._collection('message')
+
+        assert [x.id for x in collection] == [1]
+        assert collection.truncated
+
+    def test_relationship_pages(self):
+        from sqlalchemy_traversal.resources import TraversalRoot
+
+        request = self._make_request('/traverse/user/1/messages')
+        user = TraversalRoot(request)['user']['1']
+
+        collection = user['messages']
+        assert [x.id for x in collection] == [1, 2]
+        assert collection.truncated
+
+        user.messages
+        collection = user['messages.limit(2,5)']
+        assert [x.id for x in collection] == [3, 4, 5]
+        assert not collection.truncated
+
+
+class TestFilterCoercion(TraversalTestCase):
+    def _ticket(self):
+        from sqlalchemy.types import Boolean
+        from sqlalchemy.types import Numeric
+        from sqlalchemy.types import Float
+        from sqlalchemy.types import Date
+        from sqlalchemy.types import DateTime
+        from sqlalchemy.types import Time
+        from sqlalchemy.types import Enum
+        from sqlalchemy.dialects.postgresql import UUID
+
+        class Ticket(declarative_base()):
+            __tablename__ = 'ticket'
+            id = Column(Integer, primary_key=True)
+            paid = Column(Boolean)
+            price = Column(Numeric(10, 2))
+            weight = Column(Float)
+            day = Column(Date)
+            sold = Column(DateTime)
+            doors = Column(Time)
+            kind = Column(Enum('adult', 'child', name='kind'))
+            code = Column(UUID)
+            name = Column(Unicode(50))
+
+        return Ticket
+
+    def _coerce(self, column, args, command='equals'):
+        from sqlalchemy_traversal import coerce_args
+
+        return coerce_args(getattr(self._ticket(), column).property,
+            command, args
+        )
+
+    def test_column_types(self):
+        import datetime
+        import decimal
+
+        assert self._coerce('id', ('1', '2'), 'in') == (1, 2)
+        assert self._coerce('paid', 'False') is False
+        assert self._coerce('price', '10.50') == decimal.Decimal('10.50')
+        assert self._coerce('weight', '0.5') == 0.5
+        assert self._coerce('day', '2012-05-01') == datetime.date(2012, 5, 1)
+        assert self._coerce('sold', '2012-05-01T10:30:00') == \
+            datetime.datetime(2012, 5, 1, 10, 30)
+        assert self._coerce('sold', '2012-05-01') == \
+            datetime.datetime(2012, 5, 1)
+        assert self._coerce('doors', '19:30:00') == datetime.time(19, 30)
+        assert self._coerce('kind', 'child') == 'child'
+        assert self._coerce('code', '{12345678-1234-5678-1234-567812345678}') \
+            == '12345678-1234-5678-1234-567812345678'
+        assert self._coerce('name', 'Jo') == 'Jo'
+
+    def test_string_commands(self):
+        assert self._coerce('id', '1', 'starts_with') == '1'
+
+    def test_invalid_values(self):
+        from pyramid.httpexceptions import HTTPBadRequest
+
+        for column, args in [('id', 'one'), ('paid', 'maybe'),
+                ('price', 'ten'), ('day', '2012-13-01'), ('kind', 'pet'),
+                ('code', 'nope')]:
+            self.assertRaises(HTTPBadRequest, self._coerce, column, args)
+
+    def test_cursor_values(self):
+        from sqlalchemy_traversal import encode_cursor
+        from sqlalchemy_traversal import decode_cursor
+
+        import datetime
+        import decimal
+
+        Ticket = self._ticket()
+        ticket = Ticket(id=1, paid=True, price=decimal.Decimal('10.50'),
+            weight=0.5, day=datetime.date(2012, 5, 1),
+            sold=datetime.datetime(2012, 5, 1, 10, 30, 0, 5),
+            doors=datetime.time(19, 30), kind='child',
+            code='12345678-1234-5678-1234-567812345678'
+        )
+        columns = [(column, 'asc') for column in ('paid', 'price', 'weight',
+            'day', 'sold', 'doors', 'kind', 'code', 'id')
+        ]
+        token = encode_cursor(ticket, columns)
+
+        assert decode_cursor(token, columns, Ticket) == [
+            getattr(ticket, column) for column, method in columns
+        ]
+
+    def test_invalid_cursor_values(self):
+        from sqlalchemy_traversal import decode_cursor
+        from pyramid.httpexceptions import HTTPBadRequest
+
+        import base64
+        import json
+
+        Ticket = self._ticket()
+
+        for column, value in [('doors', '7pm'), ('kind', 'pet'),
+                ('code', 'nope'), ('id', 'one')]:
+            token = base64.urlsafe_b64encode(json.dumps([value]))
+
+            self.assertRaises(HTTPBadRequest, decode_cursor, token,
+                [(column, 'asc')], Ticket
+            )
+
+    def test_bad_key_is_bad_request(self):
+        from pyramid.httpexceptions import HTTPBadRequest
+        from sqlalchemy_traversal.resources import TraversalRoot
+
+        key = 'message{id.in(1,two)}'
+        request = self._make_request('/traverse/' + key)
+
+        self.assertRaises(HTTPBadRequest, TraversalRoot(request).__getitem__,
+            key
+        )
+
+    def test_filter_list_in(self):
+        from sqlalchemy_traversal import filter_list
+        from sqlalchemy_traversal import parse_key
+
+        messages = session.query(Message).order_by(Message.id).all()
+        filters = parse_key('message{id.in(1,3),user_id.equals(1)}')
+
+        assert [x.id for x in filter_list(filters, messages, Message)] == \
+            [1, 3]
+
+    def test_add_column_coercer(self):
+        from sqlalchemy_traversal import add_column_coercer
+        from sqlalchemy_traversal import get_column_coercer
+        from sqlalchemy_traversal import COLUMN_COERCERS
+        from sqlalchemy_traversal import _column_coercers
+        from sqlalchemy.types import Interval
+
+        class Show(declarative_base()):
+            __tablename__ = 'show'
+            id = Column(Integer, primary_key=True)
+            length = Column(Interval)
+
+        def coerce_minutes(value, column_type):
+            return int(value)
+
+        prop = Show.length.property
+        before = get_column_coercer(prop)
+        add_column_coercer(Interval, coerce_minutes)
+
+        try:
+            # replaces the coercer chosen before it was added
+            assert before is not coerce_minutes
+            assert get_column_coercer(prop) is coerce_minutes
+        finally:
+            COLUMN_COERCERS.pop(0)
+            _column_coercers.clear()
+
+
+class TestComparisonFilters(TraversalTestCase):
+    def setUp(self):
+        super(TestComparisonFilters, self).setUp()
+
+        session.add(Message(id=6, user_id=2, topic=None))
+        session.commit()
+
+    def _filter(self, key):
+        from sqlalchemy_traversal import filter_query
+        from sqlalchemy_traversal import filter_list
+        from sqlalchemy_traversal import parse_key
+        from sqlalchemy_traversal.resources import TraversalRoot
+
+        filters = parse_key(key)
+        query = session.query(Message).order_by(Message.id)
+
+        in_sql = [x.id for x in filter_query(filters, query, Message)]
+        in_memory = [x.id for x in filter_list(filters, query.all(), Message)]
+
+        request = self._make_request('/traverse/' + key)
+        planned = [x.id for x in TraversalRoot(request)[key]]
+
+        assert in_sql == in_memory == planned, key
+
+        return in_sql
+
+    def test_comparisons(self):
+        assert self._filter('message{id.gt(2)}') == [3, 4, 5, 6]
+        assert self._filter('message{id.gte(2),id.lt(5)}') == [2, 3, 4]
+        assert self._filter('message{id.lte(2)}') == [1, 2]
+        assert self._filter('message{id.between(2, 4)}') == [2, 3, 4]
+        assert self._filter('message{topic.gt(topic0)}') == [1, 3, 5]
+
+    def test_is_null(self):
+        assert self._filter('message{topic.is_null()}') == [6]
+        assert self._filter('message{topic.is_null(false)}') == \
+            [1, 2, 3, 4, 5]
+
+    def test_invalid_value(self):
+        from pyramid.httpexceptions import HTTPBadRequest
+
+        self.assertRaises(HTTPBadRequest, self._filter,
+            'message{id.between(1, two)}'
+        )
+
+
+class TestFilterListByQs(TraversalTestCase):
+    def _filter(self, qs):
+        from sqlalchemy_traversal import filter_list_by_qs
+        from sqlalchemy_traversal import filter_query_by_qs
+
+        messages = session.query(Message).all()
+        in_sql = filter_query_by_qs(session, Message, dict(qs)).all()
+        in_memory = filter_list_by_qs(dict(qs), messages)
+
+        assert [x.id for x in in_memory] == [x.id for x in in_sql], qs
+
+        return [x.id for x in in_memory]
+
+    def test_same_as_sql(self):
+        assert self._filter({'id.notin': '1,2'}) == [3, 4, 5]
+        assert self._filter({'id.in': '2,3', 'user_id': '1'}) == [2, 3]
+        assert self._filter({'topic.not': 'topic0'}) == [1, 3, 5]
+
+    def test_order_by_every_key(self):
+        assert self._filter({'__order_by': 'topic desc, id'}) == \
+            [5, 3, 1, 4, 2]
+        assert self._filter({'__order_by': 'topic, id desc'}) == \
+            [4, 2, 5, 3, 1]
+        assert self._filter({'__order_by': 'topic asc, id desc'}) == \
+            [4, 2, 5, 3, 1]
+
+    def test_empty(self):
+        from sqlalchemy_traversal import filter_list_by_qs
+
+        assert filter_list_by_qs({'id': '1'}, []) == []
@@ -0,0 +1,220 @@
+from sqlalchemy_traversal.tests.test_resources import TraversalTestCase
+from sqlalchemy_traversal.tests.test_resources import User
+from sqlalchemy_traversal.tests.test_resources import session
+
+import colander
+import mock
+
+
+class UserSchema(colander.MappingSchema):
+    name = colander.SchemaNode(colander.String(),
+        validator=colander.Length(max=10)
+    )
+
+
+class TestBulkSave(TraversalTestCase):
+    def setUp(self):
+        super(TestBulkSave, self).setUp()
+
+        self.after = []
+
+    def _register(self, decorator, wrapped):
+        scanner = mock.Mock(config=self.config)
+        decorator.register(scanner, wrapped.__name__, wrapped)
+
+    def _register_save(self, save_user=None, **kw):
+        from sqlalchemy_traversal import register_save
+
+        def passthrough(request, data):
+            return data
+
+        self._register(register_save(User, UserSchema, **kw),
+            save_user or passthrough
+        )
+
+    def _save(self, path, method, items):
+        from sqlalchemy_traversal.resources import TraversalRoot
+        from sqlalchemy_traversal.views import resources_view
+
+        request = self._make_request(path, method)
+        request.is_xhr = True
+        request.content_type = 'application/json'
+        request.json_body = request.json = items
+
+        context = TraversalRoot(request)
+
+        for segment in path.split('/')[2:]:
+            context = context[segment]
+
+        request.context = context
+
+        return request, resources_view(request)
+
+    def test_bulk_create(self):
+        self._register_save()
+
+        request, result = self._save('/traverse/user', 'POST', [
+            {'name': u'new1'}, {'name': u'new2'}
+        ])
+
+        assert [x.name for x in result] == [u'new1', u'new2']
+        assert all(x.id for x in result)
+        assert session.query(User).count() == 5
+
+    def test_bulk_update(self):
+        self._register_save()
+
+        request, result = self._save('/traverse/user', 'PUT', [
+            {'id': 1, 'name': u'first'}, {'id': '3', 'name': u'third'}
+        ])
+
+        names = [x.name for x in session.query(User).order_by(User.id)]
+
+        assert [x.id for x in result] == [1, 3]
+        assert names == [u'first', u'user2', u'third']
+
+    def test_errors_per_item(self):
+        self._register_save()
+
+        request, result = self._save('/traverse/user', 'POST', [
+            {'name': u'fine'}, {'name': u'much too long'}, 'nope'
+        ])
+
+        assert result['has_errors']
+        assert result['items'][0] == {}
+        assert result['items'][1]['errors'][0]['id'] == 'name'
+        assert result['items'][2] == {'message': 'Expected an object'}
+        assert request.response.status_int == 400
+        assert session.query(User).count() == 3
+
+    def test_update_missing(self):
+        self._register_save()
+
+        request, result = self._save('/traverse/user', 'PUT', [
+            {'id': 1, 'name': u'first'}, {'id': 20, 'name': u'twenty'}
+        ])
+
+        assert result['items'][1] == {'message': 'Not found', 'id': 20}
+
+    def test_update_errors_change_nothing(self):
+        self._register_save()
+
+        request, result = self._save('/traverse/user', 'PUT', [
+            {'id': 1, 'name': u'changed'}, {'id': 2, 'name': u'much too long'}
+        ])
+        session.commit()
+
+        assert result['has_errors']
+        assert request.response.status_int == 400
+        assert session.query(User).get(1).name == u'user1'
+
+    def test_batched_flush(self):
+        from sqlalchemy import event
+
+        self._register_save()
+
+        flushes = []
+        event.listen(session, 'after_flush', lambda *args: flushes.append(1))
+
+        with mock.patch.object(User, '_traversal_bulk_batch', 2):
+            request, result = self._save('/traverse/user', 'POST', [
+                {'name': u'new%s' % i} for i in range(5)
+            ])
+
+        assert len(result) == 5
+        assert len(flushes) == 3
+
+    def test_flush_errors(self):
+        from sqlalchemy.exc import IntegrityError
+
+        handled = []
+
+        def handle_integrity_error(objects, e):
+            handled.append(objects)
+
+            return {'message': 'invalid'}
+
+        def save_user(request, data):
+            # name isn't nullable
+            if data['name'] == u'null':
+                data['name'] = None
+
+            return data
+
+        self._register_save(save_user, exception_handlers={
+            IntegrityError: handle_integrity_error
+        })
+
+        with mock.patch.object(User, '_traversal_bulk_batch', 2):
+            request, result = self._save('/traverse/user', 'POST', [
+                {'name': u'new1'}, {'name': u'new2'},
+                {'name': u'new3'}, {'name': u'null'}
+            ])
+
+        assert result == {'has_errors': True, 'message': 'invalid',
+            'batch': [2, 4]}
+        assert [x.name for x in handled[0]] == [u'new3', None]
+
+    def test_after_bulk_save(self):
+        from sqlalchemy_traversal import register_after_bulk_save
+
+        self._register_save()
+
+        def after(request, objects):
+            self.after.append([x.id for x in objects])
+
+        self._register(register_after_bulk_save(User), after)
+
+        self._save('/traverse/user', 'POST', [
+            {'name': u'new1'}, {'name': u'new2'}
+        ])
+
+        assert self.after == [[4, 5]]
+
+    def test_after_save_per_object(self):
+        from sqlalchemy_traversal import register_after_save
+
+        self._register_save()
+
+        def after(request):
+            self.after.append(request.context.id)
+
+        self._register(register_after_save(User), after)
+
+        request, result = self._save('/traverse/user', 'POST', [
+            {'name': u'new1'}, {'name': u'new2'}
+        ])
+
+        assert self.after == [4, 5]
+        assert isinstance(request.context, User)
+        assert request.context.id is None
+
+    def test_save_instance(self):
+        self._register_save()
+
+        request, result = self._save('/traverse/user/1', 'PUT',
+            {'name': u'first'}
+        )
+
+        assert result is session.query(User).get(1)
+        assert result.name == u'first'
+
+    def test_save_instance_errors(self):
+        self._register_save()
+
+        request, result = self._save('/traverse/user/1', 'PUT',
+            {'name': u'much too long'}
+        )
+
+        assert result['has_errors']
+        assert result['name'] == u'much too long'
+        assert request.response.status_int == 400
+
+    def test_bulk_save_to_instance(self):
+        self._register_save()
+
+        request, result = self._save('/traverse/user/1', 'PUT', [
+            {'name': u'first'}
+        ])
+
+        assert result['has_errors']
@@ -4,13 +4,21 @@ from sqlalchemy.types import UnicodeText
 from sqlalchemy.types import Unicode
 from sqlalchemy.types import Boolean
 from sqlalchemy.types import DateTime
+from sqlalchemy.types import Numeric
+from sqlalchemy.types import Float
+from sqlalchemy.types import LargeBinary
+from sqlalchemy.types import String
+from sqlalchemy.types import Interval
 from sqlalchemy.orm import sessionmaker
 from sqlalchemy.orm import scoped_session
+from sqlalchemy.orm import relationship
 from sqlalchemy import Column
+from sqlalchemy import ForeignKey
 
 from sqlalchemy_traversal import JsonSerializableMixin
 
 import datetime
+import decimal
 import unittest
 import os
 
@@ -29,6 +37,41 @@ class User(Base, JsonSerializableMixin):
     created = Column(DateTime)
 
 
+class Author(Base, JsonSerializableMixin):
+    __tablename__ = 'authors'
+    id = Column(Integer, primary_key=True)
+
+    books = relationship('Book', backref='author')
+
+    _json_eager_load = ['books']
+
+
+class Book(Base, JsonSerializableMixin):
+    __tablename__ = 'books'
+    id = Column(Integer, primary_key=True)
+    author_id = Column(Integer, ForeignKey('authors.id'))
+
+    chapters = relationship('Chapter')
+
+    _json_eager_load = ['chapters', 'author']
+
+
+class Chapter(Base, JsonSerializableMixin):
+    __tablename__ = 'chapters'
+    id = Column(Integer, primary_key=True)
+    book_id = Column(Integer, ForeignKey('books.id'))
+
+
+class Payment(Base, JsonSerializableMixin):
+    __tablename__ = 'payments'
+    id = Column(Integer, primary_key=True)
+    amount = Column(Numeric(10, 2))
+    rate = Column(Float)
+    receipt = Column(LargeBinary)
+    code = Column(String(10))
+    late_by = Column(Interval)
+
+
 class TestSerialization(unittest.TestCase):
 
     def setUp(self):
@@ -77,3 +120,116 @@ class TestSerialization(unittest.TestCase):
         d = self.user.__json__(object())
         assert d['created'] == "1969-12-31T19:00:00"
         assert type(d['created']) == str
+
+    def test_serialization_plan_is_cached(self):
+        from sqlalchemy_traversal import get_serialization_plan
+
+        plan = get_serialization_plan(User)
+        self.user.__json__(object())
+
+        assert get_serialization_plan(User) is plan
+        assert 'password' in plan.blacklist
+        assert set(key for key, converter in plan.columns) == set(
+            self.user.__json__(object())
+        )
+
+    def test_field_plans_bounded(self):
+        from sqlalchemy_traversal import get_serialization_plan
+
+        import mock
+
+        with mock.patch('sqlalchemy_traversal._serialization_plans.maxsize',
+                2):
+            first = get_serialization_plan(User, frozenset(['id']))
+            get_serialization_plan(User, frozenset(['name']))
+            get_serialization_plan(User, frozenset(['id', 'name']))
+
+            assert get_serialization_plan(User, frozenset(['id'])) \
+                is not first
+
+
+class TestColumnConverters(unittest.TestCase):
+    def _serialize(self, **kw):
+        return Payment(**kw).__json__(object())
+
+    def test_decimal(self):
+        d = self._serialize(amount=decimal.Decimal('10.50'), rate=0.5)
+
+        assert d['amount'] == u'10.50'
+        assert d['rate'] == 0.5
+
+    def test_decimal_precision(self):
+        d = self._serialize(
+            amount=decimal.Decimal('12345678901234567.0123456789')
+        )
+
+        assert d['amount'] == u'12345678901234567.0123456789'
+
+    def test_binary(self):
+        d = self._serialize(receipt='\x00\xff')
+
+        assert d['receipt'] == 'AP8='
+
+    def test_string(self):
+        d = self._serialize(code='abc')
+
+        assert d['code'] == u'abc'
+        assert isinstance(d['code'], unicode)
+
+    def test_nulls(self):
+        d = self._serialize()
+
+        assert d == dict(id=None, amount=None, rate=None, receipt=None,
+            code=None, late_by=None
+        )
+
+    def test_unknown_type(self):
+        d = self._serialize(late_by=datetime.timedelta(hours=1))
+
+        assert d['late_by'] == u'1:00:00'
+
+    def test_add_column_converter(self):
+        from sqlalchemy_traversal import add_column_converter
+        from sqlalchemy_traversal import get_column_converter
+        from sqlalchemy_traversal import COLUMN_CONVERTERS
+        from sqlalchemy_traversal import _serialization_plans
+        from sqlalchemy.orm import class_mapper
+
+        def convert_seconds(value):
+            return value.seconds
+
+        prop = class_mapper(Payment).get_property('late_by')
+        late_by = datetime.timedelta(hours=1)
+
+        # builds the plan before the converter is added
+        assert self._serialize(late_by=late_by)['late_by'] == u'1:00:00'
+
+        add_column_converter(Interval, convert_seconds)
+
+        try:
+            assert get_column_converter(prop) is convert_seconds
+            assert self._serialize(late_by=late_by)['late_by'] == 3600
+        finally:
+            COLUMN_CONVERTERS.pop(0)
+            _serialization_plans.clear()
+
+
+class TestEagerLoadPaths(unittest.TestCase):
+    def test_nested_paths(self):
+        from sqlalchemy_traversal import get_eager_load_paths
+
+        assert get_eager_load_paths(Author) == (
+            'books', 'books.chapters', 'books.author'
+        )
+
+    def test_cycles_stop(self):
+        from sqlalchemy_traversal import get_eager_load_paths
+
+        assert get_eager_load_paths(Book) == (
+            'chapters', 'author', 'author.books'
+        )
+
+    def test_no_eager_load(self):
+        from sqlalchemy_traversal import get_eager_load_paths
+
+        assert get_eager_load_paths(Chapter) == ()
@@ -0,0 +1,1186 @@
+from sqlalchemy_traversal.tests.test_resources import TraversalTestCase
+from sqlalchemy_traversal.tests.test_resources import User
+from sqlalchemy_traversal.tests.test_resources import Message
+from sqlalchemy_traversal.tests.test_resources import session
+from sqlalchemy_traversal.tests.test_resources import Base
+
+from sqlalchemy_traversal.resources import TraversalRoot
+from sqlalchemy_traversal import TraversalMixin
+
+from sqlalchemy.types import Integer
+from sqlalchemy.types import Unicode
+from sqlalchemy.types import DateTime
+from sqlalchemy.orm import relationship
+from sqlalchemy.orm import backref
+from sqlalchemy import Column
+from sqlalchemy import ForeignKey
+from sqlalchemy import Table
+
+from datetime import datetime
+from datetime import timedelta
+
+import mock
+
+
+class Note(TraversalMixin, Base):
+    __tablename__ = 'note'
+    id = Column(Integer, primary_key=True)
+    body = Column(Unicode(50))
+    updated = Column(DateTime, nullable=False)
+
+    _traversal_version_column = 'updated'
+
+
+class Revision(TraversalMixin, Base):
+    __tablename__ = 'revision'
+    id = Column(Integer, primary_key=True)
+    version = Column(Integer, nullable=False)
+
+    __mapper_args__ = {'version_id_col': version}
+
+
+class Draft(TraversalMixin, Base):
+    __tablename__ = 'draft'
+    id = Column(Integer, primary_key=True)
+    user_id = Column(Integer, ForeignKey('user.id'))
+    rank = Column(Integer, nullable=False)
+
+    user = relationship('User',
+        backref=backref('drafts', order_by='Draft.rank.desc()')
+    )
+
+
+class Board(TraversalMixin, Base):
+    __tablename__ = 'board'
+    id = Column(Integer, primary_key=True)
+    updated = Column(DateTime, nullable=False)
+
+    pins = relationship('Pin', order_by='Pin.id')
+
+    _traversal_version_column = 'updated'
+    _json_eager_load = ['pins']
+
+
+class Pin(TraversalMixin, Base):
+    __tablename__ = 'pin'
+    id = Column(Integer, primary_key=True)
+    board_id = Column(Integer, ForeignKey('board.id'))
+    body = Column(Unicode(50))
+
+
+team_members = Table('team_members', Base.metadata
+    , Column('team_id', Integer, ForeignKey('team.id'))
+    , Column('user_id', Integer, ForeignKey('user.id'))
+)
+
+
+class Team(TraversalMixin, Base):
+    __tablename__ = 'team'
+    id = Column(Integer, primary_key=True)
+
+    members = relationship('User', secondary=team_members, order_by='User.id')
+
+
+class TestResourcesView(TraversalTestCase):
+    def _traverse(self, request):
+        from sqlalchemy_traversal.resources import TraversalRoot
+
+        context = TraversalRoot(request)
+
+        for segment in request.path.split('/')[2:]:
+            context = context[segment]
+
+        request.context = context
+
+        return context
+
+    def _resolve(self, request):
+        """ Traverses to a collection, loading it if traversal is lazy """
+        from sqlalchemy_traversal.resources import CollectionQuery
+
+        context = self._traverse(request)
+
+        if isinstance(context, CollectionQuery):
+            request.context = context = context.resolve()
+
+        return context
+
+    def _counting(self, cls):
+        calls = []
+        original = cls.__json__.im_func
+
+        def __json__(self, request):
+            calls.append(self)
+
+            return original(self, request)
+
+        return calls, mock.patch.object(cls, '__json__', __json__)
+
+    def test_collection_serialized_once(self):
+        from sqlalchemy_traversal.views import resources_view
+
+        request = self._make_request('/traverse/user')
+        self._traverse(request)
+
+        calls, patch = self._counting(User)
+
+        with patch:
+            result = resources_view(request)
+
+        assert len(calls) == 3
+        assert [x['id'] for x in result] == [1, 2, 3]
+
+    def _drafts(self, key, loaded=False):
+        from sqlalchemy_traversal.views import resources_view
+
+        session.add_all([Draft(id=i, user_id=1, rank=i) for i in range(1, 6)])
+        session.commit()
+
+        if loaded:
+            assert len(session.query(User).get(1).drafts) == 5
+
+        request = self._make_request('/traverse/user/1/' + key)
+        self._traverse(request)
+
+        return [x['id'] for x in resources_view(request)]
+
+    def test_relationship_order_by(self):
+        assert self._drafts('drafts') == [5, 4, 3, 2, 1]
+
+    def test_relationship_order_by_paged(self):
+        assert self._drafts('drafts.limit(0,2)') == [5, 4]
+
+    def test_key_order_by_replaces_relationship(self):
+        assert self._drafts('drafts.order_by(id).limit(0,2)') == [1, 2]
+
+    def test_relationship_order_by_loaded(self):
+        assert self._drafts('drafts.limit(0,2)', loaded=True) == [5, 4]
+
+    def test_relationship_collection_parent_keys(self):
+        from sqlalchemy_traversal.views import resources_view
+
+        request = self._make_request('/traverse/user/1/messages')
+        self._traverse(request)
+
+        calls, patch = self._counting(Message)
+
+        with patch:
+            result = resources_view(request)
+
+        assert len(calls) == 5
+        assert len(result) == 5
+
+        for row in result:
+            assert row['user_pk'] == 1
+
+    def test_instance_parent_keys(self):
+        from sqlalchemy_traversal.views import resources_view
+
+        request = self._make_request('/traverse/user/1/messages/2')
+        self._traverse(request)
+
+        result = resources_view(request)
+
+        assert result == {'id': 2, 'user_id': 1, 'topic': u'topic0',
+            'user_pk': 1}
+
+    def test_streamed_collection(self):
+        from sqlalchemy_traversal.views import resources_view
+
+        import json
+
+        request = self._make_request('/traverse/message')
+        self._traverse(request)
+        expected = resources_view(request)
+
+        request = self._make_request('/traverse/message',
+            headers={'X-Traversal-Stream': '1'}
+        )
+        self._resolve(request)
+
+        assert request.context.stream
+
+        request.context.batch_size = 2
+        response = resources_view(request)
+        chunks = list(response.app_iter)
+
+        assert response.content_type == 'application/json'
+        assert len(chunks) == 3
+        assert json.loads(''.join(chunks)) == expected
+
+    def _stream_after_close(self):
+        from sqlalchemy_traversal.views import resources_view
+        from sqlalchemy import event
+
+        import json
+
+        request = self._make_request('/traverse/message',
+            headers={'X-Traversal-Stream': '1'}
+        )
+        self._traverse(request)
+        response = resources_view(request)
+
+        # a transaction manager has committed and closed it by now
+        session.commit()
+        session.close()
+
+        statements = []
+
+        def before_cursor_execute(conn, cursor, statement, *args):
+            statements.append(statement)
+
+        event.listen(self.engine, 'before_cursor_execute',
+            before_cursor_execute
+        )
+
+        result = json.loads(''.join(response.app_iter))
+
+        # the rows are only selected once the response is written
+        assert len(statements) == 1
+
+        return result
+
+    def test_streamed_after_session_closed(self):
+        result = self._stream_after_close()
+
+        assert [x['id'] for x in result] == [1, 2, 3, 4, 5]
+
+    def test_streamed_rows_after_session_closed(self):
+        with mock.patch.object(Message, '_traversal_raw', True):
+            result = self._stream_after_close()
+
+        assert [x['id'] for x in result] == [1, 2, 3, 4, 5]
+
+    def test_streamed_empty_collection(self):
+        from sqlalchemy_traversal.views import resources_view
+
+        import json
+
+        request = self._make_request(
+            '/traverse/message{topic.equals(nothing)}',
+            headers={'X-Traversal-Stream': 'true'}
+        )
+        self._traverse(request)
+
+        response = resources_view(request)
+
+        assert json.loads(''.join(response.app_iter)) == []
+
+    def test_model_streams_by_default(self):
+        request = self._make_request('/traverse/message')
+
+        with mock.patch.object(Message, '_traversal_stream', True):
+            self._resolve(request)
+
+        assert request.context.stream
+
+    def test_next_cursor_header(self):
+        from sqlalchemy_traversal.views import resources_view
+
+        request = self._make_request('/traverse/message.cursor(3)')
+        self._traverse(request)
+
+        result = resources_view(request)
+        cursor = request.response.headers['X-Traversal-Next-Cursor']
+
+        assert [x['id'] for x in result] == [1, 2, 3]
+
+        request = self._make_request(
+            '/traverse/message.cursor(3, %s)' % cursor
+        )
+        self._traverse(request)
+
+        result = resources_view(request)
+
+        assert [x['id'] for x in result] == [4, 5]
+        assert 'X-Traversal-Next-Cursor' not in request.response.headers
+
+
+    def test_truncated_header(self):
+        from sqlalchemy_traversal.views import resources_view
+
+        settings = self.config.registry.settings
+        settings['sqlalchemy_traversal.max_page_size'] = '4'
+
+        request = self._make_request('/traverse/message')
+        self._traverse(request)
+
+        result = resources_view(request)
+
+        assert len(result) == 4
+        assert request.response.headers['X-Traversal-Truncated'] == 'true'
+
+    def test_member_beyond_default_page(self):
+        from sqlalchemy_traversal.views import resources_view
+
+        settings = self.config.registry.settings
+        settings['sqlalchemy_traversal.default_page_size'] = '2'
+
+        request = self._make_request('/traverse/user/1/messages/5')
+        self._traverse(request)
+
+        assert resources_view(request)['id'] == 5
+
+    def test_member_of_loaded_collection_beyond_default_page(self):
+        from sqlalchemy_traversal.views import resources_view
+
+        settings = self.config.registry.settings
+        settings['sqlalchemy_traversal.default_page_size'] = '2'
+
+        assert len(session.query(User).get(1).messages) == 5
+
+        request = self._make_request('/traverse/user/1/messages/5')
+        self._traverse(request)
+
+        assert resources_view(request)['id'] == 5
+
+    def test_head_collection_member(self):
+        from sqlalchemy_traversal.views import resources_view
+
+        request = self._make_request('/traverse/user/1/messages/5', 'HEAD')
+        self._traverse(request)
+
+        response = resources_view(request)
+
+        assert response.status_int == 200
+        assert 'X-Traversal-Total-Count' not in response.headers
+
+    def test_total_count_header(self):
+        from sqlalchemy_traversal.views import resources_view
+
+        request = self._make_request(
+            '/traverse/message{topic.equals(topic1)}.limit(0,1).count()'
+        )
+        self._traverse(request)
+
+        result = resources_view(request)
+
+        assert len(result) == 1
+        assert request.response.headers['X-Traversal-Total-Count'] == '3'
+
+    def test_total_count_request_header(self):
+        from sqlalchemy_traversal.views import resources_view
+
+        request = self._make_request('/traverse/user/1/messages.limit(0,2)',
+            headers={'X-Traversal-Count': '1'}
+        )
+        self._traverse(request)
+
+        result = resources_view(request)
+
+        assert len(result) == 2
+        assert request.response.headers['X-Traversal-Total-Count'] == '5'
+
+    def test_no_total_count_by_default(self):
+        from sqlalchemy_traversal.views import resources_view
+
+        request = self._make_request('/traverse/message')
+        self._traverse(request)
+        resources_view(request)
+
+        assert 'X-Traversal-Total-Count' not in request.response.headers
+
+    def test_head_collection(self):
+        from sqlalchemy_traversal.views import resources_view
+
+        request = self._make_request('/traverse/user/1/messages', 'HEAD')
+        self._traverse(request)
+
+        response = resources_view(request)
+
+        assert response is request.response
+        assert response.headers['X-Traversal-Total-Count'] == '5'
+        assert response.body == ''
+
+class TestLazyTraversal(TestResourcesView):
+    def setUp(self):
+        from sqlalchemy import event
+
+        super(TestLazyTraversal, self).setUp()
+
+        self.config.registry.settings['sqlalchemy_traversal.lazy'] = 'true'
+        self.statements = []
+
+        def before_cursor_execute(conn, cursor, statement, *args):
+            self.statements.append(statement)
+
+        event.listen(self.engine, 'before_cursor_execute',
+            before_cursor_execute
+        )
+
+        # start a new connection so that it picks up the listener
+        session.remove()
+
+    def test_single_round_trip(self):
+        from sqlalchemy_traversal.views import resources_view
+
+        request = self._make_request('/traverse/user/1/messages/2')
+        self._traverse(request)
+
+        assert self.statements == []
+
+        result = resources_view(request)
+
+        assert len(self.statements) == 1
+        assert result == {'id': 2, 'user_id': 1, 'topic': u'topic0',
+            'user_pk': 1}
+
+    def test_deep_path_single_round_trip(self):
+        from sqlalchemy_traversal.views import resources_view
+
+        request = self._make_request('/traverse/message/2/user/messages')
+        self._traverse(request)
+
+        result = resources_view(request)
+
+        assert len(self.statements) == 1
+        assert [x['id'] for x in result] == [1, 2, 3, 4, 5]
+
+    def test_missing_instance_is_not_found(self):
+        from pyramid.httpexceptions import HTTPNotFound
+        from sqlalchemy_traversal.views import resources_view
+
+        request = self._make_request('/traverse/user/1/messages/20')
+        self._traverse(request)
+
+        self.assertRaises(HTTPNotFound, resources_view, request)
+
+    def test_collection_eager_loads(self):
+        from sqlalchemy_traversal.views import resources_view
+
+        session.add(Team(id=1, members=session.query(User).all()))
+        session.commit()
+        session.remove()
+        del self.statements[:]
+
+        request = self._make_request('/traverse/team/1/members')
+        self._traverse(request)
+
+        result = resources_view(request)
+
+        # the members and then all of their messages
+        assert [len(x.get('messages', [])) for x in result] == [5, 0, 0]
+        assert len(self.statements) == 2
+
+    def test_collection_of_missing_parent(self):
+        from pyramid.httpexceptions import HTTPNotFound
+        from sqlalchemy_traversal.views import resources_view
+
+        for method in ('GET', 'HEAD'):
+            request = self._make_request('/traverse/user/999/messages',
+                method
+            )
+            self._traverse(request)
+
+            self.assertRaises(HTTPNotFound, resources_view, request)
+
+    def test_empty_collection_parents(self):
+        from sqlalchemy_traversal.views import resources_view
+
+        request = self._make_request('/traverse/user/3/messages')
+        self._traverse(request)
+
+        result = resources_view(request)
+
+        assert result == []
+        assert request.context.__parent__.id == 3
+        assert len(self.statements) == 2
+
+    def test_keys_coerced_by_column(self):
+        from sqlalchemy_traversal import add_column_coercer
+        from sqlalchemy_traversal import COLUMN_COERCERS
+        from sqlalchemy_traversal import _column_coercers
+        from sqlalchemy_traversal.views import resources_view
+
+        def coerce_hex(value, column_type):
+            return int(value, 16)
+
+        add_column_coercer(Integer, coerce_hex)
+
+        try:
+            request = self._make_request('/traverse/user/0x1/messages/0x2')
+            self._traverse(request)
+
+            assert resources_view(request)['id'] == 2
+
+            request = self._make_request('/traverse/user/g')
+            self.assertRaises(KeyError, self._traverse, request)
+
+            request = self._make_request('/traverse/user/1/messages/g')
+            self.assertRaises(KeyError, self._traverse, request)
+        finally:
+            COLUMN_COERCERS.pop(0)
+            _column_coercers.clear()
+
+    def test_member_of_paged_collection(self):
+        from sqlalchemy_traversal.views import resources_view
+
+        request = self._make_request('/traverse/user/1/messages.limit(0,3)/2')
+        self._traverse(request)
+
+        result = resources_view(request)
+
+        assert result['id'] == 2
+
+    def test_member_with_max_page_size(self):
+        from sqlalchemy_traversal.views import resources_view
+
+        settings = self.config.registry.settings
+        settings['sqlalchemy_traversal.max_page_size'] = '4'
+
+        request = self._make_request('/traverse/user/1/messages/5')
+        self._traverse(request)
+
+        result = resources_view(request)
+
+        assert result['id'] == 5
+
+    def test_member_outside_filters_is_not_found(self):
+        from pyramid.httpexceptions import HTTPNotFound
+        from sqlalchemy_traversal.views import resources_view
+
+        request = self._make_request(
+            '/traverse/user/1/messages{topic.equals(topic1)}/2'
+        )
+        self._traverse(request)
+
+        self.assertRaises(HTTPNotFound, resources_view, request)
+
+
+class StatementsTestCase(TraversalTestCase):
+    """ Records the SQL statements run during the test """
+    def setUp(self):
+        from sqlalchemy import event
+
+        super(StatementsTestCase, self).setUp()
+
+        session.add_all([
+            Message(id=i, user_id=2, topic=u'other') for i in range(6, 9)
+        ])
+        session.commit()
+
+        self.statements = []
+
+        def before_cursor_execute(conn, cursor, statement, *args):
+            self.statements.append(statement)
+
+        event.listen(self.engine, 'before_cursor_execute',
+            before_cursor_execute
+        )
+        session.remove()
+
+
+class TestEagerLoading(StatementsTestCase):
+    def test_collection_query_count(self):
+        from sqlalchemy_traversal.resources import TraversalRoot
+        from sqlalchemy_traversal.views import resources_view
+
+        request = self._make_request('/traverse/user')
+        request.context = TraversalRoot(request)['user']
+
+        result = resources_view(request)
+
+        assert [len(x.get('messages', [])) for x in result] == [5, 3, 0]
+        assert len(self.statements) == 2
+
+
+class TestFields(StatementsTestCase):
+    def test_collection_fields(self):
+        from sqlalchemy_traversal.resources import TraversalRoot
+        from sqlalchemy_traversal.views import resources_view
+
+        request = self._make_request('/traverse/message.fields(topic)')
+        request.context = TraversalRoot(request)['message.fields(topic)']
+
+        result = resources_view(request)
+
+        assert result[0] == {'topic': u'topic1'}
+        assert len(self.statements) == 1
+        assert 'user_id' not in self.statements[0]
+
+    def test_relationship_fields(self):
+        from sqlalchemy_traversal.views import resources_view
+
+        request = self._make_request('/traverse/user/2/messages.fields(id)')
+        request.context = TraversalRoot(request)['user']['2'][
+            'messages.fields(id)'
+        ]
+
+        result = resources_view(request)
+
+        assert result == [
+            {'id': 6, 'user_pk': 2}, {'id': 7, 'user_pk': 2},
+            {'id': 8, 'user_pk': 2}
+        ]
+        assert 'topic' not in self.statements[-1]
+
+    def test_fields_select_relationships(self):
+        from sqlalchemy_traversal.resources import TraversalRoot
+        from sqlalchemy_traversal.views import resources_view
+
+        key = 'user.fields(name)'
+        request = self._make_request('/traverse/' + key)
+        request.context = TraversalRoot(request)[key]
+
+        result = resources_view(request)
+
+        assert result[0] == {'name': u'user1'}
+        assert len(self.statements) == 1
+
+    def test_fields_not_kept_on_instances(self):
+        from sqlalchemy_traversal.resources import TraversalRoot
+        from sqlalchemy_traversal.views import resources_view
+
+        key = 'message.fields(id)'
+        request = self._make_request('/traverse/' + key)
+        request.context = TraversalRoot(request)[key]
+        resources_view(request)
+
+        # served from the identity map the fields query just filled
+        request = self._make_request('/traverse/message/1')
+        request.context = TraversalRoot(request)['message']['1']
+
+        assert resources_view(request) == {'id': 1, 'user_id': 1,
+            'topic': u'topic1'}
+
+    def test_unknown_field(self):
+        from sqlalchemy_traversal.resources import TraversalRoot
+
+        key = 'user.fields(nope)'
+        request = self._make_request('/traverse/' + key)
+
+        self.assertRaises(KeyError, TraversalRoot(request).__getitem__, key)
+
+
+class TestCount(StatementsTestCase):
+    def test_head_only_counts(self):
+        from sqlalchemy_traversal.resources import TraversalRoot
+        from sqlalchemy_traversal.views import resources_view
+
+        key = 'message{user_id.equals(2)}.order_by(topic)'
+        request = self._make_request('/traverse/' + key, 'HEAD')
+        request.context = TraversalRoot(request)[key]
+
+        response = resources_view(request)
+
+        assert response.headers['X-Traversal-Total-Count'] == '3'
+        assert len(self.statements) == 1
+        assert 'count(' in self.statements[0]
+        assert 'ORDER BY' not in self.statements[0]
+
+    def test_count_ignores_paging(self):
+        from sqlalchemy_traversal.resources import TraversalRoot
+
+        key = 'message.order_by(id desc).limit(2,2).count()'
+        request = self._make_request('/traverse/' + key)
+        collection = TraversalRoot(request)[key]
+
+        assert [x.id for x in collection] == [6, 5]
+        assert collection.total_count == 8
+        assert 'LIMIT' not in self.statements[0]
+
+    def test_loaded_relationship_count(self):
+        from sqlalchemy_traversal.resources import TraversalRoot
+
+        key = 'messages{topic.equals(topic0)}.limit(0,1).count()'
+        request = self._make_request('/traverse/user/1/' + key)
+        user = TraversalRoot(request)['user']['1']
+        user.messages
+
+        collection = user[key]
+
+        assert len(list(collection)) == 1
+        assert collection.total_count == 2
+
+    def test_member_not_counted(self):
+        from sqlalchemy_traversal.resources import TraversalRoot
+
+        request = self._make_request('/traverse/user/1/messages/5',
+            headers={'X-Traversal-Count': '1'}
+        )
+        message = TraversalRoot(request)['user']['1']['messages']['5']
+
+        assert message.id == 5
+        assert not [x for x in self.statements if 'count(' in x]
+
+
+class TestBulkDelete(StatementsTestCase):
+    def _delete(self, key):
+        from sqlalchemy_traversal.resources import TraversalRoot
+        from sqlalchemy_traversal.views import resources_view
+
+        request = self._make_request('/traverse/' + key, 'DELETE')
+        request.context = TraversalRoot(request)[key]
+
+        return resources_view(request)
+
+    def test_single_statement(self):
+        with mock.patch.object(Message, '_traversal_bulk_delete', ['user_id']):
+            result = self._delete('message{user_id.equals(2)}')
+
+        assert result == {'success': True, 'count': 3}
+        assert len(self.statements) == 1
+        assert self.statements[0].startswith('DELETE')
+        assert session.query(Message).count() == 5
+
+    def test_not_allowed(self):
+        from pyramid.httpexceptions import HTTPForbidden
+
+        self.assertRaises(HTTPForbidden, self._delete,
+            'message{user_id.equals(2)}'
+        )
+
+        with mock.patch.object(Message, '_traversal_bulk_delete', ['user_id']):
+            self.assertRaises(HTTPForbidden, self._delete,
+                'message{topic.equals(other)}'
+            )
+
+        assert session.query(Message).count() == 8
+
+    def test_bad_keys(self):
+        from pyramid.httpexceptions import HTTPBadRequest
+
+        with mock.patch.object(Message, '_traversal_bulk_delete', ['user_id']):
+            self.assertRaises(HTTPBadRequest, self._delete, 'message')
+            self.assertRaises(HTTPBadRequest, self._delete,
+                'message{user_id.equals(2)}.limit(0,1)'
+            )
+
+
+class TestETags(StatementsTestCase):
+    def setUp(self):
+        super(TestETags, self).setUp()
+
+        self.now = datetime(2012, 5, 1)
+        session.add_all([
+            Note(id=i, body=u'note%s' % i, updated=self.now)
+            for i in range(1, 4)
+        ])
+        session.commit()
+        session.remove()
+        del self.statements[:]
+
+    def _get(self, key, etag=None, method='GET'):
+        from sqlalchemy_traversal.views import resources_view
+
+        headers = {}
+
+        if etag:
+            headers['If-None-Match'] = '"%s"' % etag
+
+        request = self._make_request('/traverse/' + key, method,
+            headers=headers
+        )
+        context = TraversalRoot(request)
+
+        for segment in key.split('/'):
+            context = context[segment]
+
+        request.context = context
+
+        return request, resources_view(request)
+
+    def test_version_key(self):
+        from sqlalchemy_traversal import get_version_key
+
+        assert get_version_key(Note) == 'updated'
+        assert get_version_key(Revision) == 'version'
+        assert get_version_key(Message) is None
+
+    def test_collection_not_modified(self):
+        from pyramid.httpexceptions import HTTPNotModified
+
+        request, result = self._get('note')
+        etag = request.response.etag
+
+        assert len(result) == 3
+        assert etag
+
+        del self.statements[:]
+        request, result = self._get('note', etag)
+
+        assert isinstance(result, HTTPNotModified)
+        assert result.etag == etag
+        assert len(self.statements) == 1
+        assert 'max(' in self.statements[0]
+
+    def test_collection_changes(self):
+        request, result = self._get('note')
+        etag = request.response.etag
+
+        note = session.query(Note).get(2)
+        note.updated = self.now + timedelta(seconds=1)
+        session.commit()
+
+        request, result = self._get('note', etag)
+
+        assert len(result) == 3
+        assert request.response.etag != etag
+
+    def test_version_counter_replaced_row(self):
+        session.add_all([Revision(id=i) for i in range(1, 4)])
+        session.commit()
+
+        request, result = self._get('revision')
+        etag = request.response.etag
+
+        # the new row starts at the same version the deleted one had
+        session.delete(session.query(Revision).get(3))
+        session.add(Revision(id=4))
+        session.commit()
+
+        request, result = self._get('revision', etag)
+
+        assert [x['id'] for x in result] == [1, 2, 4]
+        assert request.response.etag != etag
+
+    def test_etag_depends_on_key(self):
+        request, result = self._get('note')
+        other, result = self._get('note.limit(0,1)')
+
+        assert request.response.etag != other.response.etag
+
+    def test_instance_not_modified(self):
+        from pyramid.httpexceptions import HTTPNotModified
+
+        request, result = self._get('note/1')
+        etag = request.response.etag
+
+        assert result['body'] == u'note1'
+
+        request, result = self._get('note/1', etag)
+
+        assert isinstance(result, HTTPNotModified)
+
+    def test_eager_loaded_relationship_changes(self):
+        session.add(Board(id=1, updated=self.now,
+            pins=[Pin(id=1, body=u'pin1')]
+        ))
+        session.commit()
+
+        request, result = self._get('board')
+        etag = request.response.etag
+
+        # the pin changes, the board's version column doesn't
+        session.query(Pin).get(1).body = u'changed'
+        session.commit()
+
+        request, result = self._get('board', etag)
+
+        assert result[0]['pins'][0]['body'] == u'changed'
+        assert request.response.etag is None
+
+        request, result = self._get('board/1')
+
+        assert request.response.etag is None
+
+    def test_eager_load_not_asked_for(self):
+        session.add(Board(id=1, updated=self.now))
+        session.commit()
+
+        request, result = self._get('board.fields(id,updated)')
+
+        assert request.response.etag
+
+    def test_head(self):
+        request, result = self._get('note', method='HEAD')
+
+        # just the count and the version, no rows
+        assert result.etag
+        assert all('count(' in x for x in self.statements)
+
+    def test_payload_etag(self):
+        from webtest import TestApp
+
+        app = TestApp(self.config.make_wsgi_app())
+
+        response = app.get('/traverse/message')
+        etag = response.headers['ETag']
+
+        assert len(response.json) == 8
+
+        response = app.get('/traverse/message',
+            headers={'If-None-Match': etag}, status=304
+        )
+
+        assert response.body == ''
+
+
+class TestIdentityLookup(StatementsTestCase):
+    def _lookup(self, key, **kw):
+        request = self._make_request('/traverse/user/' + key, **kw)
+
+        return TraversalRoot(request)['user'][key]
+
+    def test_identity_map(self):
+        user = session.query(User).get(1)
+        del self.statements[:]
+
+        assert self._lookup('1') is user
+        assert self.statements == []
+
+    def test_loads_once(self):
+        first = self._lookup('2')
+
+        assert self._lookup('2') is first
+        assert len(self.statements) == 1
+
+    def test_query_string(self):
+        session.query(User).get(1)
+        del self.statements[:]
+
+        self._lookup('1', params={'name': u'user1'})
+
+        assert len(self.statements) == 1
+
+    def test_lookup_key_not_primary(self):
+        from sqlalchemy_traversal import get_primary_lookup
+
+        with mock.patch.object(User, '_traversal_lookup_key', 'name'):
+            assert get_primary_lookup(User) is None
+
+        assert get_primary_lookup(User) is User.__table__.c.id
+
+    def test_not_found(self):
+        self.assertRaises(KeyError, self._lookup, '20')
+        self.assertRaises(KeyError, self._lookup, 'nope')
+        self.assertRaises(KeyError, self._lookup, 'nope',
+            params={'name': u'user1'}
+        )
+
+    def test_database_error_not_found(self):
+        from sqlalchemy.exc import DataError
+        from sqlalchemy.orm import Query
+
+        error = DataError('SELECT', {}, Exception())
+
+        with mock.patch.object(Query, 'get', side_effect=error):
+            self.assertRaises(KeyError, self._lookup, '20')
+
+    def test_key_coerced_by_column(self):
+        from sqlalchemy_traversal import add_column_coercer
+        from sqlalchemy_traversal import COLUMN_COERCERS
+        from sqlalchemy_traversal import _column_coercers
+
+        def coerce_hex(value, column_type):
+            return int(value, 16)
+
+        add_column_coercer(Integer, coerce_hex)
+
+        user = session.query(User).get(2)
+        del self.statements[:]
+
+        try:
+            assert self._lookup('0x2') is user
+            assert self.statements == []
+            self.assertRaises(KeyError, self._lookup, 'g')
+        finally:
+            COLUMN_COERCERS.pop(0)
+            _column_coercers.clear()
+
+
+class TestRawRows(StatementsTestCase):
+    def _get(self, key, raw=True, **kw):
+        from sqlalchemy_traversal.views import resources_view
+
+        request = self._make_request('/traverse/' + key, **kw)
+
+        with mock.patch.object(Message, '_traversal_raw', raw):
+            request.context = TraversalRoot(request)[key]
+
+        return request, resources_view(request)
+
+    def test_same_as_instances(self):
+        request, expected = self._get('message{user_id.equals(2)}', False)
+        session.remove()
+
+        request, result = self._get('message{user_id.equals(2)}')
+
+        assert result == expected
+        assert len(session.identity_map) == 0
+
+    def test_fields(self):
+        request, result = self._get('message.fields(topic).limit(0,2)')
+
+        assert result == [{'topic': u'topic1'}, {'topic': u'topic0'}]
+        assert 'user_id' not in self.statements[-1]
+
+    def test_cursor(self):
+        request, result = self._get('message.order_by(topic).cursor(4)')
+        cursor = request.response.headers['X-Traversal-Next-Cursor']
+
+        assert [x['id'] for x in result] == [6, 7, 8, 2]
+
+        request, result = self._get(
+            'message.order_by(topic).cursor(4, %s)' % cursor
+        )
+
+        assert [x['id'] for x in result] == [4, 1, 3, 5]
+
+    def test_streamed(self):
+        import json
+        from sqlalchemy import event
+
+        options = []
+
+        def before_cursor_execute(conn, cursor, statement, params, context,
+                executemany):
+            options.append(context.execution_options.get('stream_results'))
+
+        event.listen(self.engine, 'before_cursor_execute',
+            before_cursor_execute
+        )
+
+        request, result = self._get('message',
+            headers={'X-Traversal-Stream': '1'}
+        )
+
+        assert [x['id'] for x in json.loads(''.join(result.app_iter))] == \
+            range(1, 9)
+        assert len(session.identity_map) == 0
+        # the driver is asked not to buffer the whole result
+        assert options[-1] is True
+
+
+class TestQueryPlans(StatementsTestCase):
+    def _get(self, key):
+        from sqlalchemy_traversal.views import resources_view
+
+        request = self._make_request('/traverse/' + key)
+        request.context = TraversalRoot(request)[key]
+
+        return resources_view(request)
+
+    def test_plan_per_shape(self):
+        from sqlalchemy_traversal import get_query_plan
+        from sqlalchemy_traversal import parse_key
+
+        def plan(key):
+            return get_query_plan(Message, parse_key(key))
+
+        assert plan('message{topic.equals(topic1)}') is \
+            plan('message{topic.equals(topic0)}')
+        assert plan('message{id.in(1,2)}') is plan('message{id.in(3,4)}')
+        assert plan('message{id.in(1,2)}') is not plan('message{id.in(1)}')
+        assert plan('message.limit(0,2)') is plan('message.limit(2,2)')
+        assert plan('message.cursor(2)') is not plan('message.cursor(2, x)')
+
+    def test_same_as_filter_query(self):
+        from sqlalchemy_traversal import filter_query
+        from sqlalchemy_traversal import get_query_plan
+        from sqlalchemy_traversal import parse_key
+
+        keys = [
+            'message{topic.starts_with(top),id.not_in(1,2)}'
+            , 'message{topic.ends_with(1),user_id.not_equals(2)}'
+            , 'message{topic.contains(pic)}.order_by(topic desc, id)'
+            , 'message{id.in(2,4,6)}.limit(1,2)'
+            , 'message.order_by(topic).cursor(3)'
+        ]
+
+        for key in keys:
+            filters = parse_key(key)
+            expected = filter_query(filters, session.query(Message), Message)
+            plan = get_query_plan(Message, filters)
+            query = plan.query(session, filters)
+
+            assert [x.id for x in plan.instances(query)] == \
+                [x.id for x in expected], key
+
+    def test_compiled_once(self):
+        from sqlalchemy_traversal import get_query_plan
+        from sqlalchemy_traversal import parse_key
+
+        plan = get_query_plan(Message, parse_key('message{topic.equals(x)}'))
+        plan.statements.clear()
+
+        assert [x['id'] for x in self._get('message{topic.equals(topic1)}')] \
+            == [1, 3, 5]
+        assert [x['id'] for x in self._get('message{topic.equals(topic0)}')] \
+            == [2, 4]
+
+        (key, (statement, compiled, context)), = plan.statements.items()
+
+        assert len(compiled) == 1
+
+    def test_context_compiled_once(self):
+        from sqlalchemy.orm import Query
+        from sqlalchemy_traversal import get_query_plan
+        from sqlalchemy_traversal import parse_key
+
+        plan = get_query_plan(Message,
+            parse_key('message{topic.equals(x)}.limit(0,2)')
+        )
+        plan.statements.clear()
+
+        compile_context = Query._compile_context
+        compiled = []
+
+        def counted(query, *args, **kw):
+            compiled.append(query)
+
+            return compile_context(query, *args, **kw)
+
+        with mock.patch.object(Query, '_compile_context', counted):
+            first = self._get('message{topic.equals(topic1)}.limit(0,2)')
+            second = self._get('message{topic.equals(topic0)}.limit(0,2)')
+
+        assert [x['id'] for x in first] == [1, 3]
+        assert [x['id'] for x in second] == [2, 4]
+        assert len(compiled) == 1
+
+    def test_cursor_values(self):
+        key = 'message.order_by(topic).cursor(4)'
+        request = self._make_request('/traverse/' + key)
+        result = TraversalRoot(request)[key]
+
+        assert [x.id for x in result] == [6, 7, 8, 2]
+
+        key = 'message.order_by(topic).cursor(4, %s)' % result.next_cursor
+
+        assert [x['id'] for x in self._get(key)] == [4, 1, 3, 5]
+
+    def test_autoflush(self):
+        session.add(User(id=8, name=u'user8'))
+
+        request = self._make_request('/traverse/user')
+
+        assert [x.id for x in TraversalRoot(request)['user']] == [1, 2, 3, 8]
+
+        request = self._make_request('/traverse/user/8',
+            params={'name': u'user8'}
+        )
+
+        assert TraversalRoot(request)['user']['8'].id == 8
+
+    def test_eager_loads_bound(self):
+        result = self._get('user{name.in(user1,user2)}')
+
+        assert [len(x['messages']) for x in result] == [5, 3]
+
+        # the related rows are loaded for the values of this query
+        session.remove()
+        result = self._get('user{name.in(user2,user3)}')
+
+        assert [len(x.get('messages', [])) for x in result] == [3, 0]
+
+    def test_qs_filters(self):
+        from sqlalchemy_traversal import get_qs_filters
+
+        filters = get_qs_filters({
+            '__order_by': 'topic desc, id'
+            , 'id.notin': '1,2'
+            , 'user_id.in': '1'
+            , 'topic.not': 'other'
+            , 'id': '3'
+        })
+
+        assert filters == {
+            'column_filters': (
+                ('id', 'equals', '3')
+                , ('id', 'not_in', ('1', '2'))
+                , ('topic', 'not_equals', 'other')
+                , ('user_id', 'in', ('1',))
+            )
+            , 'order_by': (('topic', 'desc'), ('id', 'desc'))
+        }
@@ -1,12 +1,27 @@
 from pyramid.view                       import view_config
+from pyramid.httpexceptions             import HTTPNotFound
+from pyramid.httpexceptions             import HTTPNotModified
 from sqlalchemy_traversal               import ModelCollection
 from sqlalchemy_traversal               import get_session
 from sqlalchemy_traversal               import TraversalMixin
+from sqlalchemy_traversal               import instance_etag
+from sqlalchemy_traversal               import etag_matches
+from sqlalchemy_traversal               import get_cache_tags
+from sqlalchemy_traversal               import get_write_tags
+from sqlalchemy_traversal               import invalidate_cache
+from sqlalchemy_traversal               import wants_count
 from sqlalchemy_traversal.resources     import SQLAlchemyRoot
+from sqlalchemy_traversal.resources     import QueryGetItem
+from sqlalchemy_traversal.resources     import CollectionQuery
+from sqlalchemy_traversal.resources     import CollectionDelete
 from sqlalchemy_traversal.interfaces    import ISaver
+from sqlalchemy_traversal.interfaces    import IResponseCache
+from pyramid.response                   import Response
 
 from zope.interface                     import providedBy
 
+import urllib
+
 def get_parent_keys(obj, pks):
     if hasattr(obj, '__parent__'):
         if hasattr(obj.__parent__, 'pk'):
@@ -15,28 +30,161 @@ def get_parent_keys(obj, pks):
         get_parent_keys(obj.__parent__, pks)
 
 
+def set_collection_headers(request, collection):
+    """
+    Puts the paging metadata of a ModelCollection in the response headers
+    """
+    headers = request.response.headers
+
+    if collection.next_cursor:
+        headers['X-Traversal-Next-Cursor'] = collection.next_cursor
+
+    if collection.truncated:
+        headers['X-Traversal-Truncated'] = 'true'
+
+    if collection.total_count is not None:
+        headers['X-Traversal-Total-Count'] = str(collection.total_count)
+
+
+def payload_etag(request, response):
+    """
+    Response callback that uses a hash of the rendered body as the ETag
+    and lets webob answer a matching If-None-Match with a 304
+    """
+    if response.status_int == 200 and response.etag is None:
+        response.md5_etag()
+        response.conditional_response = True
+
+
+def stream_response(request, collection, extra):
+    """
+    Writes the collection out as a chunked JSON array instead of handing
+    the full list to the json renderer
+    """
+    response = request.response
+    response.content_type = 'application/json'
+    response.app_iter = collection.iter_json(request, extra=extra)
+
+    return response
+
+
+def get_cache_key(request):
+    """
+    The normalized path and query string a GET response is cached under
+    """
+    path = urllib.unquote(request.path)
+    params = tuple(sorted(request.GET.items()))
+
+    return (path, params, wants_count({}, request))
+
+
+def response_cache(view):
+    """
+    View decorator that answers GETs from the IResponseCache, the
+    responses resources_view tagged with request.traversal_cache_tags are
+    stored on the way out.  It runs after traversal and the view's
+    permission checks, so a cached response is only given to requests
+    that are allowed to see it.
+    """
+    def response_cache_view(context, request):
+        cache = request.registry.queryUtility(IResponseCache)
+
+        if cache is None or request.method != 'GET':
+            return view(context, request)
+
+        key = get_cache_key(request)
+        cached = cache.get(key)
+
+        if cached is not None:
+            body, headerlist = cached
+
+            response = Response(body=body, headerlist=list(headerlist))
+            response.conditional_response = True
+
+            return response
+
+        response = view(context, request)
+        tags = getattr(request, 'traversal_cache_tags', None)
+
+        if tags and response.status_int == 200:
+            # response callbacks run after us, so hash the body now
+            payload_etag(request, response)
+
+            headerlist = [(name, value) for name, value in response.headerlist
+                if name.lower() != 'set-cookie'
+            ]
+
+            cache.set(key, (response.body, tuple(headerlist)), tags)
+
+        return response
+
+    return response_cache_view
+
+
 @view_config(
     route_name='traversal_resources',
     renderer='json',
+    decorator=response_cache,
 )
 def resources_view(request):
     session = get_session(request)
 
-    if request.method == 'GET':
-        #TODO: Do we really want to be doing this? :P
-        results = request.context.__json__(request)
+    if request.method in ('GET', 'HEAD'):
+        # lazy traversal hands us the query, run it now
+        if isinstance(request.context, (QueryGetItem, CollectionQuery)):
+            try:
+                request.context = request.context.resolve()
+            except KeyError:
+                raise HTTPNotFound()
+
+        etag = None
+
+        if isinstance(request.context, ModelCollection):
+            etag = request.context.etag
+        elif isinstance(request.context, TraversalMixin):
+            etag = instance_etag(request.context, request)
+
+        if etag is not None:
+            if etag_matches(request, etag):
+                response = HTTPNotModified()
+                response.etag = etag
+
+                return response
+
+            request.response.etag = etag
+        # a streamed body can't be hashed before it is sent
+        elif request.method == 'GET' \
+                and not getattr(request.context, 'stream', False):
+            request.add_response_callback(payload_etag)
+
+        if request.method == 'HEAD':
+            if isinstance(request.context, ModelCollection):
+                set_collection_headers(request, request.context)
+
+            request.response.content_type = 'application/json'
+
+            return request.response
+
         parent_pks = {}
         get_parent_keys(request.context, parent_pks)
 
         if isinstance(request.context, ModelCollection):
-            results = []
-            for obj in request.context:
-                json = obj.__json__(request)
-                results.append(dict(json.items() + parent_pks.items()))
+            set_collection_headers(request, request.context)
 
-            return results
+            if request.context.stream:
+                return stream_response(request, request.context, parent_pks)
+
+        # lets response_cache know it may keep the response
+        request.traversal_cache_tags = get_cache_tags(request.context)
+
+        if isinstance(request.context, ModelCollection):
+            # merge the parent keys in while each row is serialized
+            return request.context.__json__(request, extra=parent_pks)
         else:
-            return dict(results.items() + parent_pks.items())
+            results = request.context.__json__(request)
+            results.update(parent_pks)
+
+            return results
 
     elif request.method == 'POST' or request.method == 'PUT':
         if isinstance(request.context, SQLAlchemyRoot):
@@ -55,7 +203,7 @@ def resources_view(request):
 
         if not isinstance(result, TraversalMixin):
             if 'has_errors' in result:
-                request.response_status = '400 Bad Request'
+                request.response.status = 400
 
         if 'serverAttrs' in request.json:
             to_return = {}
@@ -66,6 +214,11 @@ def resources_view(request):
 
         return result
     elif request.method == 'DELETE':
+        if isinstance(request.context, CollectionDelete):
+            return {'success': True, 'count': request.context.delete()}
+
+        invalidate_cache(request, get_write_tags(request.context))
+
         session.delete(request.context)
         return {'success': True}
 